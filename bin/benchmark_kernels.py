@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark the backends in pyplr.kernels on synthetic recordings.
+
+Usage: python benchmark_kernels.py [n_samples ...]
+
+The default sizes are 1e6 and 1e7 samples. 1e8 needs about 4 GB of memory.
+"""
+
+import sys
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from pyplr import kernels
+
+SAMPLE_RATE = 120
+BLINK_EVERY = 4.0  # s
+EVENT_EVERY = 10.0  # s
+EPOCH_LENGTH = 7 * SAMPLE_RATE
+
+
+def synthetic_recording(n, seed=0):
+    """Jittered 120 Hz timestamps, a dropout mask and regular blinks."""
+    rng = np.random.default_rng(seed)
+    t = np.cumsum(rng.uniform(0.9, 1.1, n) / SAMPLE_RATE)
+    blink_on = np.arange(t[0], t[-1], BLINK_EVERY)
+    blink_on += rng.uniform(0, 1, len(blink_on))
+    blink_off = blink_on + rng.uniform(0.1, 0.3, len(blink_on))
+    dropout = kernels.interval_sweep(t, blink_on, blink_off)
+    values = rng.normal(4, 0.1, (n, 2)).astype("float32")
+    return t, values, dropout, blink_on, blink_off
+
+
+def cases(n):
+    t, values, dropout, blink_on, blink_off = synthetic_recording(n)
+    onsets = np.arange(t[0], t[-1], EVENT_EVERY)
+    starts = np.searchsorted(t, onsets) - SAMPLE_RATE
+    idxs = starts[:, None] + np.arange(EPOCH_LENGTH)
+    n_events = min(len(onsets), n // EPOCH_LENGTH)
+    keys = t[np.clip(idxs[:n_events], 0, n - 1)]
+    keys = keys - keys[:, :1]
+    grid = np.arange(EPOCH_LENGTH) / SAMPLE_RATE
+    queries = np.broadcast_to(grid, keys.shape)
+    span = max(keys.max(), grid.max()) + 1.0
+    return {
+        "interval_sweep": lambda: kernels.interval_sweep(
+            t, blink_on, blink_off
+        ),
+        "runs": lambda: kernels.runs(dropout),
+        "gather_rows": lambda: kernels.gather_rows(values, idxs),
+        "search_rows": lambda: kernels.search_rows(keys, queries, span),
+    }
+
+
+def best_of(func, repeat=3):
+    func()  # warm up (and compile)
+    times = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        func()
+        times.append(perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == "__main__":
+    sizes = [int(float(a)) for a in sys.argv[1:]] or [10**6, 10**7]
+    results = []
+    for n in sizes:
+        for name, func in cases(n).items():
+            row = {"n_samples": n, "kernel": name}
+            for backend in kernels.available_backends():
+                kernels.set_backend(backend)
+                row[backend] = best_of(func)
+            results.append(row)
+    results = pd.DataFrame(results).set_index(["n_samples", "kernel"])
+    if "numba" in results:
+        results["speedup"] = results["numpy"] / results["numba"]
+    print(results.to_string(float_format="{:.4f}".format))
@@ -8,11 +8,12 @@ Created on Sat Mar 28 11:06:05 2020
 import os
 import os.path as op
 import pyplr as plr
+from pyplr import graphing
+from pyplr.epochs import EpochSet
+from pyplr.store import EpochStore
 import matplotlib.pyplot as plt
-from pandas import HDFStore
 import seaborn as sns
 
-# from based_noise_blinks_detection import based_noise_blinks_detection
 sns.set_context(context="paper", font_scale=2.1)
 
 # directories for analysis
@@ -42,24 +43,21 @@ for subjdir in subjdirs:
     samples = plr.load_pupil(pl_data_dir, cols=load_cols)
     events = plr.load_annotations(pl_data_dir)
     blinks = plr.load_blinks(pl_data_dir)
-    # blinks = based_noise_blinks_detection(samples["diameter"], sample_rate)
+    # blinks = plr.preproc.detect_blinks(samples, "diameter", sample_rate)
 
-    # make figure for processing
-    f, axs = plt.subplots(nrows=4, ncols=1, sharex=True, figsize=(14, 14))
-
-    # plot the raw data
-    samples[pupil_cols].plot(title="Raw", ax=axs[0], legend=False)
+    # keep a downsampled copy of each stage for the processing figure
+    stages = [("Raw", graphing.downsample(samples[pupil_cols]))]
 
     # interpolate zeros
     samples = plr.interpolate_zeros(samples, fields=pupil_cols)
-    samples[pupil_cols].plot(
-        title="Zeros interpolated", ax=axs[1], legend=False
+    stages.append(
+        ("Zeros interpolated", graphing.downsample(samples[pupil_cols]))
     )
 
     # interpolate blinks
     samples = plr.interpolate_blinks(samples, blinks, fields=pupil_cols)
-    samples[pupil_cols].plot(
-        title="Blinks interpolated", ax=axs[2], legend=False
+    stages.append(
+        ("Blinks interpolated", graphing.downsample(samples[pupil_cols]))
     )
 
     # smooth
@@ -67,14 +65,11 @@ for subjdir in subjdirs:
     samples = plr.butterworth_series(
         samples, fields=pupil_cols, filt_order=3, cutoff_freq=0.05
     )
-    samples[pupil_cols].plot(
-        title="Butterworth filtered", ax=axs[3], legend=False
+    stages.append(
+        ("Butterworth filtered", graphing.downsample(samples[pupil_cols]))
     )
 
-    for ax in axs:
-        ax.set_ylabel("Pupil diameter")
-        ax.set_xlabel("Pupil timestamp")
-    axs[0].legend(loc="upper right", labels=["pixels", "mm"])
+    f, axs = graphing.pupil_preprocessing_figure(4, subjid, stages=stages)
     f.savefig(out_dir + "\\" + subjid + "_pupil_processing.png")
 
     # get the events of interest
@@ -207,10 +202,11 @@ for subjdir in subjdirs:
     # save metrics
     metrics.to_csv(out_dir + "\\pipr_metrics.csv")
 
-    # add the subject id
-    ranges["subjid"] = subjid
-
-    # append processed data to HDFStore
-    processed = HDFStore(expdir + "\\processed.h5")
-    processed.put(subjid, ranges, format="table")
-    processed.close()
+    # add processed epochs to the study's epoch store
+    epochs = EpochSet.from_ranges(
+        ranges.set_index(["event", "onset"]),
+        fields=["diameter", "diameter_3d", "diameter_pc", "diameter_3dpc"],
+        attributes=["color", "reject"],
+    )
+    # replace any epochs from a previous run for this subject
+    EpochStore(expdir + "\\epochs").append(subjid, epochs, replace=True)
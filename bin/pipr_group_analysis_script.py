@@ -5,28 +5,21 @@ Created on Wed Apr  8 15:25:58 2020
 @author: engs2242
 """
 
-import os
 import pyplr as plr
-import pandas as pd
-import seaborn as sns
 import matplotlib.pyplot as plt
+from pyplr.store import EpochStore
 
 # useful strings
 exp_dir = "..\\..\\..\\data\\red_vs_blue_2s_pulse_3trials_each"
-subdirs = [f.path for f in os.scandir(exp_dir) if f.is_dir()]
 
-# handle for processed data
-store = exp_dir + "\\processed.h5"
+# epochs for all subjects, written by pipr_analysis_script.py
+store = EpochStore(exp_dir + "\\epochs")
 
-# loop on subjects
-combined = pd.DataFrame()
-for subdir in subdirs:
-    subject = subdir[-6:]
-    ranges = pd.read_hdf(store, key=subject)
-    ranges["subject"] = subject
-    combined = combined.append(ranges)
-
-combined.reset_index(inplace=True)
+# subject and grand averages, streamed over the store one chunk at a time
+channels = ["diameter_3d", "diameter_3dpc"]
+subject_means = store.mean(by=["subject", "color"], channels=channels)
+grand_means = store.mean(by="color", channels=channels)
+grand_sems = store.sem(by="color", channels=channels)
 
 # plot grand averages
 fig, axs = plt.subplots(
@@ -34,24 +27,21 @@ fig, axs = plt.subplots(
 )
 axs = [item for sublist in axs for item in sublist]
 p = 0
-for sub, df in combined.groupby("subject"):
-    averages = df.groupby(by=["color", "onset"], as_index=True).mean()
-
-    axs[p].plot(averages.loc["red", "diameter_3dpc"], color="red")
-    axs[p].plot(averages.loc["blue", "diameter_3dpc"], color="blue")
+for sub in subject_means.events["subject"].unique():
+    means = subject_means.select(subject=sub)
+    for color in ["red", "blue"]:
+        axs[p].plot(
+            means.select(color=color).channel("diameter_3dpc")[0], color=color
+        )
     axs[p].set_title(sub)
     p += 1
-sns.lineplot(
-    x="onset",
-    y="diameter_3dpc",
-    hue="color",
-    data=combined,
-    n_boot=10,
-    ci=95,
-    palette=["red", "blue"],
-    ax=axs[p],
-    legend=False,
-)
+for color in ["red", "blue"]:
+    m = grand_means.select(color=color).channel("diameter_3dpc")[0]
+    ci = grand_sems.select(color=color).channel("diameter_3dpc")[0] * 1.96
+    axs[p].plot(m, color=color)
+    axs[p].fill_between(
+        range(len(m)), m - ci, m + ci, color=color, alpha=0.2, lw=0
+    )
 
 for ax in axs[3:]:
     ax.set_xlabel("Time (s)")
@@ -75,7 +65,7 @@ onset = 600
 pc = 0.01
 
 # grand averages
-averages = combined.groupby(by=["color", "onset"]).mean()
+averages = grand_means.to_frame().reset_index().set_index(["color", "onset"])
 
 # some plr metrics
 metrics = averages.groupby(by=["color"]).agg(
@@ -8,9 +8,9 @@ Created on Sat Mar 28 11:06:05 2020
 import os
 import os.path as op
 import pyplr as plr
+from pyplr import graphing
 import matplotlib.pyplot as plt
 from pandas import HDFStore
-from based_noise_blinks_detection import based_noise_blinks_detection
 
 # directories for analysis
 expdir = r"C:\Users\engs2242\Documents\repos\cvd_pupillometry\data\sinusoid_video_file"
@@ -39,20 +39,22 @@ for subjdir in subjdirs:
     samples = plr.load_pupil(pl_data_dir, cols=load_cols)
     events = plr.load_annotations(pl_data_dir)
     # blinks  = plr.load_blinks(pl_data_dir)
-    blinks = based_noise_blinks_detection(samples["diameter"], sample_rate)
+    blinks = plr.preproc.detect_blinks(samples, "diameter", sample_rate)
 
     # plot the raw data
-    ax = samples[pupil_cols].plot(figsize=(14, 4), title=subjid + ": raw")
+    ax = graphing.downsample(samples[pupil_cols]).plot(
+        figsize=(14, 4), title=subjid + ": raw"
+    )
     ax.get_figure().savefig(out_dir + "\\raw.png")
 
     # interpolate zeros, then blinks, then smooth
     samples = plr.interpolate_zeros(samples, fields=pupil_cols)
-    ax = samples[pupil_cols].plot(
+    ax = graphing.downsample(samples[pupil_cols]).plot(
         figsize=(14, 4), title=subjid + ": zeros interpolated"
     )
     ax.get_figure().savefig(out_dir + "\\zeros interpolated.png")
     samples = plr.interpolate_blinks(samples, blinks, fields=pupil_cols)
-    ax = samples[pupil_cols].plot(
+    ax = graphing.downsample(samples[pupil_cols]).plot(
         figsize=(14, 4), title=subjid + ": blinks interpolated"
     )
     ax.get_figure().savefig(out_dir + "\\blinks interpolated.png")
@@ -60,7 +62,7 @@ for subjdir in subjdirs:
         samples, fields=pupil_cols, window_length=51, filt_order=7
     )
     # samples = plr.butterworth_series(samples, fields=pupil_cols, filt_order=3, cutoff_freq=.05)
-    ax = samples[pupil_cols].plot(
+    ax = graphing.downsample(samples[pupil_cols]).plot(
         figsize=(14, 4), title=subjid + ": butterworth filtered"
     )
     ax.get_figure().savefig(out_dir + "\\butterworth filtered.png")
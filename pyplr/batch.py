@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pyplr.batch
+===========
+
+Run the same preprocessing and extraction on many recordings in parallel.
+
+Each recording is processed in its own worker process and its result is
+written to a separate temporary file, so subjects never contend for a shared
+HDF5 file and one bad recording cannot bring down the rest. Once all workers
+are done, the results are collected into a single HDFStore, one key per
+subject, just as the analysis scripts in ``bin/`` do by hand.
+
+Example
+-------
+>>> spec = {
+...     'load': {'cols': ['pupil_timestamp', 'eye_id', 'method',
+...                       'confidence', 'diameter', 'diameter_3d']},
+...     'steps': [
+...         ('interpolate_zeros', {'fields': ['diameter', 'diameter_3d']}),
+...         ('interpolate_blinks', {'fields': ['diameter', 'diameter_3d']}),
+...         ('butterworth_series', {'fields': ['diameter', 'diameter_3d'],
+...                                 'filt_order': 3, 'cutoff_freq': .05}),
+...     ],
+...     'events': "label == 'light_on'",
+...     'extract': {'offset': -600, 'duration': 7600,
+...                 'borrow_attributes': ['color']},
+... }
+>>> summary = run_batch(subjdirs, spec, 'processed.h5', n_workers=32)
+
+"""
+
+import os
+import os.path as op
+import inspect
+import shutil
+import tempfile
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from time import perf_counter
+from typing import List, Tuple
+
+import pandas as pd
+
+from pyplr import deconv, preproc, utils
+
+_SUMMARY_COLS = [
+    "subjid",
+    "rec_dir",
+    "status",
+    "fname",
+    "n_rows",
+    "error",
+    "seconds",
+]
+
+
+def _set_memory_limit(memory_limit: int) -> None:
+    """Cap the address space of the current process (POSIX only)."""
+    try:
+        import resource
+    except ImportError:
+        print("Memory limits are not supported on this platform")
+        return
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def process_recording(
+    rec_dir: str, spec: dict, export: str = "000", subjid: str = None
+) -> pd.DataFrame:
+    """Load, preprocess and (optionally) extract events for one recording.
+
+    Parameters
+    ----------
+    rec_dir : str
+        Pupil Labs recording directory.
+    spec : dict
+        Preprocessing spec. Keys are:
+
+            * 'load' - kwargs for ``utils.load_pupil(...)``
+            * 'steps' - list of (name, kwargs) pairs naming functions in
+              ``pyplr.preproc`` to apply to the samples in order. Blinks
+              are passed to any step that takes a `blinks` argument.
+            * 'events' - query string used to select annotations
+            * 'extract' - kwargs for ``utils.extract(...)``
+            * 'deconvolve' - kwargs for ``deconv.deconvolve(...)``, used
+              instead of 'extract' to estimate response kernels
+
+        Only 'load' and 'steps' are required. Without 'extract' or
+        'deconvolve', the preprocessed samples are returned.
+    export : str, optional
+        The export folder to read from. The default is '000'.
+    subjid : str, optional
+        Subject identifier. The default is None (the name of `rec_dir`).
+
+    Returns
+    -------
+    out : pandas.DataFrame
+        Extracted ranges, response kernels or preprocessed samples, with a
+        'subjid' column.
+
+    """
+    data_dir = op.join(rec_dir, "exports", export)
+    samples = utils.load_pupil(data_dir, **spec.get("load", {}))
+    steps = [(getattr(preproc, name), kw) for name, kw in spec["steps"]]
+    blinks = None
+    if any("blinks" in inspect.signature(f).parameters for f, _ in steps):
+        blinks = utils.load_blinks(data_dir)
+    for func, kwargs in steps:
+        if "blinks" in inspect.signature(func).parameters:
+            samples = func(samples, blinks, **kwargs)
+        else:
+            samples = func(samples, **kwargs)
+    out = samples
+    if "extract" in spec or "deconvolve" in spec:
+        events = utils.load_annotations(data_dir)
+        if "events" in spec:
+            events = events.query(spec["events"])
+        if "deconvolve" in spec:
+            out = deconv.deconvolve(samples, events, **spec["deconvolve"])
+        else:
+            out = utils.extract(samples, events, **spec["extract"])
+    out["subjid"] = subjid or op.basename(op.normpath(rec_dir))
+    return out
+
+
+def _worker(
+    rec_dir: str,
+    subjid: str,
+    spec: dict,
+    tmp_dir: str,
+    export: str,
+    memory_limit: int,
+) -> dict:
+    """Process one recording and write the result to `tmp_dir`.
+
+    Any exception (including MemoryError from hitting `memory_limit`) is
+    caught and reported, so it only affects this recording.
+
+    """
+    record = {"subjid": subjid, "rec_dir": rec_dir}
+    t0 = perf_counter()
+    try:
+        if memory_limit is not None:
+            _set_memory_limit(memory_limit)
+        out = process_recording(rec_dir, spec, export, subjid)
+        fname = op.join(tmp_dir, subjid + ".pkl")
+        out.to_pickle(fname)
+        record.update(status="ok", fname=fname, n_rows=len(out), error="")
+    except Exception as e:
+        record.update(status="failed", fname=None, n_rows=0, error=repr(e))
+    record["seconds"] = perf_counter() - t0
+    return record
+
+
+def _run_pool(args: list, n_workers: int) -> Tuple[list, list]:
+    """Run `_worker` over `args`, returning the records and the args of any
+    jobs whose worker process died (e.g., killed by the OS).
+
+    """
+    records, crashed = [], []
+    with futures.ProcessPoolExecutor(max_workers=n_workers) as ex:
+        jobs = {ex.submit(_worker, *a): a for a in args}
+        for job in futures.as_completed(jobs):
+            try:
+                records.append(job.result())
+            except BrokenProcessPool:
+                crashed.append(jobs[job])
+    return records, crashed
+
+
+def run_batch(
+    rec_dirs: List[str],
+    spec: dict,
+    out_fname: str,
+    n_workers: int = None,
+    memory_limit: int = None,
+    export: str = "000",
+    subject_ids: List[str] = None,
+) -> pd.DataFrame:
+    """Process many recordings in parallel and collect the results.
+
+    Parameters
+    ----------
+    rec_dirs : list of str
+        Pupil Labs recording directories, one per subject.
+    spec : dict
+        Preprocessing spec, see ``process_recording(...)``.
+    out_fname : str
+        HDF5 file in which to store the results, one key per subject.
+    n_workers : int, optional
+        Number of worker processes. The default is None (one per CPU).
+    memory_limit : int, optional
+        Maximum address space in bytes for each worker. A subject that needs
+        more fails with a MemoryError without affecting the others. POSIX
+        only. The default is None (no limit).
+    export : str, optional
+        The export folder to read from. The default is '000'.
+    subject_ids : list of str, optional
+        Identifier of each subject, used as its key in `out_fname`. Must be
+        unique. The default is None (the name of each directory in
+        `rec_dirs`).
+
+    Returns
+    -------
+    summary : pandas.DataFrame
+        Status, number of rows, time taken and any error for each subject.
+
+    """
+    if subject_ids is None:
+        subject_ids = [op.basename(op.normpath(d)) for d in rec_dirs]
+    if len(subject_ids) != len(rec_dirs):
+        raise ValueError("Need one subject ID per recording")
+    if len(set(subject_ids)) != len(subject_ids):
+        # e.g., recordings named by date in different subject folders
+        raise ValueError(
+            "Subject IDs must be unique. Pass subject_ids to name them."
+        )
+    tmp_dir = tempfile.mkdtemp(
+        prefix="pyplr_batch_", dir=op.dirname(op.abspath(out_fname))
+    )
+    args = [
+        (d, s, spec, tmp_dir, export, memory_limit)
+        for d, s in zip(rec_dirs, subject_ids)
+    ]
+    try:
+        records, crashed = _run_pool(args, n_workers or os.cpu_count())
+        # a dead worker takes the whole pool with it, so rerun the affected
+        # subjects one at a time to find the culprit(s)
+        for a in crashed:
+            more, still_crashed = _run_pool([a], 1)
+            records.extend(more)
+            for b in still_crashed:
+                records.append(
+                    {
+                        "subjid": b[1],
+                        "rec_dir": b[0],
+                        "status": "crashed",
+                        "fname": None,
+                        "n_rows": 0,
+                        "error": "worker process died",
+                        "seconds": float("nan"),
+                    }
+                )
+
+        # collect in the parent only, so there is one writer
+        with pd.HDFStore(out_fname) as store:
+            for r in records:
+                if r["status"] == "ok":
+                    store.put(
+                        r["subjid"], pd.read_pickle(r["fname"]), format="table"
+                    )
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    summary = (
+        pd.DataFrame(records, columns=_SUMMARY_COLS)
+        .drop(columns="fname")
+        .set_index("subjid")
+        .reindex(subject_ids)
+    )
+    n_ok = (summary["status"] == "ok").sum()
+    print("Processed {} of {} recordings".format(n_ok, len(rec_dirs)))
+    return summary
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pyplr.cache
+===========
+
+A columnar sidecar cache for exported CSV files.
+
+The first time a file is read through ``read_table(...)``, the parsed table
+is written in Feather format to a '.pyplr_cache' directory next to it, with
+a fingerprint of the source (size, modification time and a BLAKE2 hash of
+its contents). Later reads memory-map the Feather file, so only the
+requested columns are touched and nothing is parsed.
+
+A cached table is used as long as the size and modification time of the
+source are unchanged. If only the modification time has changed (e.g., the
+export was copied), the contents are hashed and the cache is kept if they
+match. Otherwise, the file is parsed again and the cache replaced.
+
+Requires `pyarrow <https://arrow.apache.org/docs/python/>`_. See
+``utils.load_pupil(..., cache=True)`` and ``utils.warm_cache(...)``.
+
+"""
+
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+from typing import Callable, List
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+CACHE_DIR = ".pyplr_cache"
+
+# bump to invalidate caches written by older versions
+CACHE_VERSION = 2
+
+
+def _paths(fname: str) -> tuple:
+    """Feather and fingerprint files for the source file `fname`."""
+    head, tail = op.split(op.abspath(fname))
+    base = op.join(head, CACHE_DIR, op.splitext(tail)[0])
+    return base + ".feather", base + ".json"
+
+
+def _hash(fname: str, block_size: int = 1 << 20) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def fingerprint(fname: str, content: bool = True) -> dict:
+    """Size, modification time and (optionally) content hash of a file.
+
+    Parameters
+    ----------
+    fname : str
+        The file.
+    content : bool, optional
+        Whether to hash the contents. The default is True.
+
+    Returns
+    -------
+    fp : dict
+        The fingerprint.
+
+    """
+    st = os.stat(fname)
+    fp = {
+        "version": CACHE_VERSION,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+    }
+    if content:
+        fp["blake2b"] = _hash(fname)
+    return fp
+
+
+def is_fresh(fname: str) -> bool:
+    """Whether there is an up to date cached table for `fname`.
+
+    If the source has been touched but not changed, the stored modification
+    time is updated so that the contents need not be hashed again.
+
+    """
+    table_fname, fp_fname = _paths(fname)
+    try:
+        with open(fp_fname) as f:
+            stored = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return False
+    if not op.exists(table_fname):
+        return False
+    current = fingerprint(fname, content=False)
+    if stored.get("version") != current["version"]:
+        return False
+    if stored.get("size") != current["size"]:
+        return False
+    if stored.get("mtime_ns") == current["mtime_ns"]:
+        return True
+    if stored.get("blake2b") != _hash(fname):
+        return False
+    stored["mtime_ns"] = current["mtime_ns"]
+    _write_json(stored, fp_fname)
+    return True
+
+
+def _write_json(obj: dict, fname: str) -> None:
+    tmp = "{}.{}.tmp".format(fname, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp, fname)
+
+
+def write_table(fname: str, data: pd.DataFrame) -> None:
+    """Cache the parsed contents of `fname`.
+
+    Files are written under temporary names and then renamed, so readers
+    (and other writers) never see a partial cache.
+
+    Parameters
+    ----------
+    fname : str
+        The source file.
+    data : pandas.DataFrame
+        Its parsed contents. The index is kept.
+
+    Returns
+    -------
+    None.
+
+    """
+    if pa is None:
+        raise ValueError("The cache requires pyarrow")
+    fp = fingerprint(fname)
+    table_fname, fp_fname = _paths(fname)
+    os.makedirs(op.dirname(table_fname), exist_ok=True)
+    tmp = "{}.{}.tmp".format(table_fname, os.getpid())
+    table = pa.Table.from_pandas(data, preserve_index=True)
+    # uncompressed, so that it can be memory-mapped
+    feather.write_feather(table, tmp, compression="uncompressed")
+    os.replace(tmp, table_fname)
+    _write_json(fp, fp_fname)
+
+
+def read_table(
+    fname: str,
+    parse: Callable[[str], pd.DataFrame],
+    columns: List[str] = None,
+) -> "pa.Table":
+    """Read a file through the cache.
+
+    Parameters
+    ----------
+    fname : str
+        The source file.
+    parse : callable
+        Function that reads `fname` into a pandas.DataFrame. Only called
+        if the cache is missing or out of date.
+    columns : list, optional
+        Columns to read. The default is None (all columns).
+
+    Returns
+    -------
+    table : pyarrow.Table
+        Memory-mapped table. Use ``table.to_pandas()`` for a DataFrame.
+
+    """
+    if pa is None:
+        raise ValueError("The cache requires pyarrow")
+    if not is_fresh(fname):
+        print("Caching {}".format(fname))
+        write_table(fname, parse(fname))
+    table_fname = _paths(fname)[0]
+    if columns is not None:
+        # keep any stored index columns so that it can be restored
+        schema = feather.read_table(table_fname, memory_map=True).schema
+        index = (schema.pandas_metadata or {}).get("index_columns", [])
+        keep = set(columns) | {c for c in index if isinstance(c, str)}
+        columns = [c for c in schema.names if c in keep]
+    return feather.read_table(table_fname, columns=columns, memory_map=True)
+
+
+def clear(data_dir: str) -> None:
+    """Delete the cache for the files in `data_dir`."""
+    shutil.rmtree(op.join(data_dir, CACHE_DIR), ignore_errors=True)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pyplr.chunked
+=============
+
+Out-of-core preprocessing for recordings too long to hold in memory.
+
+``preprocess_pupil_chunked(...)`` streams 'pupil_positions.csv' in blocks of
+a fixed number of rows, masks, interpolates and filters each block, and
+appends the result to a file on disk. Interpolation and filter state are
+carried across block boundaries, so the output matches processing the
+whole recording at once (to within the tolerance of ``preproc.BlockFilter``)
+while peak memory depends only on the block size.
+
+"""
+
+import os
+import os.path as op
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from pyplr.preproc import BlockFilter, _artifact_reasons, _reject_mask
+from pyplr.utils import _match_method
+
+
+class _ChunkInterpolator:
+    """Linear interpolation over NaNs in a stream of DataFrame blocks.
+
+    Rows after the last fully valid row of a block are held back until the
+    next valid row arrives, so gaps spanning block boundaries are filled as
+    if the data had been processed in one go. As with
+    ``preproc.interpolate_zeros(...)``, samples are treated as evenly spaced
+    and missing values at the start or end take the nearest valid value.
+
+    """
+
+    def __init__(self, fields: List[str]) -> None:
+        self.fields = fields
+        self._pending = None
+        self._last = None
+
+    def _fill(self, frame: pd.DataFrame) -> pd.DataFrame:
+        v = frame[self.fields].to_numpy(dtype="float")
+        nans = np.isnan(v)
+        frame["interpolated"] = nans.any(axis=1).astype("int")
+        if nans.any():
+            x = np.arange(len(v))
+            for i in np.flatnonzero(nans.any(axis=0)):
+                good = ~nans[:, i]
+                xp, fp = x[good], v[good, i]
+                if self._last is not None:
+                    xp, fp = np.r_[-1, xp], np.r_[self._last[i], fp]
+                if len(xp):
+                    v[nans[:, i], i] = np.interp(x[nans[:, i]], xp, fp)
+            frame[self.fields] = v
+        if len(v):
+            self._last = v[-1]
+        return frame
+
+    def process(self, frame: pd.DataFrame) -> pd.DataFrame:
+        if self._pending is not None:
+            frame = pd.concat([self._pending, frame])
+        ok = ~frame[self.fields].isna().any(axis=1).to_numpy()
+        if not ok.any():
+            self._pending = frame
+            return frame.iloc[:0]
+        last = np.flatnonzero(ok)[-1] + 1
+        self._pending = frame.iloc[last:]
+        return self._fill(frame.iloc[:last].copy())
+
+    def flush(self) -> pd.DataFrame:
+        frame, self._pending = self._pending, None
+        if frame is None:
+            return None
+        return self._fill(frame.copy())
+
+
+class _ChunkFilter:
+    """Apply a ``preproc.BlockFilter`` to `fields` of DataFrame blocks."""
+
+    def __init__(self, fields: List[str], bf: BlockFilter) -> None:
+        self.fields = fields
+        self.bf = bf
+        self._pending = None
+
+    def _emit(self, filtered: np.ndarray) -> pd.DataFrame:
+        done = self._pending.iloc[: len(filtered)].copy()
+        self._pending = self._pending.iloc[len(filtered) :]
+        done[self.fields] = filtered.reshape(len(done), len(self.fields))
+        return done
+
+    def process(self, frame: pd.DataFrame) -> pd.DataFrame:
+        self._pending = (
+            frame
+            if self._pending is None
+            else pd.concat([self._pending, frame])
+        )
+        return self._emit(
+            self.bf.process(frame[self.fields].to_numpy(dtype="float"))
+        )
+
+    def flush(self) -> pd.DataFrame:
+        if self._pending is None:
+            return None
+        return self._emit(self.bf.flush())
+
+
+def _best_eye(fname: str, method: str, chunksize: int) -> int:
+    """Eye with the highest average confidence, found in one streaming pass
+    over the 'eye_id', 'method' and 'confidence' columns.
+
+    """
+    totals = None
+    for chunk in pd.read_csv(
+        fname, usecols=["eye_id", "method", "confidence"], chunksize=chunksize
+    ):
+        chunk = chunk.loc[_match_method(chunk.method, method)]
+        agg = chunk.groupby("eye_id")["confidence"].agg(["sum", "count"])
+        totals = agg if totals is None else totals.add(agg, fill_value=0)
+    if totals is None or totals.empty:
+        raise ValueError('No samples found for method "{}"'.format(method))
+    return int((totals["sum"] / totals["count"]).idxmax())
+
+
+def _append(frame: pd.DataFrame, out_fname: str, first: bool) -> None:
+    """Append processed rows to a .csv or .h5 file."""
+    if out_fname.endswith(".h5"):
+        frame.to_hdf(out_fname, key="samples", format="table", append=True)
+    else:
+        frame.to_csv(out_fname, mode="w" if first else "a", header=first)
+
+
+def preprocess_pupil_chunked(
+    data_dir: str,
+    out_fname: str,
+    fields: List[str] = ["diameter"],
+    eye_id: str = "best",
+    method: str = "3d c++",
+    cols: List[str] = None,
+    blinks: pd.DataFrame = None,
+    mask_zeros: bool = True,
+    confidence_threshold: float = None,
+    filt_order: int = 3,
+    cutoff_freq: float = 0.01,
+    chunksize: int = 200000,
+    overlap: int = None,
+) -> int:
+    """Preprocess 'pupil_positions.csv' block by block.
+
+    Each block of rows is read, filtered by eye and method as in
+    ``utils.load_pupil(...)``, masked (zeros, low confidence, blinks),
+    linearly interpolated and Butterworth filtered, then appended to
+    `out_fname`. Only the current block, the filter overlap and any
+    unfinished gap are held in memory.
+
+    Parameters
+    ----------
+    data_dir : str
+        Directory where the Pupil Labs 'pupil_positions.csv' data exists.
+    out_fname : str
+        File to write. If it ends with '.h5' the output is appended to an
+        HDF5 table under the key 'samples', otherwise it is written as CSV.
+        Any existing file is overwritten.
+    fields : list, optional
+        Pupil columns to process. The default is ['diameter'].
+    eye_id : str, optional
+        Eye to load. Must be 'left' (1), 'right' (0), or 'best'. If 'best',
+        the eye with the highest average confidence is found with an extra
+        pass over three columns of the file. The default is 'best'.
+    method : str, optional
+        Pupil detection method to load. The default is '3d c++'.
+    cols : list, optional
+        Other columns to carry through to the output. The default is None
+        (only `fields` and 'confidence').
+    blinks : pandas.DataFrame, optional
+        Blinks to mask, with 'start_timestamp' and 'end_timestamp' columns
+        (e.g., from ``utils.load_blinks(...)``). The default is None.
+    mask_zeros : bool, optional
+        Whether to mask 0 values. The default is True.
+    confidence_threshold : float, optional
+        Mask samples with lower confidence. The default is None.
+    filt_order : int, optional
+        Order of the Butterworth filter. The default is 3.
+    cutoff_freq : float, optional
+        Normalised cut-off frequency. If None, the data are not filtered.
+        The default is .01.
+    chunksize : int, optional
+        Number of rows to read at a time. The default is 200000.
+    overlap : int, optional
+        Filter context carried between blocks. The default is None (see
+        ``preproc.BlockFilter``).
+
+    Returns
+    -------
+    n : int
+        Number of samples written.
+
+    """
+    fname = op.join(data_dir, "", "pupil_positions.csv")
+    if eye_id == "left":
+        eye = 1
+    elif eye_id == "right":
+        eye = 0
+    elif eye_id == "best":
+        eye = _best_eye(fname, method, chunksize)
+    else:
+        raise ValueError('Eye must be "left", "right" or "best".')
+    keep = list(dict.fromkeys(fields + ["confidence"] + (cols or [])))
+    usecols = list(
+        dict.fromkeys(["pupil_timestamp", "eye_id", "method"] + keep)
+    )
+
+    stages = [_ChunkInterpolator(fields)]
+    if cutoff_freq is not None:
+        bf = BlockFilter(filt_order, cutoff_freq, overlap)
+        stages.append(_ChunkFilter(fields, bf))
+
+    if op.exists(out_fname):
+        os.remove(out_fname)
+    reject = ["low_confidence", "blink"] + (["zero"] if mask_zeros else [])
+    n = 0
+
+    def _write(frame):
+        nonlocal n
+        if frame is not None and len(frame):
+            _append(frame, out_fname, first=n == 0)
+            n += len(frame)
+
+    reader = pd.read_csv(
+        fname,
+        usecols=usecols,
+        index_col="pupil_timestamp",
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        chunk = chunk.loc[
+            _match_method(chunk.method, method) & (chunk.eye_id == eye), keep
+        ]
+        if chunk.empty:
+            continue
+        reasons = _artifact_reasons(
+            chunk.index.to_numpy(dtype="float"),
+            chunk[fields].to_numpy(dtype="float"),
+            chunk["confidence"].to_numpy(),
+            blinks,
+            confidence_threshold,
+            velocity_mads=None,
+        )
+        chunk.loc[_reject_mask(reasons, reject), fields] = float("nan")
+        for stage in stages:
+            chunk = stage.process(chunk)
+        _write(chunk)
+
+    # push whatever is still held back through the remaining stages
+    frame = None
+    for stage in stages:
+        out = [] if frame is None or frame.empty else [stage.process(frame)]
+        tail = stage.flush()
+        if tail is not None:
+            out.append(tail)
+        frame = pd.concat(out) if out else None
+    _write(frame)
+    print("Wrote {} samples to {}".format(n, out_fname))
+    return n
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pyplr.deconv
+============
+
+Deconvolution of overlapping event-related pupil responses.
+
+With short inter-stimulus intervals, the response to one stimulus has not
+ended before the next begins, so averaging extracted epochs mixes them.
+Here, the whole recording is instead modelled as the sum of one response
+kernel per condition, shifted to each event onset, plus a constant. The
+kernels are found with sparse least squares, optionally with ridge
+(Tikhonov) regularisation.
+
+The design matrix has one row per sample but only one nonzero per event per
+lag, so it is built directly in sparse form and never expanded. Samples that
+are missing (e.g., blinks) are simply left out of the fit rather than
+interpolated.
+
+Example
+-------
+>>> events = utils.load_annotations(data_dir)
+>>> kernels = deconvolve(samples, events, fields=['diameter_3d'],
+...                      window=(-1., 6.), by='label', alpha=1.)
+
+"""
+
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from scipy.sparse.linalg import lsqr
+
+from pyplr.preproc import _nearest
+
+
+def tent_basis(n_lags: int, n_basis: int) -> np.ndarray:
+    """Evenly spaced, overlapping triangular basis functions.
+
+    Each function peaks at one knot and falls linearly to zero at its
+    neighbours, so a weighted sum is a piecewise linear curve through the
+    knots. Using fewer basis functions than lags gives smoother kernels
+    with fewer parameters.
+
+    Parameters
+    ----------
+    n_lags : int
+        Length of the response window in samples.
+    n_basis : int
+        Number of basis functions (at least 2).
+
+    Returns
+    -------
+    basis : np.ndarray
+        (n_lags x n_basis) array.
+
+    """
+    if n_basis < 2 or n_basis > n_lags:
+        raise ValueError("n_basis must be between 2 and n_lags")
+    knots = np.linspace(0, n_lags - 1, n_basis)
+    width = knots[1] - knots[0]
+    lags = np.arange(n_lags)[:, None]
+    return np.clip(1 - np.abs(lags - knots) / width, 0, None)
+
+
+def design_matrix(
+    t: np.ndarray,
+    onsets: np.ndarray,
+    codes: np.ndarray,
+    n_conditions: int,
+    lags: np.ndarray,
+    basis: np.ndarray = None,
+    intercept: bool = True,
+) -> sparse.csr_matrix:
+    """Sparse design matrix for overlapping responses.
+
+    Parameters
+    ----------
+    t : np.ndarray
+        Sorted sample timestamps.
+    onsets : np.ndarray
+        Event onset times, on the same clock as `t`.
+    codes : np.ndarray
+        Condition of each event, as integers in [0, `n_conditions`).
+    n_conditions : int
+        Number of conditions.
+    lags : np.ndarray
+        Evenly spaced times of the kernel relative to onset, in seconds.
+    basis : np.ndarray, optional
+        (len(lags) x n_basis) basis functions for each kernel. The default
+        is None (one parameter per lag, i.e., an FIR model).
+    intercept : bool, optional
+        Whether to add a constant column. The default is True.
+
+    Returns
+    -------
+    X : scipy.sparse.csr_matrix
+        (samples x parameters) design matrix. The parameters are ordered
+        by condition, then lag (or basis function), then the intercept.
+
+    """
+    n, n_lags = len(t), len(lags)
+    step = lags[1] - lags[0] if n_lags > 1 else np.inf
+    targets = (onsets[:, None] + lags).ravel()
+    rows = _nearest(targets, t, step / 2)
+    cols = (codes[:, None] * n_lags + np.arange(n_lags)).ravel()
+    keep = rows >= 0
+    X = sparse.csr_matrix(
+        (np.ones(keep.sum()), (rows[keep], cols[keep])),
+        shape=(n, n_conditions * n_lags),
+    )
+    if basis is not None:
+        X = X @ sparse.kron(
+            sparse.identity(n_conditions), sparse.csr_matrix(basis)
+        )
+    if intercept:
+        X = sparse.hstack([X, np.ones((n, 1))])
+    return sparse.csr_matrix(X)
+
+
+def solve(
+    X: sparse.spmatrix,
+    y: np.ndarray,
+    alpha: float = 0.0,
+    atol: float = 1e-8,
+    iter_lim: int = None,
+) -> np.ndarray:
+    """Sparse least squares with optional ridge penalty.
+
+    Minimises ``||y - Xb||^2 + alpha * ||b||^2`` for each column of `y`
+    with ``scipy.sparse.linalg.lsqr``. Rows where `y` is NaN are left out.
+
+    Parameters
+    ----------
+    X : scipy.sparse.spmatrix
+        (samples x parameters) design matrix.
+    y : np.ndarray
+        (samples,) or (samples x fields) data.
+    alpha : float, optional
+        Ridge penalty. The default is 0.0 (ordinary least squares).
+    atol : float, optional
+        Stopping tolerance passed to ``lsqr`` (also used as `btol`). The
+        default is 1e-8.
+    iter_lim : int, optional
+        Maximum number of iterations. The default is None (``lsqr``'s
+        default).
+
+    Returns
+    -------
+    beta : np.ndarray
+        (parameters,) or (parameters x fields) estimates.
+
+    """
+    y = np.asarray(y, dtype="float")
+    Y = y.reshape(len(y), -1)
+    X = sparse.csr_matrix(X)
+    beta = np.empty((X.shape[1], Y.shape[1]))
+    damp = np.sqrt(alpha)
+    for i in range(Y.shape[1]):
+        ok = ~np.isnan(Y[:, i])
+        beta[:, i] = lsqr(
+            X[ok],
+            Y[ok, i],
+            damp=damp,
+            atol=atol,
+            btol=atol,
+            iter_lim=iter_lim,
+        )[0]
+    return beta.reshape((X.shape[1],) + y.shape[1:])
+
+
+def deconvolve(
+    samples: pd.DataFrame,
+    events: pd.DataFrame,
+    fields: List[str] = ["diameter"],
+    window: Tuple[float, float] = (-1.0, 6.0),
+    by: str = "label",
+    sample_rate: float = None,
+    n_basis: int = None,
+    alpha: float = 0.0,
+    intercept: bool = True,
+) -> pd.DataFrame:
+    """Estimate a response kernel for each condition from a whole recording.
+
+    Parameters
+    ----------
+    samples : pandas.DataFrame
+        Samples indexed by timestamp (e.g., from ``utils.load_pupil(...)``).
+        Missing samples (NaN) are left out of the fit.
+    events : pandas.DataFrame
+        Events indexed by onset time (e.g., from
+        ``utils.load_annotations(...)``).
+    fields : list, optional
+        Columns of `samples` to deconvolve. The default is ['diameter'].
+    window : tuple, optional
+        Start and stop of each kernel relative to onset, in seconds. The
+        default is (-1., 6.).
+    by : str, optional
+        Column of `events` giving the condition. If None, all events are
+        one condition. The default is 'label'.
+    sample_rate : float, optional
+        Sampling rate of the kernels. The default is None (the median rate
+        of `samples`).
+    n_basis : int, optional
+        Number of tent basis functions per kernel (see ``tent_basis(...)``).
+        The default is None (one parameter per sample, i.e., FIR).
+    alpha : float, optional
+        Ridge penalty. The default is 0.0.
+    intercept : bool, optional
+        Whether to model a constant baseline. The default is True.
+
+    Returns
+    -------
+    kernels : pandas.DataFrame
+        Response kernels, indexed by condition and time relative to onset.
+
+    """
+    t = samples.index.to_numpy(dtype="float")
+    if sample_rate is None:
+        sample_rate = 1.0 / np.median(np.diff(t))
+    lags = np.arange(
+        np.ceil(window[0] * sample_rate), np.floor(window[1] * sample_rate)
+    )
+    lags = lags / sample_rate
+    if by is None:
+        codes = np.zeros(len(events), dtype="int")
+        conditions = pd.Index(["all"], name="condition")
+    else:
+        codes, conditions = pd.factorize(events[by], sort=True)
+        conditions = pd.Index(conditions, name=by)
+    basis = None if n_basis is None else tent_basis(len(lags), n_basis)
+    X = design_matrix(
+        t,
+        events.index.to_numpy(dtype="float"),
+        codes,
+        len(conditions),
+        lags,
+        basis,
+        intercept,
+    )
+    print(
+        "Deconvolving {} events in {} conditions from {} samples".format(
+            len(events), len(conditions), len(t)
+        )
+    )
+    beta = solve(X, samples[fields].to_numpy(), alpha)
+    beta = beta[: X.shape[1] - intercept].reshape(
+        len(conditions), -1, len(fields)
+    )
+    if basis is not None:
+        beta = np.einsum("lb,cbf->clf", basis, beta)
+    index = pd.MultiIndex.from_product(
+        [conditions, np.round(lags, 6)], names=[conditions.name, "onset"]
+    )
+    return pd.DataFrame(
+        beta.reshape(-1, len(fields)), index=index, columns=fields
+    )
@@ -0,0 +1,734 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pyplr.epochs
+============
+
+An array-backed container for extracted epochs.
+
+``EpochSet`` keeps the data from ``utils.extract(...)`` as one contiguous
+(events x time x channels) array alongside a table of event metadata, so
+that baseline correction, trial rejection, selection and condition averages
+are plain NumPy operations rather than ``groupby`` calls on a MultiIndex
+DataFrame.
+
+``RaggedEpochs`` holds epochs defined in seconds rather than samples, which
+may differ in length, and resamples them all to a common ``EpochSet`` grid.
+
+Example
+-------
+>>> epochs = EpochSet.from_samples(
+...     samples, events, offset=-600, duration=7600,
+...     fields=['diameter_3d', 'interpolated'],
+...     borrow_attributes=['color'], sample_rate=120)
+>>> epochs = epochs.percent_change(-5., 0.).reject(interp_thresh=20)
+>>> means, sems = epochs.mean(by='color'), epochs.sem(by='color')
+
+"""
+
+from typing import List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import scipy.signal as signal
+
+from pyplr import utils
+from pyplr.preproc import _float_dtype, _poly_filter, _rate_ratio
+
+
+def _group_codes(events: pd.DataFrame, by: Union[str, List[str]] = None):
+    """Integer group codes for each event and a table of the groups."""
+    if by is None:
+        return np.zeros(len(events), dtype="int"), pd.DataFrame(index=[0])
+    by = [by] if isinstance(by, str) else list(by)
+    grouped = events.groupby(by, sort=True, dropna=False)
+    codes = grouped.ngroup().to_numpy()
+    groups = grouped.size().index.to_frame(index=False)
+    return codes, groups
+
+
+class EpochSet:
+    """Epochs of pupil data with event metadata."""
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        events: pd.DataFrame,
+        channels: List[str],
+        times: np.ndarray = None,
+    ) -> None:
+        """Wrap an existing (events x time x channels) array.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            (events x time x channels) array.
+        events : pandas.DataFrame
+            One row of metadata per event (e.g., condition labels).
+        channels : list of str
+            Name of each channel (e.g., ['diameter', 'interpolated']).
+        times : np.ndarray, optional
+            Time of each sample relative to event onset. The default is None
+            (sample number).
+
+        Returns
+        -------
+        None.
+
+        """
+        if data.ndim != 3:
+            raise ValueError("data must be (events x time x channels)")
+        if len(events) != data.shape[0]:
+            raise ValueError("Need one row of events for each epoch")
+        if len(channels) != data.shape[2]:
+            raise ValueError("Need one name for each channel")
+        self.data = data
+        self.events = events.reset_index(drop=True)
+        self.channels = list(channels)
+        self.times = (
+            np.arange(data.shape[1]) if times is None else np.asarray(times)
+        )
+
+    @classmethod
+    def from_samples(
+        cls,
+        samples: pd.DataFrame,
+        events: pd.DataFrame,
+        offset: int = 0,
+        duration: int = 0,
+        fields: List[str] = ["diameter"],
+        borrow_attributes: List[str] = [],
+        sample_rate: float = None,
+    ) -> "EpochSet":
+        """Extract epochs straight into an array.
+
+        Parameters
+        ----------
+        samples : pandas.DataFrame
+            The samples. Index must be timestamp.
+        events : pandas.DataFrame
+            The events. Index must be timestamp.
+        offset : int, optional
+            Number of samples to offset from event onset. The default is 0.
+        duration : int, optional
+            Number of samples per epoch. The default is 0.
+        fields : list, optional
+            Columns of `samples` to extract. The default is ['diameter'].
+        borrow_attributes : list, optional
+            Columns of `events` to keep as metadata. The default is [].
+        sample_rate : float, optional
+            If given, times are in seconds from onset rather than samples.
+            The default is None.
+
+        Returns
+        -------
+        epochs : EpochSet
+
+        """
+        data = utils.extract(
+            samples, events, offset, duration, fields=fields, as_array=True
+        )
+        data = data.astype(np.result_type(data.dtype, np.float32))
+        meta = pd.DataFrame({"onset": events.index.to_numpy()})
+        for ba in borrow_attributes:
+            meta[ba] = events[ba].to_numpy() if ba in events else np.nan
+        times = np.arange(offset, offset + duration)
+        if sample_rate is not None:
+            times = times / sample_rate
+        return cls(data, meta, fields, times)
+
+    @classmethod
+    def from_ranges(
+        cls,
+        ranges: pd.DataFrame,
+        fields: List[str],
+        attributes: List[str] = [],
+    ) -> "EpochSet":
+        """Convert the output of ``utils.extract(...)``.
+
+        Parameters
+        ----------
+        ranges : pandas.DataFrame
+            Ranges with an ('event', 'onset') MultiIndex.
+        fields : list
+            Columns to use as channels.
+        attributes : list, optional
+            Columns that are constant within each event to keep as metadata
+            (e.g., those from `borrow_attributes`). The default is [].
+
+        Returns
+        -------
+        epochs : EpochSet
+
+        """
+        if not isinstance(ranges.index, pd.MultiIndex):
+            raise ValueError("Index of ranges must be pd.MultiIndex")
+        n_events = ranges.index.get_level_values("event").nunique()
+        data = ranges[fields].to_numpy(dtype=_float_dtype(ranges, fields))
+        data = data.reshape(n_events, -1, len(fields))
+        first = ranges.groupby(level="event", sort=False).head(1)
+        meta = first[attributes].reset_index(drop=True)
+        times = ranges.index.get_level_values("onset")[: data.shape[1]]
+        return cls(data, meta, fields, times.to_numpy())
+
+    @classmethod
+    def concat(cls, epoch_sets: List["EpochSet"]) -> "EpochSet":
+        """Join epochs with the same channels and times (e.g., from several
+        subjects, after ``.resample_poly(...)`` to a common rate).
+
+        """
+        first = epoch_sets[0]
+        for es in epoch_sets[1:]:
+            if es.channels != first.channels:
+                raise ValueError("Channels must be the same")
+            if len(es.times) != len(first.times) or not np.allclose(
+                es.times, first.times
+            ):
+                raise ValueError("Times must be the same")
+        return cls(
+            np.concatenate([es.data for es in epoch_sets]),
+            pd.concat([es.events for es in epoch_sets], ignore_index=True),
+            first.channels,
+            first.times,
+        )
+
+    def __len__(self) -> int:
+        return self.data.shape[0]
+
+    def __getitem__(self, key) -> "EpochSet":
+        """Select epochs by integer, slice, or boolean / integer array."""
+        if isinstance(key, (int, np.integer)):
+            key = [key]
+        idx = np.arange(len(self))[key]
+        return EpochSet(
+            self.data[idx], self.events.iloc[idx], self.channels, self.times
+        )
+
+    def __repr__(self) -> str:
+        return "EpochSet({} events x {} samples x {} channels)".format(
+            *self.data.shape
+        )
+
+    def channel(self, name: str) -> np.ndarray:
+        """Return an (events x time) view of a single channel."""
+        return self.data[:, :, self.channels.index(name)]
+
+    def _window(self, start: float, stop: float) -> slice:
+        """Samples with `start` <= time < `stop`."""
+        lo, hi = np.searchsorted(self.times, [start, stop], "left")
+        if lo == hi:
+            raise ValueError("No samples in window")
+        return slice(lo, hi)
+
+    def baselines(
+        self, start: float, stop: float, channels: List[str] = None
+    ) -> np.ndarray:
+        """Mean of each epoch and channel within a time window.
+
+        Parameters
+        ----------
+        start, stop : float
+            Window, in the units of ``.times``, e.g., (-5, 0) seconds.
+        channels : list, optional
+            Channels to use. The default is None (all).
+
+        Returns
+        -------
+        baselines : np.ndarray
+            (events x channels) array.
+
+        """
+        ch = self._channel_idxs(channels)
+        win = self.data[:, self._window(start, stop)][:, :, ch]
+        return np.nanmean(win, axis=1)
+
+    def _channel_idxs(self, channels: List[str] = None) -> List[int]:
+        if channels is None:
+            return list(range(len(self.channels)))
+        return [self.channels.index(c) for c in channels]
+
+    def baseline_correct(
+        self, start: float, stop: float, channels: List[str] = None
+    ) -> "EpochSet":
+        """Subtract the mean of a baseline window from each epoch.
+
+        Parameters
+        ----------
+        start, stop : float
+            Baseline window, in the units of ``.times``.
+        channels : list, optional
+            Channels to correct. The default is None (all channels).
+
+        Returns
+        -------
+        epochs : EpochSet
+            New EpochSet with corrected data.
+
+        """
+        ch = self._channel_idxs(channels)
+        data = np.array(self.data)
+        data[:, :, ch] -= self.baselines(start, stop, channels)[:, None, :]
+        return EpochSet(data, self.events, self.channels, self.times)
+
+    def percent_change(
+        self, start: float, stop: float, channels: List[str] = None
+    ) -> "EpochSet":
+        """Add channels expressing data as percent change from baseline.
+
+        As with ``preproc.percent_signal_change(...)``, new channels are
+        named with a '_pc' suffix.
+
+        Parameters
+        ----------
+        start, stop : float
+            Baseline window, in the units of ``.times``.
+        channels : list, optional
+            Channels to convert. The default is None (all channels).
+
+        Returns
+        -------
+        epochs : EpochSet
+            New EpochSet with the extra channels.
+
+        """
+        ch = self._channel_idxs(channels)
+        base = self.baselines(start, stop, channels)[:, None, :]
+        pc = (self.data[:, :, ch] / base - 1) * 100
+        return EpochSet(
+            np.concatenate([self.data, pc], axis=2),
+            self.events,
+            self.channels + [self.channels[c] + "_pc" for c in ch],
+            self.times,
+        )
+
+    def reject(
+        self,
+        interp_thresh: float = 20,
+        drop: bool = False,
+        channel: str = "interpolated",
+    ) -> "EpochSet":
+        """Mark or drop epochs with too much interpolated data.
+
+        Parameters
+        ----------
+        interp_thresh : float, optional
+            Percentage of interpolated data permitted before epochs are
+            marked for rejection / dropped. The default is 20.
+        drop : bool, optional
+            Whether to drop the epochs. The default is False.
+        channel : str, optional
+            Channel flagging interpolated samples. The default is
+            'interpolated'.
+
+        Returns
+        -------
+        epochs : EpochSet
+            With 'pct_interp' and 'reject' event columns (drop = False), or
+            without the rejected epochs (drop = True).
+
+        """
+        pct = np.nanmean(self.channel(channel), axis=1) * 100
+        bad = pct > interp_thresh
+        if drop:
+            print("{} trials were dropped".format(bad.sum()))
+            return self[~bad]
+        print("{} trials were marked for rejection".format(bad.sum()))
+        events = self.events.assign(pct_interp=pct, reject=bad.astype("int"))
+        return EpochSet(self.data, events, self.channels, self.times)
+
+    def select(self, query: str = None, **criteria) -> "EpochSet":
+        """Select epochs by their metadata.
+
+        Parameters
+        ----------
+        query : str, optional
+            Passed to ``pandas.DataFrame.query`` on ``.events``.
+        **criteria : dict
+            Column=value pairs (or column=list of values) to match.
+
+        Returns
+        -------
+        epochs : EpochSet
+
+        """
+        keep = np.ones(len(self), dtype="bool")
+        if query is not None:
+            keep &= self.events.eval(query).to_numpy(dtype="bool")
+        for col, val in criteria.items():
+            vals = val if isinstance(val, (list, tuple, set)) else [val]
+            keep &= self.events[col].isin(vals).to_numpy()
+        return self[keep]
+
+    def _groups(self, by: Union[str, List[str]] = None):
+        """Integer group codes for each epoch and a table of the groups."""
+        return _group_codes(self.events, by)
+
+    def _group_stats(self, by):
+        codes, groups = self._groups(by)
+        n_groups = len(groups)
+        valid = ~np.isnan(self.data)
+        x = np.where(valid, self.data, 0.0)
+        # sort epochs by group so each sum is one reduceat over axis 0
+        order = np.argsort(codes, kind="stable")
+        starts = np.searchsorted(codes[order], np.arange(n_groups))
+        x, valid = x[order], valid[order]
+        n = np.add.reduceat(valid, starts, axis=0, dtype="float")
+        s = np.add.reduceat(x, starts, axis=0)
+        ss = np.add.reduceat(x * x, starts, axis=0)
+        groups["n"] = np.bincount(codes, minlength=n_groups)
+        return groups, n, s, ss
+
+    def mean(self, by: Union[str, List[str]] = None) -> "EpochSet":
+        """NaN-aware mean of the epochs in each condition.
+
+        Parameters
+        ----------
+        by : str or list, optional
+            Event column(s) defining conditions. The default is None (grand
+            average).
+
+        Returns
+        -------
+        means : EpochSet
+            One epoch per condition. ``.events`` holds the condition keys
+            and the number of epochs, 'n'.
+
+        """
+        groups, n, s, _ = self._group_stats(by)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return EpochSet(s / n, groups, self.channels, self.times)
+
+    def sem(self, by: Union[str, List[str]] = None) -> "EpochSet":
+        """NaN-aware standard error of the mean in each condition.
+
+        Parameters
+        ----------
+        by : str or list, optional
+            Event column(s) defining conditions. The default is None.
+
+        Returns
+        -------
+        sems : EpochSet
+            As for ``.mean(...)``.
+
+        """
+        groups, n, s, ss = self._group_stats(by)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var = (ss - s * s / n) / (n - 1)
+            sem = np.sqrt(np.clip(var, 0, None) / n)
+        return EpochSet(sem, groups, self.channels, self.times)
+
+    def resample_poly(
+        self, new_rate: float, old_rate: float = None
+    ) -> "EpochSet":
+        """Resample all epochs to a new rate with a polyphase filter.
+
+        The whole (events x time x channels) array is filtered in one call
+        to ``scipy.signal.resample_poly`` with an anti-aliasing filter that
+        is designed once per rate ratio and cached. Epochs are extended by
+        linear extrapolation to limit edge effects. NaN samples are filled
+        by linear interpolation before filtering, and output samples whose
+        nearest input sample was NaN are set back to NaN.
+
+        Parameters
+        ----------
+        new_rate : float
+            New sampling rate in Hz.
+        old_rate : float, optional
+            Current sampling rate in Hz. The default is None (worked out
+            from ``.times``, which must then be in seconds).
+
+        Returns
+        -------
+        epochs : EpochSet
+            Resampled epochs with ``.times`` in seconds.
+
+        """
+        step = np.median(np.diff(self.times))
+        if old_rate is None:
+            old_rate = 1.0 / step
+        # times may be in seconds or in samples
+        t0 = self.times[0]
+        if not np.isclose(step, 1.0 / old_rate):
+            t0 = t0 / old_rate
+        up, down = _rate_ratio(old_rate, new_rate)
+        data = self.data
+        nans = np.isnan(data)
+        if nans.any():
+            data = data.copy()
+            x = np.arange(data.shape[1])
+            for e, c in zip(*np.nonzero(nans.any(axis=1))):
+                bad = nans[e, :, c]
+                if not bad.all():
+                    data[e, bad, c] = np.interp(
+                        x[bad], x[~bad], data[e, ~bad, c]
+                    )
+        out = signal.resample_poly(
+            data,
+            up,
+            down,
+            axis=1,
+            window=_poly_filter(up, down),
+            padtype="line",
+        )
+        n_new = out.shape[1]
+        new_times = t0 + np.arange(n_new) / new_rate
+        if nans.any():
+            nearest = np.clip(
+                np.rint(np.arange(n_new) * down / up).astype("int"),
+                0,
+                data.shape[1] - 1,
+            )
+            out[nans[:, nearest]] = np.nan
+        return EpochSet(
+            out.astype(self.data.dtype, copy=False),
+            self.events,
+            self.channels,
+            new_times,
+        )
+
+    def to_frame(self) -> pd.DataFrame:
+        """Return the epochs as a long DataFrame with an ('event', 'onset')
+        MultiIndex, as from ``utils.extract(...)``, plus the metadata.
+
+        """
+        n_events, n_times, _ = self.data.shape
+        df = pd.DataFrame(
+            self.data.reshape(n_events * n_times, -1),
+            columns=self.channels,
+            index=pd.MultiIndex.from_product(
+                [range(n_events), range(n_times)], names=["event", "onset"]
+            ),
+        )
+        df["time"] = np.tile(self.times, n_events)
+        for col in self.events:
+            df[col] = np.repeat(self.events[col].to_numpy(), n_times)
+        return df
+
+
+class RaggedEpochs:
+    """Epochs defined in seconds, each holding however many samples fell
+    within its window.
+
+    The samples of all epochs are stored end to end in one contiguous
+    (samples x channels) array, with ``offsets`` marking where each epoch
+    starts, so nothing is padded and no sample count is imposed.
+
+    Example
+    -------
+    >>> ragged = RaggedEpochs.from_samples(
+    ...     samples, events, start=-1., stop='duration',
+    ...     fields=['diameter_3d'], borrow_attributes=['color'])
+    >>> epochs = ragged.resample(sample_rate=120)
+
+    """
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        times: np.ndarray,
+        offsets: np.ndarray,
+        events: pd.DataFrame,
+        channels: List[str],
+    ) -> None:
+        """Wrap existing flat arrays.
+
+        Parameters
+        ----------
+        values : np.ndarray
+            (samples x channels) data of all epochs, end to end.
+        times : np.ndarray
+            Time of each sample relative to its event onset.
+        offsets : np.ndarray
+            (events + 1) positions in `values` at which each epoch starts.
+        events : pandas.DataFrame
+            One row of metadata per event.
+        channels : list of str
+            Name of each channel.
+
+        Returns
+        -------
+        None.
+
+        """
+        if len(offsets) != len(events) + 1 or offsets[-1] != len(values):
+            raise ValueError("offsets do not match values and events")
+        if len(times) != len(values):
+            raise ValueError("Need one time for each sample")
+        self.values = values
+        self.times = times
+        self.offsets = offsets
+        self.events = events.reset_index(drop=True)
+        self.channels = list(channels)
+
+    @classmethod
+    def from_samples(
+        cls,
+        samples: pd.DataFrame,
+        events: pd.DataFrame,
+        start: Union[float, str] = 0.0,
+        stop: Union[float, str] = 1.0,
+        fields: List[str] = ["diameter"],
+        borrow_attributes: List[str] = [],
+    ) -> "RaggedEpochs":
+        """Extract windows of time around each event.
+
+        Parameters
+        ----------
+        samples : pandas.DataFrame
+            The samples. Index must be timestamp.
+        events : pandas.DataFrame
+            The events. Index must be timestamp.
+        start : float or str, optional
+            Start of each window in seconds relative to event onset, or the
+            name of a column of `events` giving it per event. The default is
+            0.0.
+        stop : float or str, optional
+            End of each window (exclusive), as for `start`. The default is
+            1.0.
+        fields : list, optional
+            Columns of `samples` to extract. The default is ['diameter'].
+        borrow_attributes : list, optional
+            Columns of `events` to keep as metadata. The default is [].
+
+        Returns
+        -------
+        ragged : RaggedEpochs
+
+        """
+        if len(samples) == 0 or len(events) == 0:
+            raise ValueError("Need at least one sample and one event")
+        onsets = events.index.to_numpy(dtype="float")
+        meta = pd.DataFrame({"onset": onsets})
+        for name, bound in (("start", start), ("stop", stop)):
+            meta[name] = (
+                events[bound].to_numpy(dtype="float")
+                if isinstance(bound, str)
+                else np.full(len(events), bound, dtype="float")
+            )
+        if (meta["stop"] <= meta["start"]).any():
+            raise ValueError("Windows must end after they start")
+        for ba in borrow_attributes:
+            meta[ba] = events[ba].to_numpy() if ba in events else np.nan
+
+        index = samples.index.to_numpy(dtype="float")
+        flat, offsets = utils._time_window_idxs(
+            index, onsets + meta["start"], onsets + meta["stop"]
+        )
+        values = samples[fields].to_numpy()[flat]
+        times = index[flat] - np.repeat(onsets, np.diff(offsets))
+        print("Extracted ranges for {} events".format(len(events)))
+        return cls(values, times, offsets, meta, fields)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of samples in each epoch."""
+        return np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def __repr__(self) -> str:
+        return "RaggedEpochs({} events, {} samples x {} channels)".format(
+            len(self), *self.values.shape
+        )
+
+    def epoch(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Times and (samples x channels) values of epoch `i` (views)."""
+        a, b = self.offsets[i], self.offsets[i + 1]
+        return self.times[a:b], self.values[a:b]
+
+    def resample(
+        self,
+        sample_rate: float,
+        start: float = None,
+        stop: float = None,
+        max_gap: float = None,
+    ) -> EpochSet:
+        """Linearly interpolate every epoch onto one time grid at once.
+
+        All epochs are laid end to end on a single time axis, so one call
+        to ``np.searchsorted`` finds the samples either side of every new
+        timepoint. New timepoints outside an epoch's samples are NaN.
+
+        Parameters
+        ----------
+        sample_rate : float
+            Sampling rate of the grid in Hz.
+        start : float, optional
+            First time of the grid, relative to event onset. The default is
+            None (the earliest window start).
+        stop : float, optional
+            End of the grid (exclusive). The default is None (the latest
+            window stop).
+        max_gap : float, optional
+            New timepoints between two samples further apart than this many
+            seconds are set to NaN. The default is None.
+
+        Returns
+        -------
+        epochs : EpochSet
+            Events x time x channels, with ``.times`` in seconds.
+
+        """
+        start = self.events["start"].min() if start is None else start
+        stop = self.events["stop"].max() if stop is None else stop
+        n_events = len(self)
+        n_new = int(np.ceil((stop - start) * sample_rate))
+        grid = start + np.arange(n_new) / sample_rate
+        data = np.full(
+            (n_events, n_new, len(self.channels)),
+            np.nan,
+            dtype=np.result_type(self.values.dtype, np.float32),
+        )
+        ok = self.lengths >= 2
+        if ok.any() and n_new:
+            # shift each epoch along by `span` so they do not overlap
+            lo = min(self.times.min(), grid[0])
+            span = max(self.times.max(), grid[-1]) - lo + 1.0
+            shift = np.arange(n_events)[:, None] * span
+            keys = self.times - lo + np.repeat(shift[:, 0], self.lengths)
+            j = np.searchsorted(keys, grid - lo + shift, "right") - 1
+
+            # interpolate between samples j and j + 1 of the same epoch
+            first = self.offsets[:-1, None]
+            last = np.maximum(self.offsets[1:, None] - 1, first)
+            j = np.clip(j, first, np.maximum(last - 1, first))
+            j = np.minimum(j, len(self.times) - 2)
+            ta, tb = self.times[j], self.times[j + 1]
+            dt = tb - ta
+            w = np.divide(grid - ta, dt, out=np.zeros_like(dt), where=dt > 0)
+            ya, yb = self.values[j], self.values[j + 1]
+            out = ya + w[..., None] * (yb - ya)
+
+            t_first = self.times[np.minimum(first, len(self.times) - 1)]
+            t_last = self.times[np.minimum(last, len(self.times) - 1)]
+            outside = (grid < t_first) | (grid > t_last) | ~ok[:, None]
+            if max_gap is not None:
+                outside |= dt > max_gap
+            out[outside] = np.nan
+            data[...] = out
+        return EpochSet(data, self.events, self.channels, grid)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Return the epochs as a long DataFrame with an ('event', 'onset')
+        MultiIndex, where 'onset' counts samples from the window start, and
+        a 'time' column relative to event onset.
+
+        """
+        lengths = self.lengths
+        event = np.repeat(np.arange(len(self)), lengths)
+        onset = np.arange(len(self.times)) - np.repeat(
+            self.offsets[:-1], lengths
+        )
+        df = pd.DataFrame(
+            self.values,
+            columns=self.channels,
+            index=pd.MultiIndex.from_arrays(
+                [event, onset], names=["event", "onset"]
+            ),
+        )
+        df["time"] = self.times
+        for col in self.events:
+            df[col] = np.repeat(self.events[col].to_numpy(), lengths)
+        return df
@@ -6,13 +6,161 @@ pyplr.graphing
 
 Functions to help with plotting.
 
+Long recordings have far more samples than a figure has pixels, so traces
+can be reduced with ``downsample(...)`` before plotting. Both methods keep
+the peaks and troughs that would be visible at full resolution, and gaps
+(NaN runs, e.g., blinks) still break the line.
+
 @author: jtm
 """
 
+from typing import List, Tuple, Union
+
+import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 
+from pyplr import kernels
+
+DOWNSAMPLE_METHODS = ("minmax", "lttb")
+
+
+def minmax_idxs(y: np.ndarray, n_out: int) -> np.ndarray:
+    """Positions of the minimum and maximum of `y` in each of `n_out` / 2
+    equal buckets (the envelope of the trace).
+
+    Parameters
+    ----------
+    y : np.ndarray
+        1-D data. NaNs are ignored.
+    n_out : int
+        Number of points to keep.
+
+    Returns
+    -------
+    idxs : np.ndarray
+        Sorted positions in `y`.
+
+    """
+    n = len(y)
+    n_buckets = max(n_out // 2, 1)
+    if n <= n_out:
+        return np.arange(n)
+    size = -(-n // n_buckets)
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(n_buckets, size)
+    empty = np.isnan(padded)
+    lo = np.where(empty, np.inf, padded).argmin(axis=1)
+    hi = np.where(empty, -np.inf, padded).argmax(axis=1)
+    offsets = np.arange(n_buckets) * size
+    idxs = np.r_[offsets + lo, offsets + hi]
+    idxs = idxs[np.tile(~empty.all(axis=1), 2)]
+    return np.unique(idxs[idxs < n])
+
+
+def lttb_idxs(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Positions of the points kept by Largest-Triangle-Three-Buckets.
+
+    The first and last points are kept. The rest are split into `n_out` - 2
+    buckets, and from each the point forming the largest triangle with the
+    previously kept point and the mean of the next bucket is kept
+    (Steinarsson, 2013).
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Sorted 1-D coordinates (e.g., timestamps).
+    y : np.ndarray
+        1-D data. NaNs are ignored.
+    n_out : int
+        Number of points to keep (at least 3).
 
-def pupil_preprocessing_figure(nrows, subject, **kwargs):
+    Returns
+    -------
+    idxs : np.ndarray
+        Sorted positions in `y`.
+
+    """
+    ok = np.flatnonzero(~np.isnan(y))
+    n = len(ok)
+    if n <= n_out or n_out < 3:
+        return ok
+    x, y = np.asarray(x, dtype="float")[ok], np.asarray(y, dtype="float")[ok]
+    edges = np.linspace(1, n - 1, n_out - 1).astype("int")
+    # mean of each bucket, plus the last point as the final "next bucket"
+    mean_x = np.r_[np.add.reduceat(x[:-1], edges[:-1]), x[-1]]
+    mean_y = np.r_[np.add.reduceat(y[:-1], edges[:-1]), y[-1]]
+    counts = np.r_[np.diff(edges), 1]
+    mean_x, mean_y = mean_x / counts, mean_y / counts
+    out = np.empty(n_out, dtype="int")
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for b in range(n_out - 2):
+        lo, hi = edges[b], edges[b + 1]
+        cx, cy = mean_x[b + 1], mean_y[b + 1]
+        area = np.abs(
+            (x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a])
+        )
+        a = lo + area.argmax()
+        out[b + 1] = a
+    return ok[out]
+
+
+def downsample(
+    data: Union[pd.Series, pd.DataFrame],
+    n_out: int = 2000,
+    method: str = "minmax",
+) -> Union[pd.Series, pd.DataFrame]:
+    """Reduce traces to about `n_out` points per column for plotting.
+
+    The rows kept for each column are combined, and the first sample of
+    every run of NaNs is kept too, so that gaps still show.
+
+    Parameters
+    ----------
+    data : pandas.Series or pandas.DataFrame
+        Data indexed by a sorted, numeric index (e.g., timestamps).
+    n_out : int, optional
+        Points to keep per column, about the width of the plot in pixels.
+        The default is 2000.
+    method : str, optional
+        'minmax' keeps the envelope of each bucket and is best for
+        spotting artefacts. 'lttb' keeps the shape of the trace with fewer
+        points. The default is 'minmax'.
+
+    Returns
+    -------
+    data : pandas.Series or pandas.DataFrame
+        The kept rows of `data`.
+
+    """
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(
+            "method must be one of {}".format(DOWNSAMPLE_METHODS)
+        )
+    if len(data) <= n_out:
+        return data
+    values = data.to_numpy(dtype="float").reshape(len(data), -1)
+    x = data.index.to_numpy(dtype="float")
+    keep = [np.array([0, len(data) - 1])]
+    for y in values.T:
+        if method == "minmax":
+            keep.append(minmax_idxs(y, n_out))
+        else:
+            keep.append(lttb_idxs(x, y, n_out))
+        keep.append(kernels.runs(np.isnan(y))[0])
+    return data.iloc[np.unique(np.concatenate(keep))]
+
+
+def pupil_preprocessing_figure(
+    nrows: int,
+    subject: str,
+    stages: List[Tuple[str, pd.DataFrame]] = None,
+    n_out: int = 2000,
+    method: str = "minmax",
+    **kwargs
+):
     """Set up a figure to show the stages of pupil data processing.
 
     Parameters
@@ -21,6 +169,14 @@ def pupil_preprocessing_figure(nrows, subject, **kwargs):
         Number of rows in the figure.
     subject : str
         The subject identifier (used for the title of the plot).
+    stages : list, optional
+        (title, samples) for each row. The samples are downsampled (see
+        ``downsample(...)``) before plotting, so they may be full length
+        or already downsampled. The default is None (empty axes).
+    n_out : int, optional
+        Points to plot per column. The default is 2000.
+    method : str, optional
+        Downsampling method. The default is 'minmax'.
     **kwargs : dict
         Subplot kwargs.
 
@@ -37,6 +193,11 @@ def pupil_preprocessing_figure(nrows, subject, **kwargs):
         nrows=nrows, ncols=1, sharex=True, figsize=(14, 14), **kwargs
     )
 
+    for ax, (title, samples) in zip(axs, stages or []):
+        downsample(samples, n_out, method).plot(
+            title=title, ax=ax, legend=False
+        )
+
     for ax in axs:
         ax.set_ylabel("Pupil diameter")
         ax.set_xlabel("Pupil timestamp")
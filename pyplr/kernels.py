@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pyplr.kernels
+=============
+
+Low-level kernels behind the hot loops in ``pyplr.preproc`` and
+``pyplr.utils``, with a switchable backend.
+
+The 'numpy' backend is the reference implementation and is always
+available. If `numba <https://numba.pydata.org/>`_ is installed, a 'numba'
+backend with JIT-compiled loops is also available. The two give identical
+results: integer outputs match exactly and floating-point outputs are
+computed with the same operations in the same order.
+
+The backend can be chosen with ``set_backend(...)`` or with the
+``PYPLR_BACKEND`` environment variable. An unavailable backend named in
+the environment falls back to 'numpy' with a warning.
+
+Example
+-------
+>>> from pyplr import kernels
+>>> kernels.available_backends()
+('numpy', 'numba')
+>>> kernels.set_backend('numba')
+
+"""
+
+import os
+import warnings
+from typing import Tuple
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# reference implementations
+
+
+def _runs_numpy(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    edges = np.diff(np.r_[0, mask.astype("int8"), 0])
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _interval_sweep_numpy(
+    t: np.ndarray, lo: np.ndarray, hi: np.ndarray
+) -> np.ndarray:
+    n = len(t)
+    a = np.searchsorted(t, lo, side="left")
+    b = np.searchsorted(t, hi, side="right")
+    keep = a < b
+    edges = np.bincount(a[keep], minlength=n + 1) - np.bincount(
+        b[keep], minlength=n + 1
+    )
+    return np.cumsum(edges[:n]) > 0
+
+
+def _search_rows_numpy(
+    keys: np.ndarray, queries: np.ndarray, span: float
+) -> np.ndarray:
+    n_rows, n = keys.shape
+    shift = np.arange(n_rows)[:, None] * span
+    pos = np.searchsorted(
+        (keys + shift).ravel(), (queries + shift).ravel(), "right"
+    )
+    return pos.reshape(queries.shape) - np.arange(n_rows)[:, None] * n
+
+
+def _gather_rows_numpy(
+    values: np.ndarray, idxs: np.ndarray, out: np.ndarray
+) -> np.ndarray:
+    n = len(values)
+    out[...] = values[np.clip(idxs, 0, n - 1)]
+    out[(idxs < 0) | (idxs >= n)] = np.nan
+    return out
+
+
+_KERNELS = {
+    "numpy": {
+        "runs": _runs_numpy,
+        "interval_sweep": _interval_sweep_numpy,
+        "search_rows": _search_rows_numpy,
+        "gather_rows": _gather_rows_numpy,
+    }
+}
+
+
+# compiled implementations
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _runs_numba(mask):
+        n = len(mask)
+        starts = np.empty(n // 2 + 2, dtype=np.int64)
+        ends = np.empty(n // 2 + 2, dtype=np.int64)
+        ks = ke = 0
+        prev = False
+        for i in range(n):
+            # branch-free: write every time, only advance on an edge
+            cur = mask[i]
+            starts[ks] = i
+            ends[ke] = i
+            ks += cur and not prev
+            ke += prev and not cur
+            prev = cur
+        if prev:
+            ends[ke] = n
+            ke += 1
+        return starts[:ks].copy(), ends[:ke].copy()
+
+    @numba.njit(cache=True)
+    def _interval_sweep_numba(t, lo, hi):
+        mask = np.zeros(len(t), dtype=np.bool_)
+        for k in range(len(lo)):
+            a = np.searchsorted(t, lo[k], side="left")
+            b = np.searchsorted(t, hi[k], side="right")
+            mask[a:b] = True
+        return mask
+
+    @numba.njit(cache=True)
+    def _search_rows_numba(keys, queries, span):
+        n_rows, n = keys.shape
+        pos = np.empty(queries.shape, dtype=np.int64)
+        for r in range(n_rows):
+            # compare the same shifted values as the reference, so that
+            # ties resolve identically
+            shift = r * span
+            a = 0
+            last = -np.inf
+            for j in range(queries.shape[1]):
+                q = queries[r, j] + shift
+                # queries are usually increasing, so search forward from
+                # the previous position by doubling, then bisect
+                lo = a if q >= last else 0
+                step = 1
+                hi = lo
+                while hi < n and keys[r, hi] + shift <= q:
+                    lo = hi + 1
+                    hi = lo + step
+                    step *= 2
+                hi = min(hi, n)
+                while lo < hi:
+                    m = (lo + hi) // 2
+                    if keys[r, m] + shift <= q:
+                        lo = m + 1
+                    else:
+                        hi = m
+                a = lo
+                last = q
+                pos[r, j] = a
+        return pos
+
+    @numba.njit(cache=True)
+    def _gather_rows_numba(values, idxs, out):
+        n, n_fields = values.shape
+        for e in range(idxs.shape[0]):
+            for d in range(idxs.shape[1]):
+                i = idxs[e, d]
+                if 0 <= i < n:
+                    for c in range(n_fields):
+                        out[e, d, c] = values[i, c]
+                else:
+                    for c in range(n_fields):
+                        out[e, d, c] = np.nan
+        return out
+
+    _KERNELS["numba"] = {
+        "runs": _runs_numba,
+        "interval_sweep": _interval_sweep_numba,
+        "search_rows": _search_rows_numba,
+        "gather_rows": _gather_rows_numba,
+    }
+
+
+_backend = "numpy"
+
+
+def available_backends() -> Tuple[str, ...]:
+    """Names of the backends that can be used here."""
+    return tuple(_KERNELS)
+
+
+def get_backend() -> str:
+    """Name of the backend in use."""
+    return _backend
+
+
+def set_backend(name: str) -> None:
+    """Choose the backend for all kernels.
+
+    Parameters
+    ----------
+    name : str
+        'numpy' or, if numba is installed, 'numba'.
+
+    Returns
+    -------
+    None.
+
+    """
+    global _backend
+    if name not in _KERNELS:
+        raise ValueError(
+            "Backend must be one of {}".format(available_backends())
+        )
+    _backend = name
+
+
+# public kernels
+
+
+def runs(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Start and (exclusive) end of each run of True in a 1-D mask.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Boolean array.
+
+    Returns
+    -------
+    starts, ends : np.ndarray
+        Integer positions of the runs.
+
+    """
+    mask = np.ascontiguousarray(mask, dtype="bool")
+    return _KERNELS[_backend]["runs"](mask)
+
+
+def interval_sweep(
+    t: np.ndarray, lo: np.ndarray, hi: np.ndarray
+) -> np.ndarray:
+    """Boolean mask of the sorted timestamps `t` within any of the
+    (inclusive, possibly overlapping) intervals [`lo`, `hi`].
+
+    """
+    # compare in a common floating-point type, so that interval bounds are
+    # not truncated to the type of `t`
+    t, lo, hi = np.asarray(t), np.asarray(lo), np.asarray(hi)
+    dtype = np.result_type(t, lo, hi, np.float32)
+    t = np.ascontiguousarray(t, dtype=dtype)
+    lo = np.ascontiguousarray(lo, dtype=dtype)
+    hi = np.ascontiguousarray(hi, dtype=dtype)
+    return _KERNELS[_backend]["interval_sweep"](t, lo, hi)
+
+
+def search_rows(
+    keys: np.ndarray, queries: np.ndarray, span: float
+) -> np.ndarray:
+    """Row-wise ``np.searchsorted(..., side='right')``.
+
+    Each row of `keys` must be sorted, and every key and query must lie in
+    [0, `span` - 1]. Rows are laid end to end by adding a multiple of
+    `span`, as in ``preproc.interp_epochs(...)``.
+
+    Returns
+    -------
+    pos : np.ndarray
+        For each query, the number of keys in its row that are <= it.
+
+    """
+    keys = np.ascontiguousarray(keys, dtype="float")
+    queries = np.ascontiguousarray(queries, dtype="float")
+    return _KERNELS[_backend]["search_rows"](keys, queries, float(span))
+
+
+def gather_rows(values: np.ndarray, idxs: np.ndarray) -> np.ndarray:
+    """Gather rows of a 2-D array into windows.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        (samples x fields) data.
+    idxs : np.ndarray
+        (windows x length) integer row positions. Positions outside of
+        `values` give NaN.
+
+    Returns
+    -------
+    out : np.ndarray
+        (windows x length x fields) array, floating point.
+
+    """
+    values = np.ascontiguousarray(values)
+    idxs = np.ascontiguousarray(idxs, dtype="int64")
+    dtype = np.result_type(values.dtype, np.float32)
+    out = np.empty(idxs.shape + values.shape[1:], dtype=dtype)
+    values = values.astype(dtype, copy=False)
+    return _KERNELS[_backend]["gather_rows"](values, idxs, out)
+
+
+try:
+    set_backend(os.environ.get("PYPLR_BACKEND", "numpy"))
+except ValueError:
+    warnings.warn(
+        "PYPLR_BACKEND={!r} is not available, using 'numpy'".format(
+            os.environ["PYPLR_BACKEND"]
+        )
+    )
+    set_backend("numpy")
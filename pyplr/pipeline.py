@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pyplr.pipeline
+==============
+
+A copy-free, chainable alternative to the functions in ``pyplr.preproc``.
+
+Each function in ``pyplr.preproc`` works on (and returns) a full copy of the
+samples. The ``Pipeline`` class instead copies the fields of interest once,
+into a single array that it owns, and runs every stage in place on that
+array. A provenance bitmask records which samples were masked, interpolated
+or filtered, and a DataFrame is only materialised at the end.
+
+Example
+-------
+>>> pipe = Pipeline(samples, fields=['diameter', 'diameter_3d'])
+>>> pipe.mask_zeros().mask_blinks(blinks).interpolate().butterworth(3, .05)
+>>> samples = pipe.to_frame()
+>>> pipe.timings
+
+"""
+
+from functools import wraps
+from time import perf_counter
+from typing import List
+
+import numpy as np
+import pandas as pd
+import scipy.signal as signal
+
+from pyplr.preproc import (
+    interval_mask,
+    _artifact_reasons,
+    _butter_ba,
+    _filter_segments,
+    _float_dtype,
+    _reject_mask,
+)
+
+# provenance flags
+MASKED = 1
+INTERPOLATED = 2
+FILTERED = 4
+
+
+def _stage(method):
+    """Time a pipeline stage and return the pipeline for chaining."""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        t0 = perf_counter()
+        method(self, *args, **kwargs)
+        self._timings.append((method.__name__, perf_counter() - t0))
+        return self
+
+    return wrapper
+
+
+class Pipeline:
+    """Run preprocessing stages in place on a single buffer of pupil data."""
+
+    def __init__(
+        self,
+        samples: pd.DataFrame,
+        fields: List[str] = ["diameter"],
+    ) -> None:
+        """Take a copy of `fields` to work on.
+
+        Parameters
+        ----------
+        samples : pandas.DataFrame
+            The samples, e.g., from ``utils.load_pupil(...)``. Index must be
+            timestamp. Columns other than `fields` (e.g., 'confidence') are
+            read from here when needed, but never copied or modified.
+        fields : list, optional
+            Columns to process. The default is ['diameter'].
+
+        Returns
+        -------
+        None.
+
+        """
+        self.samples = samples
+        self.fields = list(fields)
+        self.index = samples.index.to_numpy()
+        # column-major, so that each field is contiguous and the final
+        # DataFrame can be built without copying
+        self.data = np.array(
+            samples[self.fields].to_numpy(
+                dtype=_float_dtype(samples, self.fields)
+            ),
+            order="F",
+        )
+        self.flags = np.zeros(len(self.index), dtype="uint8")
+        self.reasons = None
+        self._timings = []
+
+    @property
+    def timings(self) -> pd.Series:
+        """Time in seconds spent on each stage, in the order they were run."""
+        names, secs = zip(*self._timings) if self._timings else ((), ())
+        return pd.Series(secs, index=list(names), name="seconds", dtype=float)
+
+    def _mask(self, mask: np.ndarray) -> None:
+        """Set samples to NaN where `mask` is True and flag them as masked.
+
+        `mask` may be 1-D (all fields) or 2-D (per field).
+
+        """
+        self.data[mask] = np.nan
+        self.flags[mask if mask.ndim == 1 else mask.any(axis=1)] |= MASKED
+
+    @_stage
+    def mask_zeros(self) -> "Pipeline":
+        """Mask any 0 values."""
+        self._mask(self.data == 0)
+
+    @_stage
+    def mask_confidence(self, threshold: float = 0.8) -> "Pipeline":
+        """Mask samples where 'confidence' is below `threshold`.
+
+        Parameters
+        ----------
+        threshold : float, optional
+            Confidence threshold for masking. Pupil Labs recommend a
+            threshold of 0.8. The default is 0.8.
+
+        """
+        self._mask(self.samples["confidence"].to_numpy() < threshold)
+
+    @_stage
+    def mask_blinks(
+        self,
+        blinks: pd.DataFrame,
+        pad_before: float = 0.0,
+        pad_after: float = 0.0,
+    ) -> "Pipeline":
+        """Mask samples falling within blinks.
+
+        Parameters
+        ----------
+        blinks : pandas.DataFrame
+            Must contain 'start_timestamp' and 'end_timestamp' columns.
+        pad_before : float, optional
+            Time in seconds to extend the mask by before each blink. The
+            default is 0.0.
+        pad_after : float, optional
+            Time in seconds to extend the mask by after each blink. The
+            default is 0.0.
+
+        """
+        self._mask(
+            interval_mask(
+                self.index,
+                blinks["start_timestamp"].to_numpy(),
+                blinks["end_timestamp"].to_numpy(),
+                pad_before,
+                pad_after,
+            )
+        )
+
+    @_stage
+    def mask_artifacts(
+        self,
+        blinks: pd.DataFrame = None,
+        reject: List[str] = None,
+        **kwargs
+    ) -> "Pipeline":
+        """Detect and mask artifacts in a single pass.
+
+        The reasons for rejecting each sample are kept in ``.reasons`` (see
+        ``preproc.detect_artifacts(...)`` and ``preproc.ARTIFACT_FLAGS``).
+
+        Parameters
+        ----------
+        blinks : pandas.DataFrame, optional
+            Blinks with 'start_timestamp' and 'end_timestamp' columns. The
+            default is None.
+        reject : list, optional
+            Keys of ``preproc.ARTIFACT_FLAGS`` to mask. The default is None
+            (all).
+        **kwargs : dict
+            Thresholds passed to ``preproc.detect_artifacts(...)``.
+
+        """
+        conf = (
+            self.samples["confidence"].to_numpy()
+            if "confidence" in self.samples
+            else None
+        )
+        self.reasons = _artifact_reasons(
+            self.index, self.data, conf, blinks, **kwargs
+        )
+        self._mask(_reject_mask(self.reasons, reject))
+
+    @_stage
+    def interpolate(self, method: str = "linear") -> "Pipeline":
+        """Linearly interpolate over NaN values.
+
+        Values missing at the start or end are filled with the nearest valid
+        sample, as in ``preproc.interpolate_zeros(...)``.
+
+        Parameters
+        ----------
+        method : str, optional
+            'linear' to treat samples as evenly spaced (as pandas does), or
+            'time' to interpolate against the timestamps. The default is
+            'linear'.
+
+        """
+        if method not in ("linear", "time"):
+            raise ValueError('method must be "linear" or "time"')
+        x = (
+            self.index
+            if method == "time"
+            else np.arange(len(self.index), dtype="float")
+        )
+        nans = np.isnan(self.data)
+        for i in np.flatnonzero(nans.any(axis=0)):
+            col, bad = self.data[:, i], nans[:, i]
+            if bad.all():
+                continue
+            col[bad] = np.interp(x[bad], x[~bad], col[~bad])
+        self.flags[nans.any(axis=1)] |= INTERPOLATED
+
+    def _filter(self, func, min_length: int) -> None:
+        """Filter each run of samples without NaN in place."""
+        _, starts, ends = _filter_segments(
+            self.data, func, min_length, out=self.data
+        )
+        for a, b in zip(starts, ends):
+            self.flags[a:b] |= FILTERED
+
+    @_stage
+    def butterworth(
+        self,
+        filt_order: int = 3,
+        cutoff_freq: float = 0.01,
+        sample_rate: float = None,
+    ) -> "Pipeline":
+        """Apply a zero-phase Butterworth filter to all fields at once.
+
+        Masked samples need not be interpolated first; see
+        ``preproc.butterworth_series(...)``.
+
+        Parameters
+        ----------
+        filt_order : int, optional
+            Order of the filter. The default is 3.
+        cutoff_freq : float, optional
+            Normalised cut-off frequency. For 4 Hz cut-off, this should be
+            4/(sample_rate/2). The default is .01.
+        sample_rate : float, optional
+            If given, `cutoff_freq` is taken to be in Hz. The default is
+            None.
+
+        """
+        B, A = _butter_ba(filt_order, cutoff_freq, sample_rate)
+        self._filter(
+            lambda x: signal.filtfilt(B, A, x, axis=0),
+            3 * max(len(A), len(B)) + 1,
+        )
+
+    @_stage
+    def savgol(
+        self, window_length: int = 51, filt_order: int = 7
+    ) -> "Pipeline":
+        """Apply a Savitzky-Golay filter to all fields at once.
+
+        Parameters
+        ----------
+        window_length : int, optional
+            Length of the filter window. The default is 51.
+        filt_order : int, optional
+            Order of the polynomial. The default is 7.
+
+        """
+        self._filter(
+            lambda x: signal.savgol_filter(
+                x, window_length, filt_order, axis=0
+            ),
+            window_length,
+        )
+
+    def to_frame(self, keep_cols: List[str] = []) -> pd.DataFrame:
+        """Materialise the processed data as a DataFrame.
+
+        The processed fields are wrapped rather than copied, so further
+        stages on this pipeline will show up in the returned DataFrame.
+
+        Parameters
+        ----------
+        keep_cols : list, optional
+            Other columns of the original samples to carry over (these are
+            copied). The default is [].
+
+        Returns
+        -------
+        samps : pandas.DataFrame
+            The processed fields, any `keep_cols`, and 'interpolated' and
+            'flags' columns describing the provenance of each sample.
+
+        """
+        samps = pd.DataFrame(
+            self.data,
+            index=self.samples.index,
+            columns=self.fields,
+            copy=False,
+        )
+        for col in keep_cols:
+            samps[col] = self.samples[col].to_numpy()
+        samps["interpolated"] = ((self.flags & INTERPOLATED) > 0).astype(
+            "int"
+        )
+        samps["flags"] = self.flags
+        return samps
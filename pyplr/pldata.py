@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pyplr.pldata
+============
+
+Read pupil data, annotations and blinks straight from a Pupil Capture
+recording directory, without exporting them with Pupil Player first.
+
+Capture stores each data stream as a '.pldata' file of msgpack records
+alongside a '_timestamps.npy' file with one timestamp per record. The
+timestamp files are memory-mapped to size the output, records are streamed
+one at a time, and only the requested fields are decoded into preallocated
+arrays. Records for an unwanted eye are skipped on their topic alone,
+without decoding the payload.
+
+The functions here return the same DataFrames as the ``load_*`` functions
+in ``pyplr.utils`` would for a Pupil Player export of the same recording.
+
+Example
+-------
+>>> samples = pldata.load_pupil(rec_dir, eye_id='left')
+>>> events = pldata.load_annotations(rec_dir)
+
+"""
+
+import os.path as op
+from typing import Iterator, List, Tuple, Union
+
+import msgpack
+import numpy as np
+import pandas as pd
+
+from pyplr.preproc import _nearest
+from pyplr.utils import (
+    PUPIL_DTYPES,
+    _eye_code,
+    _finish_pupil,
+    _pupil_usecols,
+)
+
+# where each column of 'pupil_positions.csv' is found in a pupil datum
+PUPIL_FIELDS = {
+    "eye_id": ("id",),
+    "confidence": ("confidence",),
+    "norm_pos_x": ("norm_pos", 0),
+    "norm_pos_y": ("norm_pos", 1),
+    "diameter": ("diameter",),
+    "method": ("method",),
+    "ellipse_center_x": ("ellipse", "center", 0),
+    "ellipse_center_y": ("ellipse", "center", 1),
+    "ellipse_axis_a": ("ellipse", "axes", 0),
+    "ellipse_axis_b": ("ellipse", "axes", 1),
+    "ellipse_angle": ("ellipse", "angle"),
+    "diameter_3d": ("diameter_3d",),
+    "model_confidence": ("model_confidence",),
+    "model_id": ("model_id",),
+    "sphere_center_x": ("sphere", "center", 0),
+    "sphere_center_y": ("sphere", "center", 1),
+    "sphere_center_z": ("sphere", "center", 2),
+    "sphere_radius": ("sphere", "radius"),
+    "circle_3d_center_x": ("circle_3d", "center", 0),
+    "circle_3d_center_y": ("circle_3d", "center", 1),
+    "circle_3d_center_z": ("circle_3d", "center", 2),
+    "circle_3d_normal_x": ("circle_3d", "normal", 0),
+    "circle_3d_normal_y": ("circle_3d", "normal", 1),
+    "circle_3d_normal_z": ("circle_3d", "normal", 2),
+    "circle_3d_radius": ("circle_3d", "radius"),
+    "theta": ("theta",),
+    "phi": ("phi",),
+    "projected_sphere_center_x": ("projected_sphere", "center", 0),
+    "projected_sphere_center_y": ("projected_sphere", "center", 1),
+    "projected_sphere_axis_a": ("projected_sphere", "axes", 0),
+    "projected_sphere_axis_b": ("projected_sphere", "axes", 1),
+    "projected_sphere_angle": ("projected_sphere", "angle"),
+}
+
+
+def iter_pldata(fname: str) -> Iterator[Tuple[str, bytes]]:
+    """Stream the (topic, payload) records of a '.pldata' file.
+
+    Payloads are left encoded; see ``decode(...)``.
+
+    """
+    with open(fname, "rb") as f:
+        unpacker = msgpack.Unpacker(f, raw=False, use_list=False)
+        for topic, payload in unpacker:
+            yield topic, payload
+
+
+def decode(payload: Union[bytes, dict]) -> dict:
+    """Decode the payload of a record into a dict."""
+    if isinstance(payload, bytes):
+        return msgpack.unpackb(payload, raw=False, use_list=False)
+    return payload
+
+
+def _get(datum: dict, path: tuple):
+    """Value at `path` in a nested datum, or None if it is missing."""
+    for key in path:
+        try:
+            datum = datum[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return datum
+
+
+def _timestamps(rec_dir: str, name: str) -> np.ndarray:
+    """Memory-mapped '<name>_timestamps.npy'."""
+    return np.load(op.join(rec_dir, name + "_timestamps.npy"), mmap_mode="r")
+
+
+def _world_index(rec_dir: str, t: np.ndarray) -> np.ndarray:
+    """Index of the nearest world frame to each of `t`, as in Pupil Player
+    exports, or -1 if the recording has no world video.
+
+    """
+    try:
+        world = _timestamps(rec_dir, "world")
+    except FileNotFoundError:
+        return np.full(len(t), -1)
+    return _nearest(np.asarray(t), np.asarray(world), np.inf)
+
+
+def load_pupil(
+    rec_dir: str,
+    eye_id: str = "best",
+    method: str = "3d c++",
+    cols: Union[List[str], str] = None,
+    compact: bool = False,
+) -> pd.DataFrame:
+    """Load pupil data from 'pupil.pldata' in a recording directory.
+
+    Parameters
+    ----------
+    rec_dir : str
+        Pupil Capture recording directory.
+    eye_id : str, optional
+        Eye to load. Must be 'left' (1), 'right' (0), 'best' or 'both'. The
+        default is 'best'.
+    method : str, optional
+        Load samples whose detection method contains this string. The
+        default is '3d c++'.
+    cols : list or str, optional
+        Columns to load, named as in 'pupil_positions.csv'. If 'all',
+        loads all columns. The default is None (loads ``utils.PUPIL_COLS``).
+    compact : bool, optional
+        Whether to use compact dtypes (see ``utils.COMPACT_DTYPES``). The
+        default is False.
+
+    Returns
+    -------
+    samples : pandas.DataFrame
+        As from ``utils.load_pupil(...)`` with the same arguments.
+
+    """
+    eye = _eye_code(eye_id)
+    fname = op.join(rec_dir, "pupil.pldata")
+    ts = _timestamps(rec_dir, "pupil")
+    n = len(ts)
+    usecols = _pupil_usecols(list(PUPIL_DTYPES), cols)
+    fields = [c for c in usecols if c in PUPIL_FIELDS]
+    arrays = {c: np.full(n, np.nan) for c in fields}
+    arrays["method"] = np.empty(n, dtype="object")
+    keep = np.zeros(n, dtype="bool")
+    eye_topic = None if eye is None else str(eye)
+    for i, (topic, payload) in enumerate(iter_pldata(fname)):
+        # topics are 'pupil.<eye>' or 'pupil.<eye>.<2d|3d>'
+        parts = topic.split(".")
+        if eye_topic is not None and len(parts) > 1:
+            if parts[1] != eye_topic:
+                continue
+        datum = decode(payload)
+        if method not in datum.get("method", ""):
+            continue
+        if eye is not None and datum.get("id") != eye:
+            continue
+        keep[i] = True
+        for c in fields:
+            value = _get(datum, PUPIL_FIELDS[c])
+            if value is not None:
+                arrays[c][i] = value
+    idxs = np.flatnonzero(keep)
+    idxs = idxs[np.argsort(ts[idxs], kind="stable")]
+    samples = pd.DataFrame({"pupil_timestamp": ts[idxs]})
+    for c in usecols:
+        if c == "world_index":
+            samples[c] = _world_index(rec_dir, ts[idxs])
+        elif c in arrays:
+            samples[c] = arrays[c][idxs]
+    return _finish_pupil(samples, usecols, compact, eye_id)
+
+
+def load_annotations(rec_dir: str) -> pd.DataFrame:
+    """Load annotations from 'annotation.pldata' in a recording directory.
+
+    Parameters
+    ----------
+    rec_dir : str
+        Pupil Capture recording directory.
+
+    Returns
+    -------
+    events : pandas.DataFrame
+        As from ``utils.load_annotations(...)``, with custom annotation
+        fields (e.g., 'color') as extra columns.
+
+    """
+    fname = op.join(rec_dir, "annotation.pldata")
+    ts = _timestamps(rec_dir, "annotation")
+    columns = {"index": None, "timestamp": None, "label": [], "duration": []}
+    n = 0
+    for topic, payload in iter_pldata(fname):
+        datum = decode(payload)
+        for key in datum:
+            if key not in columns and key != "topic":
+                columns[key] = [None] * n
+        for key, values in columns.items():
+            if values is not None:
+                values.append(datum.get(key))
+        n += 1
+    columns["timestamp"] = np.asarray(ts[:n])
+    columns["index"] = _world_index(rec_dir, columns["timestamp"])
+    events = pd.DataFrame(columns).set_index("timestamp")
+    events = events.infer_objects()
+    print("Loaded {} events".format(len(events)))
+    return events
+
+
+def load_blinks(rec_dir: str) -> pd.DataFrame:
+    """Load blinks from 'blinks.pldata' in a recording directory.
+
+    Capture's online blink detector records onsets and offsets as separate
+    events. Each onset is paired with the next offset to give the columns
+    of a Pupil Player blink export. 'confidence' is the mean of the onset
+    and offset confidences, and 'filter_response' and 'base_data' are
+    missing.
+
+    Parameters
+    ----------
+    rec_dir : str
+        Pupil Capture recording directory.
+
+    Returns
+    -------
+    blinks : pandas.DataFrame
+        As from ``utils.load_blinks(...)``.
+
+    """
+    fname = op.join(rec_dir, "blinks.pldata")
+    ts = _timestamps(rec_dir, "blinks")
+    kinds = np.empty(len(ts), dtype="object")
+    conf = np.full(len(ts), np.nan)
+    for i, (topic, payload) in enumerate(iter_pldata(fname)):
+        datum = decode(payload)
+        kinds[i] = datum.get("type")
+        conf[i] = datum.get("confidence", np.nan)
+    onsets = np.flatnonzero(kinds == "onset")
+    offsets = np.flatnonzero(kinds == "offset")
+    # the first offset after each onset, ignoring repeated onsets
+    nxt = np.searchsorted(offsets, onsets)
+    ok = nxt < len(offsets)
+    onsets, nxt = onsets[ok], offsets[nxt[ok]]
+    first = np.r_[True, nxt[1:] != nxt[:-1]]
+    onsets, offsets = onsets[first], nxt[first]
+    start, end = np.asarray(ts[onsets]), np.asarray(ts[offsets])
+    blinks = pd.DataFrame(
+        {
+            "start_timestamp": start,
+            "duration": end - start,
+            "end_timestamp": end,
+            "start_frame_index": _world_index(rec_dir, start),
+            "index": _world_index(rec_dir, (start + end) / 2),
+            "end_frame_index": _world_index(rec_dir, end),
+            "confidence": (conf[onsets] + conf[offsets]) / 2,
+            "filter_response": np.nan,
+            "base_data": np.nan,
+        }
+    )
+    blinks.index.name = "id"
+    print(
+        "{} blinks detected by Pupil Capture (mean dur = {:.3f} s)".format(
+            len(blinks), blinks.duration.mean()
+        )
+    )
+    return blinks
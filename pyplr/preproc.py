@@ -10,11 +10,106 @@ Scripting tools for preprocessing pupil data.
 
 """
 
-from typing import List
+import warnings
+from fractions import Fraction
+from functools import lru_cache
+from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
 import scipy.signal as signal
+from scipy import interpolate
+
+from pyplr import kernels
+
+
+def _float_dtype(samples: pd.DataFrame, cols: List[str]) -> np.dtype:
+    """Dtype to work in for `cols`: float32 if they all fit (e.g., after
+    ``utils.load_pupil(..., compact=True)``), otherwise float64.
+
+    """
+    return np.result_type(np.float32, *samples[cols].dtypes)
+
+
+def _fill_nan_times(t: np.ndarray) -> np.ndarray:
+    """Forward- then back-fill NaN timestamps along the last axis."""
+    nans = np.isnan(t)
+    if not nans.any():
+        return t
+    n = t.shape[-1]
+    idx = np.where(nans, 0, np.arange(n))
+    idx = np.maximum.accumulate(idx, axis=-1)
+    first = np.argmax(~nans, axis=-1)[..., None]
+    idx = np.where(np.arange(n) < first, first, idx)
+    return np.take_along_axis(t, idx, axis=-1)
+
+
+def interp_epochs(
+    t: np.ndarray, values: np.ndarray, t_new: np.ndarray, max_gap: float = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Linearly interpolate many epochs onto new timepoints in one go.
+
+    All epochs are searched with a single call to ``np.searchsorted`` by
+    laying them end-to-end on one time axis, and every field is
+    interpolated at once.
+
+    Parameters
+    ----------
+    t : np.ndarray
+        (events x samples) timestamps, sorted within each event. May contain
+        NaN (e.g., padding from ``utils.extract(...)``).
+    values : np.ndarray
+        (events x samples) or (events x samples x fields) data.
+    t_new : np.ndarray
+        (events x new_samples) timepoints to interpolate to.
+    max_gap : float, optional
+        New timepoints falling between two original samples further apart
+        than this are flagged. The default is None (nothing is flagged).
+
+    Returns
+    -------
+    out : np.ndarray
+        Interpolated data, shaped like `values` but with `new_samples`
+        along axis 1. NaN outside the span of the original timestamps.
+    gap : np.ndarray
+        (events x new_samples) boolean array, True for timepoints in gaps
+        larger than `max_gap`.
+
+    """
+    t = np.atleast_2d(np.asarray(t, dtype="float"))
+    t_new = np.atleast_2d(np.asarray(t_new, dtype="float"))
+    values = np.asarray(values, dtype="float")
+    squeeze = values.ndim == 2
+    if squeeze:
+        values = values[..., None]
+    n_events, n = t.shape
+    if n < 2:
+        raise ValueError("Need at least two samples per event")
+
+    # shift each event to start at 0, then lay them end to end
+    valid = ~np.isnan(t)
+    t = _fill_nan_times(t)
+    t0 = t[:, :1]
+    t, t_new = t - t0, t_new - t0
+    t_query = np.clip(t_new, 0, None)
+    span = max(t.max(), t_query.max()) + 1.0
+    pos = np.clip(kernels.search_rows(t, t_query, span) - 1, 0, n - 2)
+
+    rows = np.arange(n_events)[:, None]
+    ta, tb = t[rows, pos], t[rows, pos + 1]
+    dt = tb - ta
+    w = np.divide(t_new - ta, dt, out=np.zeros_like(dt), where=dt > 0)
+    ya, yb = values[rows, pos], values[rows, pos + 1]
+    out = ya + w[..., None] * (yb - ya)
+
+    # no extrapolation beyond the first and last valid timestamps
+    first = t[rows[:, 0], np.argmax(valid, axis=1)][:, None]
+    last = t[rows[:, 0], n - 1 - np.argmax(valid[:, ::-1], axis=1)][:, None]
+    out[(t_new < first) | (t_new > last)] = np.nan
+    gap = np.zeros(t_new.shape, dtype="bool")
+    if max_gap is not None:
+        gap = dt > max_gap
+    return (out[..., 0] if squeeze else out), gap
 
 
 def even_samples(
@@ -22,71 +117,111 @@ def even_samples(
     sample_rate: int,
     fields: List[str] = ["diameter"],
     zero_index: bool = False,
+    max_gap: float = None,
 ) -> pd.DataFrame:
     """Resample  data in `fields` to a new index with evenly spaced timepoints.
 
-    Pupil Core data samples are unevenly spaced.
+    Pupil Core data samples are unevenly spaced. The new index runs from the
+    first sample at exactly `sample_rate` Hz, regardless of any dropped
+    frames, and all fields are interpolated at once. Other columns are
+    carried over from the last original sample at or before each new
+    timepoint.
 
     Parameters
     ----------
     samples : pandas.DataFrame
         The samples.
     sample_rate : int
-        Sampling rate of the data.
+        Sampling rate of the output.
     fields : list, optional
         The columns to interpolate to new index. The default is ['diameter'].
+    zero_index : bool, optional
+        Whether the new index should start at 0. The default is False.
+    max_gap : float, optional
+        If given, a 'gap' column marks new samples falling within a gap of
+        more than `max_gap` seconds in the original data. The default is
+        None.
 
     Returns
     -------
     samps : pandas.DataFrame
-        DataFrame with evenly spaced index and interpolated data.
+        DataFrame with evenly spaced index, interpolated `fields` and the
+        other columns of `samples`.
 
     """
     # TODO: When is the best time to do this?
-    samps = samples.copy(deep=True)
-    x = samps.index.to_numpy()
+    x = samples.index.to_numpy(dtype="float")
+    n = int((x[-1] - x[0]) * sample_rate) + 1
+    xnew = x[0] + np.arange(n) / sample_rate
+    y, gap = interp_epochs(
+        x, samples[fields].to_numpy()[None], xnew, max_gap=max_gap
+    )
+    # other columns are taken from the last sample at or before each time
+    prev = np.clip(np.searchsorted(x, xnew, side="right") - 1, 0, len(x) - 1)
+    others = [c for c in samples.columns if c not in fields]
+    samps = samples[others].iloc[prev]
+    samps[fields] = y[0].astype(_float_dtype(samples, fields), copy=False)
+    samps = samps[list(samples.columns)]
     if zero_index:
-        x = x - x[0]
-    xnew = np.linspace(x.min(), x.max(), len(x))
-    for f in fields:
-        y = samps[f].to_numpy()
-        samps[f] = np.interp(xnew, x, y)
-    samps.index = xnew
+        xnew = xnew - x[0]
+    samps.index = pd.Index(xnew, name=samples.index.name)
+    if max_gap is not None:
+        samps["gap"] = gap[0].astype("int")
     return samps
 
 
-# TODO: check this works
-
-
 def even_range_samples(
-    rangs: pd.DataFrame, sample_rate: int, fields: List[str] = []
+    rangs: pd.DataFrame,
+    sample_rate: int,
+    fields: List[str] = [],
+    max_gap: float = None,
 ) -> pd.DataFrame:
     """Make the space between samples even, for a dataframe of ranges.
 
+    Each range is resampled at exactly `sample_rate` Hz from its first
+    sample, using the original timestamps in the 'orig_idx' column. All
+    ranges and fields are interpolated at once, so `rangs` must hold the
+    same number of samples for each event, as returned by
+    ``utils.extract(...)``.
 
     Parameters
     ----------
     rangs : pd.DataFrame
         Ranges.
     sample_rate : int
-        The sample rate of the data.
+        The sample rate of the output.
     fields : list, optional
         List of fields to make even. The default is [].
+    max_gap : float, optional
+        If given, a 'gap' column marks samples falling within a gap of more
+        than `max_gap` seconds in the original data. The default is None.
 
     Returns
     -------
     rangs : pd.DataFrame
-        New dataframe with even samples.
+        New dataframe with even samples, and an 'even_idx' column giving the
+        time of each sample from the start of its range.
 
     """
-    for idx, df in rangs.groupby(level=["event"]):
-        for f in fields:
-            x = df.orig_idx.to_numpy()
-            x = x - x[0]
-            xnew = np.linspace(x.min(), x.max(), len(x))
-            y = df.loc[idx, f]
-            rangs.loc[idx, f] = np.interp(xnew, x, y)
-            rangs.loc[idx, "even_idx"] = xnew
+    n_events = rangs.index.get_level_values("event").nunique()
+    t = rangs["orig_idx"].to_numpy(dtype="float").reshape(n_events, -1)
+    n = t.shape[1]
+    # align the grid to the nominal start of ranges padded with NaN
+    first = np.argmax(~np.isnan(t), axis=1)
+    t_start = _fill_nan_times(t)[:, 0] - first / sample_rate
+    even_idx = np.arange(n) / sample_rate
+    y, gap = interp_epochs(
+        t,
+        rangs[fields].to_numpy().reshape(n_events, n, len(fields)),
+        t_start[:, None] + even_idx,
+        max_gap=max_gap,
+    )
+    rangs[fields] = y.reshape(-1, len(fields)).astype(
+        _float_dtype(rangs, fields), copy=False
+    )
+    rangs["even_idx"] = np.tile(even_idx, n_events)
+    if max_gap is not None:
+        rangs["gap"] = gap.ravel().astype("int")
     return rangs
 
 
@@ -119,8 +254,8 @@ def mask_pupil_first_derivative(
     samps = samples.copy(deep=True)
     for col in mask_cols:
         d = samps[col].diff()
-        m = samps[col].diff().mean()
-        s = samps[col].diff().std() * threshold
+        m = d.mean()
+        s = d.std() * threshold
         # TODO: check this works properly
         samps[col] = samps[col].mask((d < (m - s)) | (d > (m + s)))
         samps.loc[samps[col] == 0, col] = np.nan
@@ -191,45 +326,227 @@ def pupil_confidence_filter(
     return samps
 
 
+INTERP_METHODS = ("linear", "time", "pchip", "akima")
+# valid samples either side of a gap that determine a PCHIP or Akima fit
+_CUBIC_SUPPORT = 3
+
+
+def _interp_columns(
+    x: np.ndarray, fp: np.ndarray, x_new: np.ndarray, method: str
+) -> np.ndarray:
+    """Interpolate all columns of `fp` at `x_new` in one call. Points
+    outside the range of `x` take the nearest value.
+
+    """
+    x_new = np.clip(x_new, x[0], x[-1])
+    if method in ("linear", "time"):
+        j = np.clip(np.searchsorted(x, x_new), 1, len(x) - 1)
+        dx = x[j] - x[j - 1]
+        w = np.divide(
+            x_new - x[j - 1], dx, out=np.zeros_like(dx), where=dx > 0
+        )
+        return fp[j - 1] + w[:, None] * (fp[j] - fp[j - 1])
+    if method == "pchip":
+        return interpolate.PchipInterpolator(x, fp, axis=0)(x_new)
+    return interpolate.Akima1DInterpolator(x, fp, axis=0)(x_new)
+
+
+def interpolate_gaps(
+    t: np.ndarray,
+    values: np.ndarray,
+    method: str = "linear",
+    max_gap: float = None,
+) -> Tuple[np.ndarray, pd.DataFrame]:
+    """Fill runs of NaN in one or more columns of `values`.
+
+    Gaps are found once, as runs of rows where any column is NaN. Columns
+    sharing the same pattern of NaN (the usual case, after masking) are
+    interpolated together in a single call. Missing values at the start or
+    end take the nearest valid value.
+
+    Parameters
+    ----------
+    t : np.ndarray
+        Timestamps in seconds, increasing.
+    values : np.ndarray
+        (samples) or (samples x fields) data.
+    method : str, optional
+        'linear' treats samples as evenly spaced (like pandas), 'time'
+        interpolates linearly against `t`, and 'pchip' and 'akima' fit
+        piecewise cubics against `t`. The default is 'linear'.
+    max_gap : float, optional
+        Gaps longer than this many seconds, measured between the valid
+        samples either side, are left as NaN. The default is None (fill
+        all gaps).
+
+    Returns
+    -------
+    out : np.ndarray
+        Copy of `values` with gaps filled.
+    gaps : pandas.DataFrame
+        One row per gap, with the 'start' and 'end' timestamps of the
+        missing samples, the 'length' of the gap in seconds, the number of
+        samples, 'n', and whether it was 'interpolated'.
+
+    """
+    if method not in INTERP_METHODS:
+        raise ValueError("method must be one of {}".format(INTERP_METHODS))
+    t = np.asarray(t, dtype="float")
+    values = np.asarray(values)
+    out = np.array(values, dtype=np.result_type(values.dtype, np.float32))
+    data = out.reshape(len(out), -1)
+    nans = np.isnan(data)
+    starts, ends = _runs(nans.any(axis=1))
+    n = len(t)
+    left = t[np.maximum(starts - 1, 0)]
+    right = t[np.minimum(ends, n - 1)]
+    fill = np.ones(len(starts), dtype="bool")
+    if max_gap is not None:
+        fill = right - left <= max_gap
+    gaps = pd.DataFrame(
+        {
+            "start": t[starts],
+            "end": t[ends - 1],
+            "length": right - left,
+            "n": ends - starts,
+            "interpolated": fill,
+        }
+    )
+    if not len(starts):
+        return out, gaps
+
+    # rows in gaps that are too long
+    edges = np.zeros(n + 1, dtype="int")
+    np.add.at(edges, starts[~fill], 1)
+    np.add.at(edges, ends[~fill], -1)
+    refuse = np.cumsum(edges[:-1]) > 0
+
+    x = np.arange(n, dtype="float") if method == "linear" else t
+    # group columns by their pattern of NaN
+    groups = []
+    for i in range(data.shape[1]):
+        for pattern, cols in groups:
+            if np.array_equal(pattern, nans[:, i]):
+                cols.append(i)
+                break
+        else:
+            groups.append((nans[:, i], [i]))
+    for pattern, cols in groups:
+        target = pattern & ~refuse
+        if not target.any() or pattern.all():
+            continue
+        good = np.flatnonzero(~pattern)
+        kind = method if len(good) > 1 else "linear"
+        if kind in ("pchip", "akima"):
+            # the cubic on each interval depends only on the nearest few
+            # valid samples, so fit to just those either side of the gaps
+            pos = np.searchsorted(good, np.flatnonzero(target))
+            near = np.add.outer(
+                pos, np.arange(-_CUBIC_SUPPORT, _CUBIC_SUPPORT)
+            )
+            good = good[np.unique(np.clip(near, 0, len(good) - 1))]
+        data[np.ix_(target, cols)] = _interp_columns(
+            x[good], data[np.ix_(good, cols)], x[target], kind
+        )
+    return out, gaps
+
+
+def _interpolate_frame(
+    samps: pd.DataFrame,
+    fields: List[str],
+    method: str,
+    max_gap: float,
+    return_gaps: bool,
+):
+    """Interpolate `fields` of `samps` in place and flag what was done."""
+    values = samps[fields].to_numpy(dtype=_float_dtype(samps, fields))
+    missing = np.isnan(values).any(axis=1)
+    filled, gaps = interpolate_gaps(
+        samps.index.to_numpy(dtype="float"), values, method, max_gap
+    )
+    samps[fields] = filled
+    left = np.isnan(filled).any(axis=1)
+    samps["interpolated"] = (missing & ~left).astype("int")
+    if max_gap is not None:
+        samps["gap"] = left.astype("int")
+    if return_gaps:
+        return samps, gaps
+    return samps
+
+
 def interpolate_pupil(
     samples: pd.DataFrame,
     interp_cols: List[str] = ["diameter"],
     method: str = "linear",
     order: int = None,
+    max_gap: float = None,
+    return_gaps: bool = False,
 ) -> pd.DataFrame:
     """
-    Use linear interpolation to reconstruct nan values in interp_cols.
+    Use interpolation to reconstruct nan values in interp_cols.
+
+    Only `interp_cols` are touched. Gaps are found once and all columns are
+    interpolated together (see ``interpolate_gaps(...)``).
 
     Parameters
     ----------
     samples : pandas.DataFrame
-        Samples containing the data to be interpolated.
+        Samples containing the data to be interpolated. Index must be
+        timestamp.
     interp_cols : list, optional
         Columns to interpolate. The default is ['diameter'].
     method : string
-        Linear or polynomial. If polynomial, requires 'order' to be specified.
+        'linear', 'time', 'pchip' or 'akima', or any other method accepted
+        by ``pandas.DataFrame.interpolate`` (e.g., 'polynomial', which
+        requires 'order' to be specified).
     order : int
         Polynomial order.
+    max_gap : float, optional
+        Leave gaps longer than this many seconds as NaN, and mark them in a
+        'gap' column. The default is None.
+    return_gaps : bool, optional
+        Whether to also return the table of gaps. The default is False.
 
     Returns
     -------
     samps : pandas.DataFrame
-        Masked data
+        Interpolated data, with an 'interpolated' column.
+    gaps : pandas.DataFrame
+        Only if `return_gaps` is True. See ``interpolate_gaps(...)``.
 
     """
     if method == "polynomial" and not order:
         raise ValueError("Must specify order for polynomial")
     samps = samples.copy(deep=True)
-    samps["interpolated"] = 0
-    samps.loc[samps[interp_cols].isna().any(axis=1), "interpolated"] = 1
+    if method in INTERP_METHODS:
+        return _interpolate_frame(
+            samps, interp_cols, method, max_gap, return_gaps
+        )
+
+    # other pandas methods, with any long gaps put back afterwards
+    values = samps[interp_cols].to_numpy(dtype="float")
+    _, gaps = interpolate_gaps(
+        samps.index.to_numpy(dtype="float"), values, "linear", max_gap
+    )
+    samps["interpolated"] = np.isnan(values).any(axis=1).astype("int")
     samps[interp_cols] = samps[interp_cols].interpolate(
         method=method,
         order=order,
         axis=0,
         inplace=False,
-        limit=10000,
         limit_direction="both",
     )
+    if max_gap is not None:
+        refuse = interval_mask(
+            samps.index.to_numpy(),
+            gaps.loc[~gaps["interpolated"], "start"].to_numpy(),
+            gaps.loc[~gaps["interpolated"], "end"].to_numpy(),
+        )
+        samps.loc[refuse, interp_cols] = float("nan")
+        samps.loc[refuse, "interpolated"] = 0
+        samps["gap"] = refuse.astype("int")
+    if return_gaps:
+        return samps, gaps
     return samps
 
 
@@ -259,7 +576,85 @@ def percent_signal_change(
     return ranges
 
 
-def ev_row_idxs(samples: pd.DataFrame, blinks: pd.DataFrame) -> list:
+def merge_intervals(
+    starts: np.ndarray, ends: np.ndarray, min_gap: float = 0.0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge overlapping (or nearly overlapping) intervals.
+
+    Parameters
+    ----------
+    starts : array-like
+        Interval start times.
+    ends : array-like
+        Interval end times.
+    min_gap : float, optional
+        Intervals separated by no more than this are merged as well. The
+        default is 0.0 (only overlapping or touching intervals are merged).
+
+    Returns
+    -------
+    starts, ends : np.ndarray
+        Sorted, non-overlapping intervals.
+
+    """
+    starts = np.asarray(starts, dtype="float")
+    ends = np.asarray(ends, dtype="float")
+    if starts.size == 0:
+        return starts, ends
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    new = np.r_[True, starts[1:] > reach[:-1] + min_gap]
+    first = np.flatnonzero(new)
+    return starts[first], np.maximum.reduceat(ends, first)
+
+
+def interval_mask(
+    timestamps: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    pad_before: float = 0.0,
+    pad_after: float = 0.0,
+) -> np.ndarray:
+    """Boolean mask of the timestamps falling within any of the intervals.
+
+    Intervals are inclusive at both ends and may overlap. The mask is built
+    with two calls to ``np.searchsorted`` and a cumulative sum over interval
+    boundaries, so it runs in O(N + B log N) for N timestamps and B
+    intervals.
+
+    Parameters
+    ----------
+    timestamps : array-like
+        Sorted sample timestamps.
+    starts : array-like
+        Interval start times.
+    ends : array-like
+        Interval end times.
+    pad_before : float, optional
+        Time to extend each interval by before its start. The default is 0.0.
+    pad_after : float, optional
+        Time to extend each interval by after its end. The default is 0.0.
+
+    Returns
+    -------
+    mask : np.ndarray
+        Boolean array, True where a timestamp falls within an interval.
+
+    """
+    return kernels.interval_sweep(
+        np.asarray(timestamps),
+        np.asarray(starts) - pad_before,
+        np.asarray(ends) + pad_after,
+    )
+
+
+def ev_row_idxs(
+    samples: pd.DataFrame,
+    blinks: pd.DataFrame,
+    pad_before: float = 0.0,
+    pad_after: float = 0.0,
+) -> np.ndarray:
     """
     Returns the indices in 'samples' contained in events from 'events'.
 
@@ -269,34 +664,139 @@ def ev_row_idxs(samples: pd.DataFrame, blinks: pd.DataFrame) -> list:
         The samples from which to pull indices.
     events : pandas.DataFrame
         The events whose indices should be pulled from 'samples'.
+    pad_before : float, optional
+        Time to extend each event by before its start. The default is 0.0.
+    pad_after : float, optional
+        Time to extend each event by after its end. The default is 0.0.
 
     Returns
     -------
-    samps : pandas.DataFrame
-        Masked data
+    idxs : np.ndarray
+        Index values of the samples falling within the events.
 
     """
-    idxs = []
-    for start, end in zip(blinks["start_timestamp"], blinks["end_timestamp"]):
-        idxs.extend(list(samples.loc[start:end].index))
-    idxs = np.unique(idxs)
-    idxs = np.intersect1d(idxs, samples.index.tolist())
-    return idxs
+    mask = interval_mask(
+        samples.index.to_numpy(),
+        blinks["start_timestamp"].to_numpy(),
+        blinks["end_timestamp"].to_numpy(),
+        pad_before,
+        pad_after,
+    )
+    return samples.index.to_numpy()[mask]
 
 
-def get_mask_idxs(samples, blinks):
+def get_mask_idxs(samples, blinks, pad_before=0.0, pad_after=0.0):
     """
     Finds indices from 'samples' within the returned events.
 
     """
-    blidxs = ev_row_idxs(samples, blinks)
+    blidxs = ev_row_idxs(samples, blinks, pad_before, pad_after)
     return blidxs
 
 
+def detect_blinks(
+    samples: pd.DataFrame,
+    field: str = "diameter",
+    sample_rate: float = None,
+    concat_gap: float = 0.1,
+    smooth: float = 0.01,
+) -> pd.DataFrame:
+    """Detect blinks with the noise-based algorithm of Hershman et al.
+    (2018).
+
+    Blinks start as runs of missing data (0 or NaN). Runs separated by less
+    than `concat_gap` are joined, then each blink is widened to take in the
+    fall and rise of the pupil signal either side, found from the sign of
+    the derivative of the smoothed signal. Everything is vectorised: the
+    runs come from a single pass over the data, and the onset and offset
+    searches are one call to ``np.searchsorted`` each.
+
+    Parameters
+    ----------
+    samples : pandas.DataFrame
+        The samples. Index must be timestamp.
+    field : str, optional
+        Pupil column to use. The default is 'diameter'.
+    sample_rate : float, optional
+        Nominal sampling rate in Hz. If None, it is estimated from the
+        median interval between timestamps. The default is None.
+    concat_gap : float, optional
+        Blinks closer together than this many seconds are merged. The
+        default is 0.1.
+    smooth : float, optional
+        Length in seconds of the centred moving average applied before
+        taking the derivative. The default is 0.01.
+
+    Returns
+    -------
+    blinks : pandas.DataFrame
+        Blink events with 'start_timestamp', 'duration' and 'end_timestamp'
+        columns, as from ``utils.load_blinks(...)``.
+
+    References
+    ----------
+    Hershman, R., Henik, A., & Cohen, N. (2018). A novel blink detection
+    method based on pupillometry noise. Behavior Research Methods, 50(1),
+    107-114.
+
+    """
+    t = samples.index.to_numpy(dtype="float")
+    x = samples[field].to_numpy(dtype="float")
+    x = np.where(np.isnan(x), 0.0, x)
+    n = len(x)
+    onsets, offsets = _runs(x == 0)
+    if len(onsets):
+        # join runs separated by less than concat_gap
+        new = np.r_[True, t[onsets[1:]] - t[offsets[:-1]] >= concat_gap]
+        first = np.flatnonzero(new)
+        onsets = onsets[first]
+        offsets = offsets[np.r_[first[1:] - 1, len(new) - 1]]
+
+        # widen to where the smoothed signal stops falling / rising
+        if sample_rate is None:
+            sample_rate = 1 / np.median(np.diff(t))
+        width = max(int(smooth * sample_rate), 1)
+        # centred moving average, so that onsets and offsets are not
+        # shifted, with partial windows at the edges left out
+        lead = (width - 1) // 2
+        smoothed = np.convolve(x, np.ones(width) / width)[lead : lead + n]
+        smoothed[: width // 2] = np.nan
+        smoothed[n - lead :] = np.nan
+        smoothed[smoothed == 0] = np.nan
+        d = np.diff(smoothed)
+        not_falling = np.flatnonzero(~(d <= 0))
+        not_rising = np.flatnonzero(~(d >= 0))
+        i = np.searchsorted(not_falling, onsets - 2, "right") - 1
+        onsets = np.where(i >= 0, np.r_[not_falling, 0][i] + 1, 0)
+        j = np.searchsorted(not_rising, offsets)
+        offsets = np.where(
+            offsets < n,
+            np.r_[not_rising, n - 1][j],
+            n - 1,
+        )
+    starts, ends = merge_intervals(t[onsets], t[offsets])
+    blinks = pd.DataFrame(
+        {
+            "start_timestamp": starts,
+            "duration": ends - starts,
+            "end_timestamp": ends,
+        }
+    )
+    blinks.index.name = "id"
+    print(
+        "{} blinks detected from pupil noise (mean dur = {:.3f} s)".format(
+            len(blinks), blinks.duration.mean()
+        )
+    )
+    return blinks
+
+
 def mask_blinks(
     samples: pd.DataFrame,
     blinks: pd.DataFrame,
     mask_cols: List[str] = ["diameter"],
+    pad_before: float = 0.0,
+    pad_after: float = 0.0,
 ) -> pd.DataFrame:
     """
     Sets untrustworthy pupil data to NaN.
@@ -309,6 +809,13 @@ def mask_blinks(
         Must contain 'start_timestamp' and 'end_timestamp' columns
     mask_cols : list, optional
         Columns to mask. The default is ['diameter'].
+    pad_before : float, optional
+        Time in seconds to extend the mask by before each blink. The default
+        is 0.0.
+    pad_after : float, optional
+        Time in seconds to extend the mask by after each blink. The default
+        is 0.0.
+
     Returns
     -------
     samps : pandas.DataFrame
@@ -316,10 +823,15 @@ def mask_blinks(
 
     """
     samps = samples.copy(deep=True)
-    indices = get_mask_idxs(samps, blinks)
-    samps.loc[indices, mask_cols] = float("nan")
-    samps["interpolated"] = 0
-    samps.loc[indices, "interpolated"] = 1
+    mask = interval_mask(
+        samps.index.to_numpy(),
+        blinks["start_timestamp"].to_numpy(),
+        blinks["end_timestamp"].to_numpy(),
+        pad_before,
+        pad_after,
+    )
+    samps.loc[mask, mask_cols] = float("nan")
+    samps["interpolated"] = mask.astype("int")
     return samps
 
 
@@ -327,8 +839,12 @@ def interpolate_blinks(
     samples: pd.DataFrame,
     blinks: pd.DataFrame,
     fields: List[str] = ["diameter"],
+    pad_before: float = 0.0,
+    pad_after: float = 0.0,
+    method: str = "linear",
+    max_gap: float = None,
 ) -> pd.DataFrame:
-    """Reconstructs Pupil Labs eye blinks with linear interpolation.
+    """Reconstructs Pupil Labs eye blinks with interpolation.
 
     Parameters
     ----------
@@ -338,6 +854,18 @@ def interpolate_blinks(
         Must contain 'start_timestamp' and 'end_timestamp' columns
     fields : list, optional
         Columns to interpolate. The default is ['diameter'].
+    pad_before : float, optional
+        Time in seconds to extend each blink by before its start. The
+        default is 0.0.
+    pad_after : float, optional
+        Time in seconds to extend each blink by after its end. The default
+        is 0.0.
+    method : str, optional
+        Interpolation method, see ``interpolate_gaps(...)``. The default is
+        'linear'.
+    max_gap : float, optional
+        Leave gaps longer than this many seconds as NaN, and mark them in a
+        'gap' column. The default is None.
 
     Returns
     -------
@@ -345,14 +873,18 @@ def interpolate_blinks(
         Blink-interpolated data
 
     """
-    # TODO: fix this pipeline
-    samps = mask_blinks(samples, blinks, mask_cols=fields)
-    n = samps[fields].isna().sum().max()
-    samps = samps.interpolate(method="linear", axis=0, inplace=False)
-    # breakpoint()
+    samps = mask_blinks(
+        samples,
+        blinks,
+        mask_cols=fields,
+        pad_before=pad_before,
+        pad_after=pad_after,
+    )
+    samps = _interpolate_frame(samps, fields, method, max_gap, False)
+    n = samps["interpolated"].sum()
     print(
         "{} samples ({:.3f} %) interpolated".format(
-            len(samps.loc[samps["interpolated"] == 1]), n
+            n, n / max(len(samps), 1) * 100
         )
     )
     return samps
@@ -378,41 +910,422 @@ def mask_zeros(
     """
     samps = samples.copy(deep=True)
     for f in mask_cols:
-        samps[samps[f] == 0] = float("nan")
+        samps.loc[samps[f] == 0, f] = float("nan")
     return samps
 
 
 def interpolate_zeros(
-    samples: pd.DataFrame, fields: List[str] = ["diameter"]
+    samples: pd.DataFrame,
+    fields: List[str] = ["diameter"],
+    method: str = "linear",
+    max_gap: float = None,
 ) -> pd.DataFrame:
-    """Replace 0s in "samples" with linearly interpolated data.
+    """Replace 0s in "samples" with interpolated data.
+
+    Only `fields` are changed. Missing values at the start or end take the
+    nearest valid value.
 
     Parameters
     ----------
     samples : pandas.DataFrame
         The samples in which you'd like to replace 0s
-    interp_cols : list
+    fields : list
         The column names from samples in which you'd like to replace 0s.
+    method : str, optional
+        Interpolation method, see ``interpolate_gaps(...)``. The default is
+        'linear'.
+    max_gap : float, optional
+        Leave gaps longer than this many seconds as NaN, and mark them in a
+        'gap' column. The default is None.
+
+    Returns
+    -------
+    samps : pandas.DataFrame
+        Interpolated data, with an 'interpolated' column.
+
+    """
+    samps = samples.copy(deep=True)
+    values = samps[fields].to_numpy(dtype=_float_dtype(samps, fields))
+    values[(values == 0).any(axis=1)] = np.nan
+    samps[fields] = values
+    return _interpolate_frame(samps, fields, method, max_gap, False)
+
+
+def _nearest(t_ref: np.ndarray, t: np.ndarray, tolerance: float) -> np.ndarray:
+    """Position in `t` of the nearest timestamp to each of `t_ref`, or -1
+    where there is none within `tolerance` (both must be sorted).
+
+    """
+    j = np.searchsorted(t, t_ref)
+    left = np.clip(j - 1, 0, len(t) - 1)
+    right = np.clip(j, 0, len(t) - 1)
+    pick = np.where(t[right] - t_ref < t_ref - t[left], right, left)
+    return np.where(np.abs(t[pick] - t_ref) <= tolerance, pick, -1)
+
+
+def fuse_binocular(
+    samples: pd.DataFrame,
+    fields: List[str] = ["diameter_3d"],
+    confidence_threshold: float = 0.8,
+    tolerance: float = None,
+    reference: int = None,
+    match_scale: bool = True,
+) -> pd.DataFrame:
+    """Combine samples from both eyes into one confidence-weighted stream.
+
+    Pupil Core eye cameras are not synchronised, so the samples of the
+    reference eye set the timeline and each is paired with the nearest
+    sample from the other eye (as ``pandas.merge_asof(direction='nearest')``
+    would, but with a single ``np.searchsorted``). Valid samples are
+    averaged with their confidence as the weight. Where only one eye is
+    valid (e.g., a monocular blink), that eye is used on its own.
+
+    Parameters
+    ----------
+    samples : pandas.DataFrame
+        Samples from both eyes with 'eye_id' and 'confidence' columns, e.g.,
+        from ``utils.load_pupil(..., eye_id='both')``. Index must be
+        timestamp.
+    fields : list, optional
+        Pupil columns to fuse. Fusion makes most sense for 'diameter_3d',
+        which is in mm. The default is ['diameter_3d'].
+    confidence_threshold : float, optional
+        Samples with lower confidence, or with 0 or NaN values, are not
+        used. The default is 0.8.
+    tolerance : float, optional
+        Maximum time in seconds between paired samples. The default is None
+        (the median sampling interval of the other eye).
+    reference : int, optional
+        The eye_id whose timestamps form the timeline. The default is None
+        (the eye with more samples).
+    match_scale : bool, optional
+        Whether to rescale the other eye to the reference by the median
+        ratio of jointly valid samples, so that falling back to one eye
+        does not cause a step. The default is True.
+
+    Returns
+    -------
+    fused : pandas.DataFrame
+        Fused `fields`, the highest 'confidence' of the eyes used, and an
+        'eyes' column with bit 1 set where eye 0 was used and bit 2 set
+        where eye 1 was used.
 
     """
-    samps = mask_zeros(samples, mask_cols=fields)
-    samps = samps.interpolate(method="linear", axis=0, inplace=False)
-    # since interpolate doesn't handle the start/finish, bfill the ffill to
-    # take care of NaN's at the start/finish samps.
-    samps.fillna(method="bfill", inplace=True)
-    samps.fillna(method="ffill", inplace=True)
+    eye = samples["eye_id"].to_numpy()
+    if reference is None:
+        reference = int((eye == 1).sum() > (eye == 0).sum())
+    if reference not in (0, 1):
+        raise ValueError("reference must be 0 or 1")
+    ref, other = samples[eye == reference], samples[eye != reference]
+    t_ref = ref.index.to_numpy(dtype="float")
+    t_other = other.index.to_numpy(dtype="float")
+    if tolerance is None:
+        tolerance = np.median(np.diff(t_other)) if len(t_other) > 1 else 0
+    pair = np.full(len(t_ref), -1)
+    if len(t_other):
+        pair = _nearest(t_ref, t_other, tolerance)
+    paired = pair >= 0
+
+    # (samples x eyes x fields) values and (samples x eyes) confidence
+    x_other = np.full((len(t_ref), len(fields)), np.nan)
+    x_other[paired] = other[fields].to_numpy(dtype="float")[pair[paired]]
+    conf_other = np.zeros(len(t_ref))
+    conf_other[paired] = other["confidence"].to_numpy()[pair[paired]]
+    x = np.stack([ref[fields].to_numpy(dtype="float"), x_other], axis=1)
+    conf = np.stack(
+        [ref["confidence"].to_numpy(dtype="float"), conf_other], axis=1
+    )
+    valid = (np.isfinite(x) & (x != 0)) & (
+        conf >= confidence_threshold
+    )[..., None]
+    if match_scale:
+        both = valid.all(axis=1)
+        for i in range(len(fields)):
+            if both[:, i].any():
+                x[:, 1, i] *= np.median(
+                    x[both[:, i], 0, i] / x[both[:, i], 1, i]
+                )
+    w = np.where(valid, conf[..., None], 0.0)
+    with np.errstate(invalid="ignore"):
+        fused = (w * np.where(valid, x, 0.0)).sum(axis=1) / w.sum(axis=1)
+    used = valid.any(axis=2)
+    out = pd.DataFrame(
+        fused.astype(_float_dtype(samples, fields), copy=False),
+        index=ref.index,
+        columns=fields,
+    )
+    out["confidence"] = (
+        np.where(used, conf, 0.0)
+        .max(axis=1)
+        .astype(_float_dtype(samples, ["confidence"]), copy=False)
+    )
+    eyes = (used[:, 0] * (1 << reference)) | (used[:, 1] * (2 >> reference))
+    out["eyes"] = eyes.astype("uint8")
+    print(
+        "Fused {} samples ({:.3f} % binocular, {:.3f} % monocular)".format(
+            len(out),
+            used.all(axis=1).mean() * 100 if len(out) else 0,
+            (used.sum(axis=1) == 1).mean() * 100 if len(out) else 0,
+        )
+    )
+    return out
+
+
+# bit flags for the reasons a sample is rejected by detect_artifacts(...)
+ARTIFACT_FLAGS = {
+    "zero": 1,
+    "low_confidence": 2,
+    "velocity": 4,
+    "blink": 8,
+    "out_of_range": 16,
+}
+
+
+def _artifact_reasons(
+    t: np.ndarray,
+    values: np.ndarray,
+    confidence: np.ndarray = None,
+    blinks: pd.DataFrame = None,
+    confidence_threshold: float = 0.8,
+    velocity_mads: float = 10.0,
+    valid_range: Tuple[float, float] = None,
+    blink_pad: Tuple[float, float] = (0.0, 0.0),
+) -> np.ndarray:
+    """Array version of ``detect_artifacts(...)``.
+
+    `t` is (samples,), `values` is (samples x fields) and `confidence`
+    (samples,) or None. See ``detect_artifacts(...)`` for the rest.
+
+    """
+    reasons = np.zeros(len(t), dtype="uint8")
+    zero = values == 0
+    reasons[zero.any(axis=1)] |= ARTIFACT_FLAGS["zero"]
+    if confidence is not None and confidence_threshold is not None:
+        low = confidence < confidence_threshold
+        reasons[low] |= ARTIFACT_FLAGS["low_confidence"]
+    if blinks is not None and len(blinks):
+        in_blink = interval_mask(
+            t,
+            blinks["start_timestamp"].to_numpy(),
+            blinks["end_timestamp"].to_numpy(),
+            *blink_pad,
+        )
+        reasons[in_blink] |= ARTIFACT_FLAGS["blink"]
+    if valid_range is not None:
+        lo, hi = valid_range
+        out = ((values < lo) | (values > hi)) & ~zero
+        reasons[out.any(axis=1)] |= ARTIFACT_FLAGS["out_of_range"]
+    if velocity_mads is not None and len(t) > 2:
+        # dilation speed (Kret & Sjak-Shie, 2019): the larger of the
+        # absolute rates of change to the previous and next sample
+        v = np.where(zero, np.nan, values)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d = np.abs(np.diff(v, axis=0) / np.diff(t)[:, None])
+        nan_row = np.full((1, d.shape[1]), np.nan)
+        speed = np.fmax(np.r_[nan_row, d], np.r_[d, nan_row])
+        if not np.isnan(speed).all():
+            med = np.nanmedian(speed, axis=0)
+            mad = np.nanmedian(np.abs(speed - med), axis=0)
+            fast = speed > med + velocity_mads * mad
+            reasons[fast.any(axis=1)] |= ARTIFACT_FLAGS["velocity"]
+    return reasons
+
+
+def detect_artifacts(
+    samples: pd.DataFrame,
+    fields: List[str] = ["diameter"],
+    blinks: pd.DataFrame = None,
+    confidence_threshold: float = 0.8,
+    velocity_mads: float = 10.0,
+    valid_range: Tuple[float, float] = None,
+    blink_pad: Tuple[float, float] = (0.0, 0.0),
+) -> pd.Series:
+    """Flag poor quality samples, recording the reasons in a bitmask.
+
+    All criteria are evaluated in a single pass without copying the samples,
+    and each adds its bit from ``ARTIFACT_FLAGS`` to the samples it rejects:
+
+        * 'zero' - a value in `fields` is exactly 0
+        * 'low_confidence' - 'confidence' is below `confidence_threshold`
+        * 'velocity' - dilation speed is more than `velocity_mads` median
+          absolute deviations above the median (Kret & Sjak-Shie, 2019)
+        * 'blink' - the sample falls within one of `blinks`
+        * 'out_of_range' - a (non-zero) value is outside of `valid_range`
+
+    Use ``mask_artifacts(...)`` to mask the flagged samples and
+    ``artifact_report(...)`` to summarise them.
+
+    Parameters
+    ----------
+    samples : pandas.DataFrame
+        The samples. Index must be timestamp.
+    fields : list, optional
+        Pupil columns to check. A sample is flagged if any of them fail.
+        The default is ['diameter'].
+    blinks : pandas.DataFrame, optional
+        Blinks with 'start_timestamp' and 'end_timestamp' columns. The
+        default is None.
+    confidence_threshold : float, optional
+        Samples with lower confidence are flagged. Ignored if `samples` has
+        no 'confidence' column. The default is 0.8.
+    velocity_mads : float, optional
+        Threshold for dilation speed outliers. The default is 10.0.
+    valid_range : tuple, optional
+        Plausible (min, max) for values in `fields`. The default is None.
+    blink_pad : tuple, optional
+        Time in seconds to extend each blink by (before, after). The default
+        is (0.0, 0.0).
+
+    Any criterion can be disabled by setting its parameter to None.
+
+    Returns
+    -------
+    reasons : pandas.Series
+        uint8 bitmask for each sample (0 = no artifact).
+
+    """
+    reasons = _artifact_reasons(
+        samples.index.to_numpy(dtype="float"),
+        samples[fields].to_numpy(dtype="float"),
+        samples["confidence"].to_numpy() if "confidence" in samples else None,
+        blinks,
+        confidence_threshold,
+        velocity_mads,
+        valid_range,
+        blink_pad,
+    )
+    return pd.Series(reasons, index=samples.index, name="reasons")
+
+
+def _reject_mask(reasons: np.ndarray, reject: List[str] = None) -> np.ndarray:
+    """Boolean mask of samples flagged for any of the `reject` reasons."""
+    if reject is None:
+        reject = list(ARTIFACT_FLAGS)
+    bits = np.uint8(sum(ARTIFACT_FLAGS[r] for r in reject))
+    return (np.asarray(reasons) & bits) > 0
+
+
+def mask_artifacts(
+    samples: pd.DataFrame,
+    reasons: pd.Series,
+    mask_cols: List[str] = ["diameter"],
+    reject: List[str] = None,
+) -> pd.DataFrame:
+    """Set samples flagged by ``detect_artifacts(...)`` to NaN.
+
+    Parameters
+    ----------
+    samples : pandas.DataFrame
+        The samples.
+    reasons : pandas.Series
+        Output from ``detect_artifacts(...)``.
+    mask_cols : list, optional
+        Columns to mask. The default is ['diameter'].
+    reject : list, optional
+        Keys of ``ARTIFACT_FLAGS`` to act on. The default is None (all).
+
+    Returns
+    -------
+    samps : pandas.DataFrame
+        Masked data, with 'reasons' and 'interpolated' columns.
+
+    """
+    samps = samples.copy(deep=True)
+    mask = _reject_mask(reasons, reject)
+    samps.loc[mask, mask_cols] = float("nan")
+    samps["reasons"] = np.asarray(reasons)
+    samps["interpolated"] = mask.astype("int")
     return samps
 
 
+def artifact_report(reasons: pd.Series) -> pd.DataFrame:
+    """Count the samples flagged for each reason.
+
+    Samples may be flagged for more than one reason, so the counts can sum
+    to more than the number of rejected samples.
+
+    Parameters
+    ----------
+    reasons : pandas.Series
+        Output from ``detect_artifacts(...)``.
+
+    Returns
+    -------
+    report : pandas.DataFrame
+        Number and percentage of samples flagged for each reason, and in
+        total.
+
+    """
+    reasons = np.asarray(reasons)
+    counts = {
+        name: int(((reasons & bit) > 0).sum())
+        for name, bit in ARTIFACT_FLAGS.items()
+    }
+    counts["any"] = int((reasons > 0).sum())
+    report = pd.DataFrame.from_dict(counts, orient="index", columns=["n"])
+    report["percent"] = report["n"] / max(len(reasons), 1) * 100
+    return report
+
+
+def _runs(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Start and (exclusive) end of each run of True in a 1-D mask."""
+    return kernels.runs(mask)
+
+
+def _valid_segments(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Start and (exclusive) end of each run of rows with no NaN."""
+    return _runs(~np.isnan(values.reshape(len(values), -1)).any(axis=1))
+
+
+def _filter_segments(
+    values: np.ndarray, func, min_length: int, out: np.ndarray = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Apply `func` to each contiguous run of valid rows in `values`.
+
+    `func` is called once per segment on a 2-D (samples x fields) array, so
+    all fields are filtered together along axis 0. NaN rows are left as they
+    are, and segments shorter than `min_length` are left unfiltered.
+
+    Returns
+    -------
+    out : np.ndarray
+        The filtered values (`out` if given, which may be `values`).
+    starts, ends : np.ndarray
+        The segments that were filtered.
+
+    """
+    starts, ends = _valid_segments(values)
+    keep = ends - starts >= min_length
+    if out is None:
+        if keep.size == 1 and keep[0] and ends[0] - starts[0] == len(values):
+            out = func(values).astype(values.dtype, copy=False)
+            return out, starts[keep], ends[keep]
+        out = values.copy()
+    for a, b in zip(starts[keep], ends[keep]):
+        out[a:b] = func(values[a:b])
+    n_short = int((~keep).sum())
+    if n_short:
+        print(
+            "{} segments shorter than {} samples were left "
+            "unfiltered".format(n_short, min_length)
+        )
+    return out, starts[keep], ends[keep]
+
+
 def butterworth_series(
     samples: pd.DataFrame,
     fields: List[str] = ["diameter"],
     filt_order: int = 3,
     cutoff_freq: float = 0.01,
     inplace: bool = False,
+    sample_rate: float = None,
 ) -> pd.DataFrame:
     """Applies a Butterworth filter to the given fields.
 
+    The filter is zero-phase and is applied to all fields at once. Missing
+    data (NaN) are allowed: each contiguous run of samples without NaN is
+    filtered separately, and runs too short to filter are left as they are.
+
     Parameters
     ----------
     samples : `pandas.DataFrame`
@@ -426,6 +1339,9 @@ def butterworth_series(
         4/(sample_rate/2). The default is .01.
     inplace : bool, optional
         Whether to modify `samples` in place. The default is False.
+    sample_rate : float, optional
+        If given, `cutoff_freq` is taken to be in Hz rather than normalised.
+        The default is None.
 
     Returns
     -------
@@ -434,20 +1350,468 @@ def butterworth_series(
 
     """
     samps = samples if inplace else samples.copy(deep=True)
-    B, A = signal.butter(filt_order, cutoff_freq, output="BA")
-    samps[fields] = samps[fields].apply(
-        lambda x: signal.filtfilt(B, A, x), axis=0
-    )
+    B, A = _butter_ba(filt_order, cutoff_freq, sample_rate)
+    samps[fields] = _filter_segments(
+        samps[fields].to_numpy(dtype=_float_dtype(samps, fields)),
+        lambda x: signal.filtfilt(B, A, x, axis=0),
+        min_length=3 * max(len(A), len(B)) + 1,
+    )[0]
     return samps
 
 
+@lru_cache(maxsize=None)
+def _butter_ba(
+    filt_order: int, cutoff_freq: float, sample_rate: float = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Butterworth low-pass design as transfer function (cached)."""
+    return signal.butter(filt_order, cutoff_freq, output="BA", fs=sample_rate)
+
+
+@lru_cache(maxsize=None)
+def _butter_sos(
+    filt_order: int, cutoff_freq: float, sample_rate: float = None
+) -> np.ndarray:
+    """Butterworth low-pass design as second-order sections (cached)."""
+    return signal.butter(filt_order, cutoff_freq, output="sos", fs=sample_rate)
+
+
+@lru_cache(maxsize=None)
+def _poly_filter(up: int, down: int) -> np.ndarray:
+    """Anti-aliasing FIR filter for ``signal.resample_poly(...)`` (cached).
+
+    This is the filter scipy designs by default, so passing it as `window`
+    gives the same result without designing it again for every call.
+
+    """
+    max_rate = max(up, down)
+    return signal.firwin(
+        20 * max_rate + 1, 1.0 / max_rate, window=("kaiser", 5.0)
+    )
+
+
+def _rate_ratio(old_rate: float, new_rate: float) -> Tuple[int, int]:
+    """Smallest integer (up, down) with new_rate / old_rate = up / down."""
+    ratio = Fraction(new_rate / old_rate).limit_denominator(1000)
+    return ratio.numerator, ratio.denominator
+
+
+def _sosfiltfilt_padlen(sos: np.ndarray) -> int:
+    """Default edge padding used by ``scipy.signal.sosfiltfilt``."""
+    return 3 * (
+        2 * len(sos)
+        + 1
+        - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+    )
+
+
+def _settling_length(sos: np.ndarray, tol: float = 1e-6) -> int:
+    """Number of samples until the impulse response of `sos` decays below
+    `tol` times its peak.
+
+    """
+    n = 64
+    while True:
+        impulse = np.zeros(n)
+        impulse[0] = 1.0
+        h = np.abs(signal.sosfilt(sos, impulse))
+        above = np.flatnonzero(h > tol * h.max())
+        if above[-1] < n // 2 or n >= 2 ** 22:
+            return int(above[-1]) + 1
+        n *= 2
+
+
+class StreamingFilter:
+    """Causal Butterworth filter for pupil data arriving in chunks.
+
+    Filter state is carried between calls, so chunks of any size (including
+    single samples) can be passed as they arrive, e.g., from
+    ``PupilCore.grab_data(...)``, and the output is identical to filtering
+    the whole series in one go with ``scipy.signal.sosfilt``. Every sample is
+    returned as soon as it is passed in; the only latency is the group delay
+    of the filter itself (see ``.group_delay(...)``).
+
+    Example
+    -------
+    >>> sf = StreamingFilter(filt_order=3, cutoff_freq=4 / (120 / 2))
+    >>> data = p.grab_data('pupil.1.3d', 1.)
+    >>> smooth = sf.process(unpack_data_numpy(data, 'diameter'))
+
+    """
+
+    def __init__(
+        self, filt_order: int = 3, cutoff_freq: float = 0.01
+    ) -> None:
+        """Design the filter.
+
+        Parameters
+        ----------
+        filt_order : int, optional
+            Order of the filter. The default is 3.
+        cutoff_freq : float, optional
+            Normalised cut-off frequency. For 4 Hz cut-off, this should be
+            4/(sample_rate/2). The default is .01.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.sos = _butter_sos(filt_order, cutoff_freq)
+        self.zi = None
+        self._last = None
+
+    def reset(self) -> None:
+        """Forget the filter state."""
+        self.zi = None
+        self._last = None
+
+    def process(self, chunk: np.ndarray) -> np.ndarray:
+        """Filter the next chunk of samples.
+
+        Parameters
+        ----------
+        chunk : array-like
+            Samples, either 1-D or 2-D (samples x channels). The number of
+            channels must not change between calls.
+
+        Returns
+        -------
+        out : np.ndarray
+            Filtered samples, the same shape as `chunk`.
+
+        """
+        x = np.array(chunk, dtype="float")
+        if x.shape[0] == 0:
+            return x
+        x = self._hold_last(x)
+        start = 0
+        if self.zi is None:
+            # start in steady state with the first valid sample
+            valid = ~np.isnan(x.reshape(len(x), -1)).any(axis=1)
+            if not valid.any():
+                return x
+            start = int(np.argmax(valid))
+            zi = signal.sosfilt_zi(self.sos)
+            self.zi = zi.reshape(zi.shape + (1,) * (x.ndim - 1)) * x[start]
+        out = np.full(x.shape, np.nan)
+        out[start:], self.zi = signal.sosfilt(
+            self.sos, x[start:], axis=0, zi=self.zi
+        )
+        self._last = x[-1]
+        return out
+
+    def _hold_last(self, x: np.ndarray) -> np.ndarray:
+        """Replace NaNs with the last valid sample, which would otherwise
+        poison the filter state.
+
+        """
+        nans = np.isnan(x)
+        if not nans.any():
+            return x
+        x2, nans2 = x.reshape(len(x), -1), nans.reshape(len(x), -1)
+        idx = np.where(nans2, -1, np.arange(len(x))[:, None])
+        idx = np.maximum.accumulate(idx, axis=0)
+        held = np.take_along_axis(x2, np.maximum(idx, 0), axis=0)
+        last = np.nan if self._last is None else np.ravel(self._last)
+        return np.where(idx < 0, last, held).reshape(x.shape)
+
+    def group_delay(self, freq: float = 0.0) -> float:
+        """Group delay of the filter in samples at a normalised frequency.
+
+        Parameters
+        ----------
+        freq : float, optional
+            Normalised frequency (1 is Nyquist). The default is 0.0.
+
+        Returns
+        -------
+        delay : float
+            Delay in samples.
+
+        """
+        b, a = signal.sos2tf(self.sos)
+        _, gd = signal.group_delay((b, a), w=[freq * np.pi])
+        return float(gd[0])
+
+
+class BlockFilter:
+    """Zero-phase Butterworth filter for long series processed in blocks.
+
+    Each block is filtered forwards and backwards together with `overlap`
+    samples of context on either side, so that the result matches
+    ``scipy.signal.sosfiltfilt`` over the whole series to within the
+    tolerance implied by `overlap`. Because the backward pass needs future
+    samples, output lags input by `overlap` samples; call ``.flush()`` after
+    the last block to get the remainder.
+
+    """
+
+    def __init__(
+        self,
+        filt_order: int = 3,
+        cutoff_freq: float = 0.01,
+        overlap: int = None,
+    ) -> None:
+        """Design the filter.
+
+        Parameters
+        ----------
+        filt_order : int, optional
+            Order of the filter. The default is 3.
+        cutoff_freq : float, optional
+            Normalised cut-off frequency. The default is .01.
+        overlap : int, optional
+            Samples of context kept on each side of a block. The default is
+            None, which uses the length of the filter's impulse response
+            (to 1e-6 of its peak). A shorter overlap uses less memory, but
+            the result no longer matches zero-phase filtering of the whole
+            series, so a warning is given.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.sos = _butter_sos(filt_order, cutoff_freq)
+        settling = _settling_length(self.sos)
+        self.overlap = settling if overlap is None else int(overlap)
+        if self.overlap < 0:
+            raise ValueError("overlap must not be negative")
+        if self.overlap < settling:
+            warnings.warn(
+                "overlap={} is shorter than the filter's impulse response "
+                "({} samples), so blocks will not match sosfiltfilt over "
+                "the whole series".format(self.overlap, settling),
+                stacklevel=2,
+            )
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget any buffered samples."""
+        self._context = None
+        self._pending = None
+
+    def _filter(self, x: np.ndarray) -> np.ndarray:
+        # same edge padding as sosfiltfilt, unless the buffer is too short
+        padlen = _sosfiltfilt_padlen(self.sos)
+        return signal.sosfiltfilt(
+            self.sos, x, axis=0, padlen=min(len(x) - 1, padlen)
+        )
+
+    def process(self, chunk: np.ndarray) -> np.ndarray:
+        """Pass in the next block and get back the samples that are final.
+
+        Parameters
+        ----------
+        chunk : array-like
+            Samples, either 1-D or 2-D (samples x channels).
+
+        Returns
+        -------
+        out : np.ndarray
+            Filtered samples. Fewer than were passed in (possibly none) until
+            the buffer holds more than `overlap` samples.
+
+        """
+        x = np.asarray(chunk, dtype="float")
+        if self._pending is None:
+            self._pending = x[:0]
+            self._context = x[:0]
+        pending = np.concatenate([self._pending, x])
+        n_ready = len(pending) - self.overlap
+        if n_ready <= 0:
+            self._pending = pending
+            return x[:0]
+        buf = np.concatenate([self._context, pending])
+        out = self._filter(buf)[len(self._context) :][:n_ready]
+        # the `overlap` samples before the pending ones (none if 0)
+        end = len(buf) - self.overlap
+        self._context = buf[max(end - self.overlap, 0) : end]
+        self._pending = pending[n_ready:]
+        return out
+
+    def flush(self) -> np.ndarray:
+        """Filter and return whatever is left in the buffer."""
+        if self._pending is None or len(self._pending) == 0:
+            self.reset()
+            return np.empty(0)
+        buf = np.concatenate([self._context, self._pending])
+        out = self._filter(buf)[len(self._context) :]
+        self.reset()
+        return out
+
+
+def blockwise_filtfilt(
+    x: np.ndarray,
+    filt_order: int = 3,
+    cutoff_freq: float = 0.01,
+    block_size: int = 100000,
+    overlap: int = None,
+) -> np.ndarray:
+    """Zero-phase Butterworth filter a long series one block at a time.
+
+    See ``BlockFilter``.
+
+    Parameters
+    ----------
+    x : array-like
+        Samples, either 1-D or 2-D (samples x channels).
+    filt_order : int, optional
+        Order of the filter. The default is 3.
+    cutoff_freq : float, optional
+        Normalised cut-off frequency. The default is .01.
+    block_size : int, optional
+        Number of samples per block. The default is 100000.
+    overlap : int, optional
+        Samples of context on each side of a block. The default is None
+        (see ``BlockFilter``).
+
+    Returns
+    -------
+    out : np.ndarray
+        Filtered samples.
+
+    """
+    bf = BlockFilter(filt_order, cutoff_freq, overlap)
+    x = np.asarray(x, dtype="float")
+    out = [
+        bf.process(x[i : i + block_size])
+        for i in range(0, len(x), block_size)
+    ]
+    out.append(bf.flush().reshape((-1,) + x.shape[1:]))
+    return np.concatenate(out)
+
+
 def rolling_mean_series(
-    samples, window_size, fields=["diameter"], inplace=False
+    samples, window_size, fields=["diameter"], inplace=False, center=False
 ):
-    """Smoothes the data with a rolling mean."""
+    """Smoothes the data with a rolling mean.
+
+    The window trails each sample unless `center` is True.
+    """
     samps = samples if inplace else samples.copy(deep=True)
     for f in fields:
-        samps[f] = samps[f].rolling(window_size).mean()
+        mean = samps[f].rolling(window_size, center=center).mean()
+        # keep float32 columns compact, but never truncate means to integers
+        if np.issubdtype(samps[f].dtype, np.floating):
+            mean = mean.astype(samps[f].dtype)
+        samps[f] = mean
+    return samps
+
+
+def _rolling_median(
+    values: pd.DataFrame, window_size: int, min_periods: int = None
+) -> np.ndarray:
+    """Centred, NaN-aware rolling median of each column.
+
+    pandas keeps each window in a skiplist, so this is O(N log w) per
+    column. NaN samples are ignored within windows, but stay NaN.
+
+    """
+    if window_size < 1 or window_size % 2 == 0:
+        raise ValueError("window_size must be a positive odd number")
+    med = (
+        values.rolling(window_size, center=True, min_periods=min_periods or 1)
+        .median()
+        .to_numpy()
+    )
+    med[values.isna().to_numpy()] = np.nan
+    return med
+
+
+def rolling_median_series(
+    samples: pd.DataFrame,
+    window_size: int = 5,
+    fields: List[str] = ["diameter"],
+    min_periods: int = None,
+    inplace: bool = False,
+) -> pd.DataFrame:
+    """Smoothes the data with a centred rolling median.
+
+    Parameters
+    ----------
+    samples : pandas.DataFrame
+        The samples.
+    window_size : int, optional
+        Length of the window in samples. Must be odd. The default is 5.
+    fields : list, optional
+        Columns to smooth. The default is ['diameter'].
+    min_periods : int, optional
+        Minimum number of valid samples in a window for a result, otherwise
+        NaN. The default is None (1).
+    inplace : bool, optional
+        Whether to modify `samples` rather than a copy. The default is
+        False.
+
+    Returns
+    -------
+    samps : pandas.DataFrame
+        The samples.
+
+    """
+    samps = samples if inplace else samples.copy(deep=True)
+    samps[fields] = _rolling_median(
+        samps[fields], window_size, min_periods
+    ).astype(_float_dtype(samps, fields), copy=False)
+    return samps
+
+
+def hampel_series(
+    samples: pd.DataFrame,
+    window_size: int = 7,
+    n_sigmas: float = 3.0,
+    fields: List[str] = ["diameter"],
+    replace: str = "median",
+    inplace: bool = False,
+) -> pd.DataFrame:
+    """Remove spikes with a Hampel filter.
+
+    A sample is an outlier if it is more than `n_sigmas` robust standard
+    deviations from the centred rolling median. The robust standard
+    deviation is 1.4826 times the rolling median of each sample's absolute
+    deviation from its own rolling median. Both medians are O(N log w), and
+    all fields are done at once.
+
+    Parameters
+    ----------
+    samples : pandas.DataFrame
+        The samples.
+    window_size : int, optional
+        Length of the window in samples. Must be odd. The default is 7.
+    n_sigmas : float, optional
+        Threshold in robust standard deviations. The default is 3.0.
+    fields : list, optional
+        Columns to despike. The default is ['diameter'].
+    replace : str, optional
+        Replace outliers with the rolling 'median', or with 'nan' so they
+        can be interpolated later. The default is 'median'.
+    inplace : bool, optional
+        Whether to modify `samples` rather than a copy. The default is
+        False.
+
+    Returns
+    -------
+    samps : pandas.DataFrame
+        The samples.
+
+    """
+    if replace not in ("median", "nan"):
+        raise ValueError('replace must be "median" or "nan"')
+    samps = samples if inplace else samples.copy(deep=True)
+    values = samps[fields]
+    med = _rolling_median(values, window_size)
+    dev = np.abs(values.to_numpy() - med)
+    mad = _rolling_median(pd.DataFrame(dev), window_size)
+    with np.errstate(invalid="ignore"):
+        outliers = dev > n_sigmas * 1.4826 * mad
+    out = values.to_numpy(dtype=_float_dtype(samps, fields))
+    out[outliers] = med[outliers] if replace == "median" else np.nan
+    samps[fields] = out
+    print(
+        "{} outliers ({:.3f} %) replaced by the Hampel filter".format(
+            outliers.sum(), outliers.mean() * 100 if out.size else 0
+        )
+    )
     return samps
 
 
@@ -457,9 +1821,14 @@ def savgol_series(
     """
     Applies a savitsky-golay filter to the given fields
     See documentation on scipys savgol_filter method FMI.
+
+    As with ``butterworth_series(...)``, all fields are filtered at once and
+    each run of samples without NaN is filtered separately.
     """
     samps = samples if inplace else samples.copy(deep=True)
-    samps[fields] = samps[fields].apply(
-        lambda x: signal.savgol_filter(x, window_length, filt_order), axis=0
-    )
+    samps[fields] = _filter_segments(
+        samps[fields].to_numpy(dtype=_float_dtype(samps, fields)),
+        lambda x: signal.savgol_filter(x, window_length, filt_order, axis=0),
+        min_length=window_length,
+    )[0]
     return samps
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pyplr.recording
+===============
+
+A handle on one Pupil Labs recording that loads its data on first use and
+keeps it.
+
+``Recording`` loads samples, events and blinks the first time they are
+accessed, from a Pupil Player export if there is one and otherwise straight
+from the '.pldata' files (see ``pyplr.pldata``). Derived products (e.g.,
+preprocessed samples or epochs) are computed with ``.derive(...)``.
+Everything is memoised in memory and also saved to a cache directory in the
+output folder, keyed by a fingerprint of the source files, the parameters
+and (for derived products) the code of the function. A rerun, or another
+process working on the same recording, loads the saved result instead of
+repeating the work, until any of these changes.
+
+Example
+-------
+>>> rec = Recording(rec_dir, load_kwargs={'cols': ['diameter_3d']})
+>>> clean = rec.derive('clean', preprocess, cutoff_freq=.05)
+>>> rec.timings
+              source   seconds
+name
+samples     computed  1.463201
+blinks      computed  0.011542
+clean       computed  0.842071
+
+"""
+
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+from time import perf_counter
+from typing import Any, Callable, Dict
+
+import pandas as pd
+
+from pyplr import cache, pldata, utils
+
+
+def _code_fingerprint(code) -> str:
+    """Hash of a code object's bytecode, names and constants, including
+    those of nested functions, lambdas and comprehensions.
+
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if code is None:
+        return h.hexdigest()
+    h.update(code.co_code)
+    h.update(repr((code.co_names, code.co_varnames)).encode())
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            h.update(_code_fingerprint(const).encode())
+        else:
+            h.update(repr(const).encode())
+    return h.hexdigest()
+
+
+class Recording:
+    """Lazily loaded, memoised data for one recording."""
+
+    def __init__(
+        self,
+        rec_dir: str,
+        export: str = "000",
+        out_dir_nm: str = "pyplr_analysis",
+        load_kwargs: Dict[str, Any] = None,
+    ) -> None:
+        """Get a handle on a recording. Nothing is loaded yet.
+
+        Parameters
+        ----------
+        rec_dir : str
+            Pupil Labs recording directory.
+        export : str, optional
+            The export folder to read from. If it does not exist, data are
+            read from the recording itself. The default is '000'.
+        out_dir_nm : str, optional
+            Name for the folder where output (and the cache) will be saved.
+            Existing output is kept. The default is 'pyplr_analysis'.
+        load_kwargs : dict, optional
+            Keyword arguments for ``load_pupil(...)``. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not op.isdir(rec_dir):
+            raise FileNotFoundError(
+                '"{}" does not appear to exist.'.format(rec_dir)
+            )
+        self.root = op.abspath(rec_dir)
+        self.id = op.basename(op.normpath(rec_dir))
+        self.data_dir = op.join(self.root, "exports", export)
+        self.out_dir = op.join(self.root, out_dir_nm)
+        self.cache_dir = op.join(self.out_dir, ".cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.load_kwargs = dict(load_kwargs or {})
+        self.exported = op.isdir(self.data_dir)
+        self._memo = {}
+        self._timings = []
+
+    def __repr__(self) -> str:
+        return "Recording('{}', loaded={})".format(
+            self.id, list(self._memo)
+        )
+
+    def _source_files(self, name: str) -> list:
+        if self.exported:
+            fname = {
+                "samples": "pupil_positions.csv",
+                "events": "annotations.csv",
+                "blinks": "blinks.csv",
+            }[name]
+            return [op.join(self.data_dir, fname)]
+        stem = {"samples": "pupil", "events": "annotation", "blinks": "blinks"}
+        return [
+            op.join(self.root, stem[name] + ".pldata"),
+            op.join(self.root, stem[name] + "_timestamps.npy"),
+        ]
+
+    def _fingerprint(self, files: list) -> dict:
+        """Size and modification time of each existing source file."""
+        return {
+            op.basename(f): cache.fingerprint(f, content=False)
+            for f in files
+            if op.exists(f)
+        }
+
+    def _memoised(
+        self, name: str, compute: Callable[[], Any], key: dict
+    ) -> Any:
+        """Return `name` from memory or from the cache directory if its key
+        matches, or else compute and save it.
+
+        """
+        t0 = perf_counter()
+        key = json.loads(json.dumps(key, default=repr))
+        if name in self._memo and self._memo[name][0] == key:
+            source = "memory"
+        else:
+            data_fname = op.join(self.cache_dir, name + ".pkl")
+            key_fname = op.join(self.cache_dir, name + ".json")
+            try:
+                with open(key_fname) as f:
+                    stored = json.load(f)
+            except (FileNotFoundError, ValueError):
+                stored = None
+            if stored == key and op.exists(data_fname):
+                self._memo[name] = (key, pd.read_pickle(data_fname))
+                source = "disk"
+            else:
+                value = compute()
+                self._memo[name] = (key, value)
+                tmp = ".{}.tmp".format(os.getpid())
+                pd.to_pickle(value, data_fname + tmp)
+                os.replace(data_fname + tmp, data_fname)
+                with open(key_fname + tmp, "w") as f:
+                    json.dump(key, f)
+                os.replace(key_fname + tmp, key_fname)
+                source = "computed"
+        self._timings.append(
+            {"name": name, "source": source, "seconds": perf_counter() - t0}
+        )
+        return self._memo[name][1]
+
+    def _load(self, name: str) -> Any:
+        if self.exported:
+            func = {
+                "samples": utils.load_pupil,
+                "events": utils.load_annotations,
+                "blinks": utils.load_blinks,
+            }[name]
+            where = self.data_dir
+        else:
+            func = {
+                "samples": pldata.load_pupil,
+                "events": pldata.load_annotations,
+                "blinks": pldata.load_blinks,
+            }[name]
+            where = self.root
+        kwargs = self.load_kwargs if name == "samples" else {}
+        key = {
+            "sources": self._fingerprint(self._source_files(name)),
+            "loader": "{}.{}".format(func.__module__, func.__name__),
+            "params": kwargs,
+        }
+        return self._memoised(name, lambda: func(where, **kwargs), key)
+
+    @property
+    def samples(self) -> pd.DataFrame:
+        """Pupil samples, as from ``utils.load_pupil(...)``."""
+        return self._load("samples")
+
+    @property
+    def events(self) -> pd.DataFrame:
+        """Annotations, as from ``utils.load_annotations(...)``."""
+        return self._load("events")
+
+    @property
+    def blinks(self) -> pd.DataFrame:
+        """Blinks, as from ``utils.load_blinks(...)``."""
+        return self._load("blinks")
+
+    def derive(self, name: str, func: Callable[..., Any], **params) -> Any:
+        """Compute (or load) a product derived from this recording.
+
+        Parameters
+        ----------
+        name : str
+            Name of the product, used for the cache file.
+        func : callable
+            Called as ``func(recording, **params)``. It should only use data
+            from this recording (e.g., ``recording.samples``) and its
+            `params`, since the cache is invalidated when the source files,
+            `params` or the code of `func` change, but not otherwise.
+            Only the code of `func` itself is tracked, so changes to the
+            functions it calls do not invalidate the cache (use
+            ``.clear_cache(name)``).
+        **params : dict
+            Parameters for `func`.
+
+        Returns
+        -------
+        product
+            Whatever `func` returns. It must be picklable.
+
+        """
+        if name in ("samples", "events", "blinks"):
+            raise ValueError('"{}" is a reserved name'.format(name))
+        files = sum(
+            (self._source_files(n) for n in ("samples", "events", "blinks")),
+            [],
+        )
+        key = {
+            "sources": self._fingerprint(files),
+            "func": "{}.{}".format(
+                getattr(func, "__module__", ""),
+                getattr(func, "__qualname__", repr(func)),
+            ),
+            "code": _code_fingerprint(getattr(func, "__code__", None)),
+            "params": params,
+            "load_kwargs": self.load_kwargs,
+        }
+        return self._memoised(name, lambda: func(self, **params), key)
+
+    @property
+    def timings(self) -> pd.DataFrame:
+        """Where each access was served from ('memory', 'disk' or
+        'computed') and how long it took.
+
+        """
+        return pd.DataFrame(
+            self._timings, columns=["name", "source", "seconds"]
+        ).set_index("name")
+
+    def clear_cache(self, name: str = None) -> None:
+        """Forget and delete one cached product, or all of them."""
+        if name is None:
+            self._memo.clear()
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            return
+        self._memo.pop(name, None)
+        for ext in (".pkl", ".json"):
+            fname = op.join(self.cache_dir, name + ext)
+            if op.exists(fname):
+                os.remove(fname)
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pyplr.store
+===========
+
+An append-only, on-disk store of epochs from many subjects.
+
+Each call to ``EpochStore.append(...)`` writes one chunk: the
+(events x time x channels) array as a '.npy' file and its event metadata as
+a '.json' file. Chunk names are unique, and the metadata file is renamed
+into place last, so several processes can append to the same store at once
+and readers only ever see complete chunks. With ``replace=True``, a
+subject's earlier chunks are deleted (metadata first) once the new one is in
+place, so that rerunning an analysis for a subject does not add a second
+copy of their epochs.
+
+Reading is lazy. The metadata of all chunks is small and is loaded as one
+table, while the arrays are memory-mapped, so selecting by subject,
+condition or time window only reads the epochs and samples needed. Group
+statistics are accumulated one chunk at a time, so the data for a whole
+study never has to be in memory at once.
+
+Example
+-------
+>>> store = EpochStore('study/epochs')
+>>> store.append('sub01', epochs, replace=True)  # an EpochSet per subject
+>>> red = store.select(color='red', start=-0.5, stop=5.)
+>>> means = store.mean(by=['subject', 'color'], channels=['diameter_3d'])
+
+"""
+
+import glob
+import json
+import os
+import os.path as op
+import uuid
+from typing import Iterator, List, Union
+
+import numpy as np
+import pandas as pd
+
+from pyplr.epochs import EpochSet, _group_codes
+
+
+class EpochStore:
+    """A directory of epoch chunks sharing the same channels and times."""
+
+    def __init__(self, root: str) -> None:
+        """Open (or create) a store.
+
+        Parameters
+        ----------
+        root : str
+            Directory of the store. Created if it does not exist.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.root = root
+        os.makedirs(op.join(root, "chunks"), exist_ok=True)
+        self._layout = None
+        self._events = None
+
+    def __repr__(self) -> str:
+        return "EpochStore('{}', {} chunks)".format(
+            self.root, len(self._chunk_ids())
+        )
+
+    def _chunk_ids(self) -> List[str]:
+        """Complete chunks, in name order."""
+        fnames = glob.glob(op.join(self.root, "chunks", "*.json"))
+        return sorted(op.basename(f)[: -len(".json")] for f in fnames)
+
+    def _chunk_path(self, chunk_id: str, ext: str) -> str:
+        return op.join(self.root, "chunks", chunk_id + ext)
+
+    @property
+    def layout(self) -> dict:
+        """Channels, times and dtype shared by all chunks, or None if the
+        store is empty.
+
+        """
+        if self._layout is None:
+            try:
+                with open(op.join(self.root, "layout.json")) as f:
+                    self._layout = json.load(f)
+            except FileNotFoundError:
+                return None
+        return self._layout
+
+    @property
+    def channels(self) -> List[str]:
+        return self.layout["channels"]
+
+    @property
+    def times(self) -> np.ndarray:
+        return np.asarray(self.layout["times"])
+
+    def _check_layout(self, epochs: EpochSet) -> None:
+        """Write the layout for the first chunk, or check that `epochs`
+        matches it.
+
+        The layout is written in full under a temporary name and then linked
+        into place, which fails if another writer got there first, so
+        readers never see a partial file.
+
+        """
+        layout = {
+            "channels": list(epochs.channels),
+            "times": np.asarray(epochs.times).tolist(),
+            "dtype": epochs.data.dtype.str,
+        }
+        fname = op.join(self.root, "layout.json")
+        if not op.exists(fname):
+            tmp = "{}.{}.tmp".format(fname, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(layout, f)
+            try:
+                os.link(tmp, fname)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp)
+        self._layout = None
+        existing = self.layout
+        if existing["channels"] != layout["channels"]:
+            raise ValueError("Channels must match the store")
+        if len(existing["times"]) != len(layout["times"]) or not np.allclose(
+            existing["times"], layout["times"]
+        ):
+            raise ValueError("Times must match the store")
+        if existing["dtype"] != layout["dtype"]:
+            raise ValueError("dtype must match the store")
+
+    def _subject_chunks(self, subject: str) -> List[str]:
+        return [
+            c for c in self._chunk_ids() if c.rsplit("-", 1)[0] == subject
+        ]
+
+    def _remove_chunks(self, chunk_ids: List[str]) -> None:
+        for chunk_id in chunk_ids:
+            # the chunk is gone for readers once its metadata is
+            for ext in (".json", ".npy"):
+                try:
+                    os.remove(self._chunk_path(chunk_id, ext))
+                except FileNotFoundError:
+                    pass
+        self._events = None
+
+    def remove(self, subject: str) -> int:
+        """Delete all chunks of a subject.
+
+        Parameters
+        ----------
+        subject : str
+            Subject identifier, as passed to ``.append(...)``.
+
+        Returns
+        -------
+        n_chunks : int
+            Number of chunks deleted.
+
+        """
+        chunk_ids = self._subject_chunks(subject)
+        self._remove_chunks(chunk_ids)
+        return len(chunk_ids)
+
+    def append(
+        self, subject: str, epochs: EpochSet, replace: bool = False
+    ) -> str:
+        """Add epochs as a new chunk.
+
+        Parameters
+        ----------
+        subject : str
+            Subject identifier, stored in a 'subject' event column.
+        epochs : EpochSet
+            The epochs. Channels and times must match the rest of the store.
+        replace : bool, optional
+            Whether to delete the subject's existing chunks once the new one
+            is in place, so that rerunning an analysis does not add a second
+            copy. The default is False.
+
+        Returns
+        -------
+        chunk_id : str
+            Name of the new chunk.
+
+        """
+        if len(epochs) == 0:
+            raise ValueError("No epochs to append")
+        self._check_layout(epochs)
+        old = self._subject_chunks(subject) if replace else []
+        chunk_id = "{}-{}".format(subject, uuid.uuid4().hex)
+        tmp = ".{}.tmp".format(os.getpid())
+        data_fname = self._chunk_path(chunk_id, ".npy")
+        with open(data_fname + tmp, "wb") as f:
+            np.save(f, np.ascontiguousarray(epochs.data))
+        os.replace(data_fname + tmp, data_fname)
+        events = epochs.events.assign(subject=subject)
+        events_fname = self._chunk_path(chunk_id, ".json")
+        events.to_json(events_fname + tmp, orient="table", index=False)
+        # the chunk exists once its metadata does
+        os.replace(events_fname + tmp, events_fname)
+        self._remove_chunks(old)
+        self._events = None
+        return chunk_id
+
+    @property
+    def events(self) -> pd.DataFrame:
+        """Metadata of every stored epoch, with the '_chunk' and '_row'
+        holding it.
+
+        """
+        if self._events is None:
+            frames = []
+            for chunk_id in self._chunk_ids():
+                events = pd.read_json(
+                    self._chunk_path(chunk_id, ".json"), orient="table"
+                )
+                frames.append(
+                    events.assign(_chunk=chunk_id, _row=np.arange(len(events)))
+                )
+            self._events = (
+                pd.concat(frames, ignore_index=True)
+                if frames
+                else pd.DataFrame(columns=["subject", "_chunk", "_row"])
+            )
+        return self._events
+
+    def refresh(self) -> None:
+        """Pick up chunks appended by other processes."""
+        self._events = None
+        self._layout = None
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def _select_events(
+        self, subjects: Union[str, List[str]], query: str, criteria: dict
+    ) -> pd.DataFrame:
+        events = self.events
+        keep = np.ones(len(events), dtype="bool")
+        if subjects is not None:
+            criteria = dict(criteria, subject=subjects)
+        if query is not None:
+            keep &= events.eval(query).to_numpy(dtype="bool")
+        for col, val in criteria.items():
+            vals = val if isinstance(val, (list, tuple, set)) else [val]
+            keep &= events[col].isin(vals).to_numpy()
+        return events[keep]
+
+    def _slices(self, start: float, stop: float, channels: List[str]):
+        """Time slice and channel positions for a selection."""
+        times = self.times
+        lo, hi = 0, len(times)
+        if start is not None:
+            lo = np.searchsorted(times, start, "left")
+        if stop is not None:
+            hi = np.searchsorted(times, stop, "left")
+        if lo == hi:
+            raise ValueError("No samples in window")
+        channels = self.channels if channels is None else list(channels)
+        idxs = [self.channels.index(c) for c in channels]
+        return slice(lo, hi), idxs, channels
+
+    def _iter_selected(self, events, window, idxs) -> Iterator[tuple]:
+        """(events, data) for the selected epochs, one chunk at a time."""
+        for chunk_id, rows in events.groupby("_chunk", sort=True):
+            data = np.load(self._chunk_path(chunk_id, ".npy"), mmap_mode="r")
+            # only the selected epochs and samples are read from disk
+            rows = rows.sort_values("_row")
+            block = data[rows["_row"].to_numpy(), window][..., idxs]
+            yield rows, np.asarray(block)
+
+    def iter_chunks(
+        self,
+        subjects: Union[str, List[str]] = None,
+        query: str = None,
+        start: float = None,
+        stop: float = None,
+        channels: List[str] = None,
+        **criteria
+    ) -> Iterator[EpochSet]:
+        """Yield the selected epochs one chunk at a time.
+
+        Takes the same arguments as ``.select(...)``.
+
+        """
+        events = self._select_events(subjects, query, criteria)
+        window, idxs, channels = self._slices(start, stop, channels)
+        times = self.times[window]
+        for rows, block in self._iter_selected(events, window, idxs):
+            yield EpochSet(
+                block, rows.drop(columns=["_chunk", "_row"]), channels, times
+            )
+
+    def select(
+        self,
+        subjects: Union[str, List[str]] = None,
+        query: str = None,
+        start: float = None,
+        stop: float = None,
+        channels: List[str] = None,
+        **criteria
+    ) -> EpochSet:
+        """Load the selected epochs.
+
+        Parameters
+        ----------
+        subjects : str or list, optional
+            Subject(s) to select. The default is None (all).
+        query : str, optional
+            Passed to ``pandas.DataFrame.query`` on ``.events``.
+        start, stop : float, optional
+            Time window to load (start <= time < stop). The default is None
+            (all times).
+        channels : list, optional
+            Channels to load. The default is None (all).
+        **criteria : dict
+            Column=value pairs (or column=list of values) to match.
+
+        Returns
+        -------
+        epochs : EpochSet
+
+        """
+        events = self._select_events(subjects, query, criteria)
+        window, idxs, channels = self._slices(start, stop, channels)
+        parts = list(self._iter_selected(events, window, idxs))
+        if not parts:
+            raise ValueError("No epochs selected")
+        return EpochSet(
+            np.concatenate([block for _, block in parts]),
+            pd.concat([rows for rows, _ in parts], ignore_index=True).drop(
+                columns=["_chunk", "_row"]
+            ),
+            channels,
+            self.times[window],
+        )
+
+    def _stream_stats(self, by, subjects, query, start, stop, channels, kw):
+        events = self._select_events(subjects, query, kw)
+        if events.empty:
+            raise ValueError("No epochs selected")
+        window, idxs, channels = self._slices(start, stop, channels)
+        codes, groups = _group_codes(events, by)
+        codes = pd.Series(codes, index=events.index)
+        shape = (len(groups), window.stop - window.start, len(idxs))
+        n, s, ss = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+        for rows, block in self._iter_selected(events, window, idxs):
+            valid = ~np.isnan(block)
+            x = np.where(valid, block, 0.0).astype("float")
+            chunk_codes = codes[rows.index].to_numpy()
+            for g in np.unique(chunk_codes):
+                mask = chunk_codes == g
+                n[g] += valid[mask].sum(axis=0)
+                s[g] += x[mask].sum(axis=0)
+                ss[g] += (x[mask] * x[mask]).sum(axis=0)
+        groups["n"] = np.bincount(codes, minlength=len(groups))
+        return groups, n, s, ss, channels, self.times[window]
+
+    def mean(
+        self,
+        by: Union[str, List[str]] = None,
+        subjects: Union[str, List[str]] = None,
+        query: str = None,
+        start: float = None,
+        stop: float = None,
+        channels: List[str] = None,
+        **criteria
+    ) -> EpochSet:
+        """NaN-aware mean of the selected epochs in each condition,
+        accumulated one chunk at a time.
+
+        Parameters
+        ----------
+        by : str or list, optional
+            Event column(s) defining conditions (e.g., ['subject', 'color']).
+            The default is None (grand average).
+        subjects, query, start, stop, channels, **criteria
+            Selection, as for ``.select(...)``.
+
+        Returns
+        -------
+        means : EpochSet
+            As from ``EpochSet.mean(...)``.
+
+        """
+        groups, n, s, _, channels, times = self._stream_stats(
+            by, subjects, query, start, stop, channels, criteria
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return EpochSet(s / n, groups, channels, times)
+
+    def sem(
+        self,
+        by: Union[str, List[str]] = None,
+        subjects: Union[str, List[str]] = None,
+        query: str = None,
+        start: float = None,
+        stop: float = None,
+        channels: List[str] = None,
+        **criteria
+    ) -> EpochSet:
+        """NaN-aware standard error of the mean in each condition,
+        accumulated one chunk at a time.
+
+        Takes the same arguments as ``.mean(...)``.
+
+        """
+        groups, n, s, ss, channels, times = self._stream_stats(
+            by, subjects, query, start, stop, channels, criteria
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var = (ss - s * s / n) / (n - 1)
+            sem = np.sqrt(np.clip(var, 0, None) / n)
+        return EpochSet(sem, groups, channels, times)
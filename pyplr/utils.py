@@ -13,15 +13,29 @@ Scripting tools for working with pupil data.
 import os
 import os.path as op
 import shutil
-from copy import deepcopy
-from typing import List
+from concurrent import futures
+from time import perf_counter
+from typing import List, Tuple, Union
 
 import numpy as np
 import pandas as pd
 
+from pyplr import cache as _cache
+from pyplr import kernels
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
 
 def new_subject(
-    rec_dir: str, export: str = "000", out_dir_nm: str = "pyplr_analysis"
+    rec_dir: str,
+    export: str = "000",
+    out_dir_nm: str = "pyplr_analysis",
+    overwrite: bool = True,
 ) -> dict:
     """Get a handle on a new subject for data analysis.
 
@@ -35,6 +49,10 @@ def new_subject(
     out_dir_nm : str, optional
         Name for the folder where output will be saved. The default is
         'pyplr_analysis'.
+    overwrite : bool, optional
+        Whether to delete any existing output folder and start afresh. If
+        False, existing output is kept. The default is True. See also
+        ``recording.Recording``, which keeps previous results.
 
     Raises
     ------
@@ -55,9 +73,9 @@ def new_subject(
     identifier = op.basename(rec_dir)
     data_dir = op.abspath(op.join(rec_dir, "exports", "", export, ""))
     out_dir = op.abspath(op.join(rec_dir, out_dir_nm, ""))
-    if os.path.exists(out_dir):
+    if overwrite and os.path.exists(out_dir):
         shutil.rmtree(out_dir)
-    os.mkdir(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
     print("{}\n{:*^60s}\n{}".format("*" * 60, " " + identifier + " ", "*" * 60))
     return {
         "root": root,
@@ -84,29 +102,260 @@ def print_file_structure(rec_dir: str) -> None:
             print(f"{subindent}{f}")
 
 
+# schema of pupil_positions.csv, as exported by Pupil Player. Columns not
+# listed here are inferred.
+PUPIL_DTYPES = {
+    "pupil_timestamp": "float64",
+    "world_index": "int64",
+    "eye_id": "int64",
+    "confidence": "float64",
+    "norm_pos_x": "float64",
+    "norm_pos_y": "float64",
+    "diameter": "float64",
+    "method": "object",
+    "ellipse_center_x": "float64",
+    "ellipse_center_y": "float64",
+    "ellipse_axis_a": "float64",
+    "ellipse_axis_b": "float64",
+    "ellipse_angle": "float64",
+    "diameter_3d": "float64",
+    "model_confidence": "float64",
+    "model_id": "float64",
+    "sphere_center_x": "float64",
+    "sphere_center_y": "float64",
+    "sphere_center_z": "float64",
+    "sphere_radius": "float64",
+    "circle_3d_center_x": "float64",
+    "circle_3d_center_y": "float64",
+    "circle_3d_center_z": "float64",
+    "circle_3d_normal_x": "float64",
+    "circle_3d_normal_y": "float64",
+    "circle_3d_normal_z": "float64",
+    "circle_3d_radius": "float64",
+    "theta": "float64",
+    "phi": "float64",
+    "projected_sphere_center_x": "float64",
+    "projected_sphere_center_y": "float64",
+    "projected_sphere_axis_a": "float64",
+    "projected_sphere_axis_b": "float64",
+    "projected_sphere_angle": "float64",
+}
+
+# columns loaded by default, which are all that preprocessing needs
+PUPIL_COLS = [
+    "pupil_timestamp",
+    "eye_id",
+    "method",
+    "confidence",
+    "diameter",
+    "diameter_3d",
+]
+
+# dtypes for compact loading; other columns of pupil_positions.csv are
+# float32, apart from the timestamps, which need float64 precision
+COMPACT_DTYPES = {
+    "pupil_timestamp": "float64",
+    "world_index": "int32",
+    "eye_id": "int8",
+    "method": "category",
+}
+
+# rows per block when filtering with the default (C) parser
+_CSV_CHUNKSIZE = 500000
+
+
+def _pupil_schema(header: List[str], compact: bool) -> dict:
+    """dtype of each column in `header`."""
+    if compact:
+        return {c: COMPACT_DTYPES.get(c, "float32") for c in header}
+    return {c: PUPIL_DTYPES[c] for c in header if c in PUPIL_DTYPES}
+
+
+def _eye_code(eye_id: str) -> int:
+    """eye_id of a single eye, or None for 'best' and 'both'."""
+    eye = {"left": 1, "right": 0}.get(eye_id)
+    if eye is None and eye_id not in ("best", "both"):
+        raise ValueError('Eye must be "left", "right", "best" or "both".')
+    return eye
+
+
+def _pupil_usecols(header: List[str], cols: Union[List[str], str]) -> list:
+    """Columns to load, in file order, including those needed to filter
+    rows.
+
+    """
+    if cols is None:
+        cols = [c for c in PUPIL_COLS if c in header]
+    elif cols == "all":
+        cols = header
+    needed = {"pupil_timestamp", "eye_id", "method", "confidence"}
+    return [c for c in header if c in needed or c in cols]
+
+
+def _finish_pupil(
+    samples: pd.DataFrame, usecols: List[str], compact: bool, eye_id: str
+) -> pd.DataFrame:
+    """Apply the schema, index by timestamp and choose the eye."""
+    schema = _pupil_schema(usecols, compact)
+    samples = samples[usecols].astype(schema).set_index("pupil_timestamp")
+    if compact:
+        # same (sorted) categories whichever reader was used
+        methods = samples["method"]
+        samples["method"] = methods.cat.set_categories(
+            sorted(methods.unique())
+        )
+    if eye_id == "best":
+        best = samples.groupby("eye_id")["confidence"].mean().idxmax()
+        samples = samples[samples.eye_id == best]
+    elif eye_id == "both":
+        samples = samples.sort_index(kind="stable")
+    print("Loaded {} samples".format(len(samples)))
+    return samples
+
+
+def _match_method(methods: pd.Series, method: str) -> pd.Series:
+    """Rows whose detection method contains `method` (literally)."""
+    # match on the few distinct methods, not on every row
+    names = pd.Index(methods.unique(), dtype="object")
+    return methods.isin(names[names.str.contains(method, regex=False)])
+
+
+def _read_pupil_c(
+    fname: str, usecols: List[str], dtype: dict, method: str, eye: int
+) -> pd.DataFrame:
+    """Read with pandas' C parser in blocks, keeping only matching rows."""
+    # the parser is slower when told to make float64 / int64 columns than
+    # when it infers them, so only pass the narrower dtypes
+    narrow = {
+        c: d
+        for c, d in dtype.items()
+        if d not in ("float64", "int64", "object")
+    }
+    keep = []
+    reader = pd.read_csv(
+        fname, usecols=usecols, dtype=narrow, chunksize=_CSV_CHUNKSIZE
+    )
+    for chunk in reader:
+        rows = _match_method(chunk.method, method)
+        if eye is not None:
+            rows &= chunk.eye_id == eye
+        keep.append(chunk.loc[rows])
+    if not keep:
+        # a file with only a header gives no blocks at all
+        return pd.DataFrame(
+            {c: pd.Series(dtype=dtype.get(c, "float64")) for c in usecols}
+        )
+    return pd.concat(keep, ignore_index=True)
+
+
+def _filter_pupil_table(
+    table: "pa.Table", method: str, eye: int
+) -> pd.DataFrame:
+    """Keep matching rows of an Arrow table, then convert to pandas."""
+    rows = pc.match_substring(
+        table["method"].cast(pa.string()), method, ignore_case=False
+    )
+    if eye is not None:
+        rows = pc.and_(rows, pc.equal(table["eye_id"], eye))
+    return table.filter(rows).to_pandas()
+
+
+def _read_pupil_pyarrow(
+    fname: str, usecols: List[str], dtype: dict, method: str, eye: int
+) -> pd.DataFrame:
+    """Read with Arrow's multithreaded parser, and filter rows before
+    converting to pandas.
+
+    """
+    types = {
+        c: pa.from_numpy_dtype(np.dtype(d))
+        for c, d in dtype.items()
+        if d not in ("category", "object")
+    }
+    types["method"] = pa.dictionary(pa.int32(), pa.string())
+    table = pa_csv.read_csv(
+        fname,
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=usecols, column_types=types
+        ),
+    )
+    return _filter_pupil_table(table, method, eye)
+
+
+def _parse_pupil(fname: str) -> pd.DataFrame:
+    """All of 'pupil_positions.csv', for the cache.
+
+    Parsed with pandas' C parser, so that cached values are identical to
+    those from ``load_pupil(..., engine='c')``.
+
+    """
+    header = pd.read_csv(fname, nrows=0).columns.tolist()
+    return pd.read_csv(fname).astype(_pupil_schema(header, False))
+
+
+def _parse_annotations(fname: str) -> pd.DataFrame:
+    return pd.read_csv(fname, index_col="timestamp")
+
+
+def _parse_blinks(fname: str) -> pd.DataFrame:
+    return pd.read_csv(fname, index_col="id")
+
+
+# exported files that can be cached, and how to parse them
+_CACHE_PARSERS = {
+    "pupil_positions.csv": _parse_pupil,
+    "annotations.csv": _parse_annotations,
+    "blinks.csv": _parse_blinks,
+}
+
+
 def load_pupil(
     data_dir: str,
     eye_id: str = "best",
     method: str = "3d c++",
-    cols: List[str] = None,
+    cols: Union[List[str], str] = None,
+    compact: bool = False,
+    engine: str = "c",
+    cache: bool = False,
 ) -> pd.DataFrame:
     """Loads 'pupil_positions.csv' data exported from Pupil Player.
 
+    Only the requested columns are parsed, with the dtypes in
+    ``PUPIL_DTYPES`` rather than inferred ones, and rows for other methods
+    (and eyes, if one is chosen) are dropped as the file is read.
+
     Parameters
     ----------
     data_dir : str
         Directory where the Pupil Labs 'pupil_positions.csv' data exists.
     eye : str
-        Eye to load. Must be 'left' (1), 'right' (0), or 'best'. If 'best',
-        the eye with the highest average confidence will be loaded. The
-        default is None.
+        Eye to load. Must be 'left' (1), 'right' (0), 'best' or 'both'. If
+        'best', the eye with the highest average confidence will be loaded.
+        If 'both', samples from both eyes are returned in time order (see
+        ``preproc.fuse_binocular(...)``). The default is 'best'.
     method : string, optional
         Whether to load pupil data generated by the 2d or 3d fitting method.
         The default is '3d'.
-    cols : list, optional
-        Columns to load from the file (check file for options). Must include
-        ['pupil_timestap', 'method', 'confidence'] and The default is None
-        (loads all columns).
+    cols : list or str, optional
+        Columns to load from the file (check file for options). The
+        'pupil_timestamp', 'eye_id', 'method' and 'confidence' columns are
+        always loaded. If 'all', loads all columns. The default is None
+        (loads ``PUPIL_COLS``).
+    compact : bool, optional
+        Whether to load pupil data as float32, 'eye_id' as int8 and
+        'method' as categorical (see ``COMPACT_DTYPES``), which roughly
+        halves memory use. Functions in ``pyplr.preproc`` keep these
+        dtypes. The default is False.
+    engine : str, optional
+        CSV parser to use, either 'c' (pandas) or 'pyarrow' (multithreaded,
+        requires pyarrow). The two can differ in the last digit of some
+        floats, so results only reproduce exactly with the same engine. The
+        default is 'c'.
+    cache : bool, optional
+        Whether to read through the sidecar cache (see ``pyplr.cache``),
+        which requires pyarrow. The first load parses the whole file and
+        caches it; later loads read only `cols` from the cache. Values are
+        as from ``engine='c'``. The default is False.
 
     Returns
     -------
@@ -115,37 +364,38 @@ def load_pupil(
 
     """
     fname = op.join(data_dir, "", "pupil_positions.csv")
+    if engine not in ("c", "pyarrow"):
+        raise ValueError('Engine must be "c" or "pyarrow".')
+    if engine == "pyarrow" and pa is None:
+        raise ValueError("The pyarrow engine requires pyarrow")
+    eye = _eye_code(eye_id)
     try:
-        if cols is None:
-            samples = pd.read_csv(fname, index_col="pupil_timestamp")
-        else:
-            samples = pd.read_csv(
-                fname, usecols=cols, index_col="pupil_timestamp"
-            )
+        header = pd.read_csv(fname, nrows=0).columns.tolist()
     except FileNotFoundError as fnf_error:
         print(fnf_error)
+        return
+    usecols = _pupil_usecols(header, cols)
+    schema = _pupil_schema(usecols, compact)
+    if cache:
+        table = _cache.read_table(fname, _parse_pupil, usecols)
+        samples = _filter_pupil_table(table, method, eye)
+    elif engine == "pyarrow":
+        samples = _read_pupil_pyarrow(fname, usecols, schema, method, eye)
     else:
-        samples = samples.loc[samples.method.str.contains(method)]
-        if eye_id == "left":
-            samples = samples[samples.eye_id == 1]
-        elif eye_id == "right":
-            samples = samples[samples.eye_id == 0]
-        elif eye_id == "best":
-            best = samples.groupby(["eye_id"])["confidence"].mean().idxmax()
-            samples = samples[samples.eye_id == best]
-        else:
-            raise ValueError('Eye must be "left", "right" or "best".')
-        print("Loaded {} samples".format(len(samples)))
-        return samples
+        samples = _read_pupil_c(fname, usecols, schema, method, eye)
+    return _finish_pupil(samples, usecols, compact, eye_id)
 
 
-def load_annotations(data_dir: str) -> pd.DataFrame:
+def load_annotations(data_dir: str, cache: bool = False) -> pd.DataFrame:
     """Loads 'annotations' exported from Pupil Player.
 
     Parameters
     ----------
     data_dir : str
         Directory where the Pupil Labs 'annotations' data exists.
+    cache : bool, optional
+        Whether to read through the sidecar cache (see ``pyplr.cache``).
+        The default is False.
 
     Returns
     -------
@@ -155,7 +405,10 @@ def load_annotations(data_dir: str) -> pd.DataFrame:
     """
     fname = op.join(data_dir, "", "annotations.csv")
     try:
-        events = pd.read_csv(fname, index_col="timestamp")
+        if cache:
+            events = _cache.read_table(fname, _parse_annotations).to_pandas()
+        else:
+            events = _parse_annotations(fname)
         print("Loaded {} events".format(len(events)))
     except FileNotFoundError as fnf_error:
         print(fnf_error)
@@ -163,13 +416,16 @@ def load_annotations(data_dir: str) -> pd.DataFrame:
         return events
 
 
-def load_blinks(data_dir: str) -> pd.DataFrame:
+def load_blinks(data_dir: str, cache: bool = False) -> pd.DataFrame:
     """Loads 'blinks' data exported from Pupil Player.
 
     Parameters
     ----------
     data_dir : str
         Directory where the Pupil Labs 'blinks' data exists.
+    cache : bool, optional
+        Whether to read through the sidecar cache (see ``pyplr.cache``).
+        The default is False.
 
     Returns
     -------
@@ -179,7 +435,10 @@ def load_blinks(data_dir: str) -> pd.DataFrame:
     """
     fname = op.join(data_dir, "", "blinks.csv")
     try:
-        blinks = pd.read_csv(fname, index_col="id")
+        if cache:
+            blinks = _cache.read_table(fname, _parse_blinks).to_pandas()
+        else:
+            blinks = _parse_blinks(fname)
         print(
             "{} blinks detected by Pupil Labs (mean dur = {:.3f} s)".format(
                 len(blinks), blinks.duration.mean()
@@ -191,7 +450,154 @@ def load_blinks(data_dir: str) -> pd.DataFrame:
         return blinks
 
 
-# TODO: optimse and debug
+def _warm_one(fname: str) -> dict:
+    record = {"fname": fname}
+    t0 = perf_counter()
+    try:
+        if _cache.is_fresh(fname):
+            record.update(status="fresh", error="")
+        else:
+            parse = _CACHE_PARSERS[op.basename(fname)]
+            _cache.write_table(fname, parse(fname))
+            record.update(status="cached", error="")
+    except Exception as e:
+        record.update(status="failed", error=repr(e))
+    record["seconds"] = perf_counter() - t0
+    return record
+
+
+def warm_cache(root: str, n_workers: int = None) -> pd.DataFrame:
+    """Cache every Pupil Player export under `root` in parallel.
+
+    Walks `root` for 'pupil_positions.csv', 'annotations.csv' and
+    'blinks.csv' files and caches any that are not already cached (see
+    ``pyplr.cache``), one file per worker process.
+
+    Parameters
+    ----------
+    root : str
+        Study directory, e.g., containing one recording per subject.
+    n_workers : int, optional
+        Number of worker processes. The default is None (one per CPU).
+
+    Returns
+    -------
+    summary : pandas.DataFrame
+        Status ('cached', 'fresh' or 'failed'), time taken and any error
+        for each file.
+
+    """
+    fnames = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != _cache.CACHE_DIR]
+        fnames += [
+            op.join(dirpath, f) for f in filenames if f in _CACHE_PARSERS
+        ]
+    records = []
+    with futures.ProcessPoolExecutor(max_workers=n_workers) as ex:
+        for job in futures.as_completed(
+            [ex.submit(_warm_one, f) for f in sorted(fnames)]
+        ):
+            records.append(job.result())
+    summary = pd.DataFrame(
+        records, columns=["fname", "status", "error", "seconds"]
+    )
+    summary = summary.set_index("fname").reindex(sorted(fnames))
+    print(
+        "Cached {} of {} files ({} already cached)".format(
+            (summary["status"] == "cached").sum(),
+            len(summary),
+            (summary["status"] == "fresh").sum(),
+        )
+    )
+    return summary
+
+
+def _window_idxs(
+    index: np.ndarray, onsets: np.ndarray, offset: int, duration: int
+) -> np.ndarray:
+    """Ordinal sample indices for fixed-length windows starting at onsets.
+
+    Returns an (events x duration) array of integer positions into `index`.
+    Positions outside of [0, len(index)) are left as they are so that the
+    caller can decide how to deal with out-of-bounds windows.
+
+    """
+    starts = np.searchsorted(index, onsets, "left") + offset
+    return starts[:, None] + np.arange(duration)
+
+
+def _time_window_idxs(
+    index: np.ndarray, starts: np.ndarray, stops: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Ordinal sample indices for windows of time, which may all differ in
+    length.
+
+    Each window holds the samples with `start` <= timestamp < `stop`. All
+    windows are located with two calls to ``np.searchsorted`` on the sorted
+    `index`.
+
+    Returns
+    -------
+    flat : np.ndarray
+        Indices of the samples of every window, laid end to end.
+    offsets : np.ndarray
+        (windows + 1) positions in `flat` at which each window starts, so
+        window i is ``flat[offsets[i]:offsets[i + 1]]``.
+
+    """
+    lo = np.searchsorted(index, starts, "left")
+    hi = np.searchsorted(index, stops, "left")
+    lengths = np.maximum(hi - lo, 0)
+    offsets = np.r_[0, np.cumsum(lengths)]
+    flat = np.repeat(lo - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return flat, offsets
+
+
+def _gather_windows(values: np.ndarray, idxs: np.ndarray) -> np.ndarray:
+    """Gather windows of rows from a 2-D array with a single fancy index.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        (samples x fields) array.
+    idxs : np.ndarray
+        (events x duration) array of ordinal row indices, as returned by
+        ``_window_idxs(...)``.
+
+    Returns
+    -------
+    out : np.ndarray
+        (events x duration x fields) array. If every window is in bounds and
+        the window starts are evenly spaced (e.g., a single event, or events
+        at a fixed sample interval), this is a read-only, zero-copy strided
+        view on `values`. Otherwise it is a new array, with any samples
+        falling outside of `values` set to NaN (upcasting to float if
+        needed).
+
+    """
+    n = values.shape[0]
+    starts = idxs[:, 0]
+    in_bounds = starts.min() >= 0 and idxs.max() < n
+    steps = np.diff(starts)
+    if in_bounds and (steps.size == 0 or (steps == steps[0]).all()):
+        step = int(steps[0]) if steps.size else 0
+        s0, s1 = values.strides
+        return np.lib.stride_tricks.as_strided(
+            values[starts[0] :],
+            shape=(idxs.shape[0], idxs.shape[1], values.shape[1]),
+            strides=(step * s0, s0, s1),
+            writeable=False,
+        )
+    if in_bounds:
+        return values[idxs]
+    if np.issubdtype(values.dtype, np.number):
+        return kernels.gather_rows(values, idxs)
+    # upcast before padding, so that NaN is not coerced (e.g., to True)
+    dtype = "float" if values.dtype == bool else "object"
+    out = values[np.clip(idxs, 0, n - 1)].astype(dtype)
+    out[(idxs < 0) | (idxs >= n)] = np.nan
+    return out
 
 
 def extract(
@@ -200,10 +606,17 @@ def extract(
     offset: int = 0,
     duration: int = 0,
     borrow_attributes: List[str] = [],
-) -> pd.DataFrame:
+    fields: List[str] = None,
+    as_array: bool = False,
+) -> Union[pd.DataFrame, np.ndarray]:
     """
     Extracts ranges from samples based on event timing and sample count.
 
+    All ranges are located with a single call to ``np.searchsorted`` and
+    pulled from the samples with one gather, so the cost scales linearly with
+    the number of events. Ranges that extend beyond the first or last sample
+    are padded with NaN rather than wrapping around.
+
     Parameters
     ----------
     samples : pandas.DataFrame
@@ -213,9 +626,10 @@ def extract(
     offset : int, optional
         Number of samples to offset from baseline. The default is 0.
     duration : int, optional
-        Duration of all events in terms of the number of samples. Currently
-        this has to be the same for all events, but could use a 'duration'
-        column in events DataFrame if needs be. The default is 0.
+        Duration of all events in terms of the number of samples. This has
+        to be the same for all events. For windows in seconds, which may
+        differ between events, see ``epochs.RaggedEpochs``. The default
+        is 0.
     borrow_attributes : list of str, optional
         List of column names in the events DataFrame whose values should be
         copied to the respective ranges. For each item in the list, a
@@ -223,49 +637,61 @@ def extract(
         not exist in the events dataframe, the values in the each
         corresponding range will be set to float('nan'). This is uesful for
         marking conditions, grouping variables, etc. The default is [].
+    fields : list of str, optional
+        Columns of `samples` to extract. The default is None (all columns).
+    as_array : bool, optional
+        If True, return an (events x duration x fields) array of the values
+        in `fields` instead of a DataFrame. Where possible this is a
+        read-only view on the sample data (see ``_gather_windows(...)``),
+        and `borrow_attributes` are ignored. The default is False.
 
     Returns
     -------
-    df : pandas.DataFrame
-        Extracted events complete with hierarchical multi-index.
+    df : pandas.DataFrame or np.ndarray
+        Extracted events complete with hierarchical multi-index, or an array
+        of the extracted values if `as_array` is True.
 
     """
     # negative duration should raise an exception
     if duration <= 0:
         raise ValueError("Duration must be >0")
+    if len(samples) == 0 or len(events) == 0:
+        raise ValueError("Need at least one sample and one event")
+
+    if fields is None:
+        fields = list(samples.columns)
+    index = samples.index.to_numpy()
+    idxs = _window_idxs(index, events.index.to_numpy(), offset, duration)
+    n_out = int(((idxs[:, 0] < 0) | (idxs[:, -1] >= len(index))).sum())
+    if n_out:
+        print(
+            "{} ranges extend beyond the samples and were padded with "
+            "NaN".format(n_out)
+        )
 
-    # get the list of start time indices
-    event_starts = events.index.to_series()
-
-    # find the indexes of the event starts, and offset by sample count
-    range_idxs = (
-        np.searchsorted(samples.index, event_starts.iloc[:], "left") + offset
-    )
-    range_duration = duration
-
-    # make a hierarchical index
-    samples["orig_idx"] = samples.index
-    midx = pd.MultiIndex.from_product(
-        [list(range(len(event_starts))), list(range(range_duration))],
-        names=["event", "onset"],
+    if as_array:
+        values = samples[fields].to_numpy()
+        print("Extracted ranges for {} events".format(len(events)))
+        return _gather_windows(values, idxs)
+
+    # one gather for all columns, then blank the out-of-bounds samples
+    flat = idxs.ravel()
+    valid = (flat >= 0) & (flat < len(index))
+    clipped = np.clip(flat, 0, len(index) - 1)
+    df = samples[fields].iloc[clipped]
+    if n_out:
+        df = df.where(np.broadcast_to(valid[:, None], df.shape))
+    df.index = pd.MultiIndex.from_product(
+        [range(len(events)), range(duration)], names=["event", "onset"]
     )
+    df["orig_idx"] = np.where(valid, index[clipped], np.nan)
 
-    # TODO: can add option for time index here
-
-    # get the samples
-    df = pd.DataFrame()
-    idx = 0
-    for start_idx in range_idxs:
-        # get the start time and add the required number of indices
-        end_idx = start_idx + range_duration - 1  # .loc indexing is inclusive
-        new_df = deepcopy(
-            samples.loc[samples.index[start_idx] : samples.index[end_idx]]
-        )
-        for ba in borrow_attributes:
-            new_df[ba] = events.iloc[idx].get(ba, float("nan"))
-        df = pd.concat([df, new_df])
-        idx += 1
-    df.index = midx
+    # broadcast event attributes over their ranges
+    for ba in borrow_attributes:
+        if ba in events:
+            df[ba] = np.repeat(events[ba].to_numpy(), duration)
+        else:
+            df[ba] = float("nan")
     print("Extracted ranges for {} events".format(len(events)))
     return df
 